@@ -0,0 +1,20 @@
+# bench = benchmarks for Spill
+
+""" Benchmarks
+
+   $ python -m bench                      # everything
+   $ python -m bench fib show             # some workloads
+   $ python -m bench --quick              # the two smallest sizes only
+   $ python -m bench --json new.json
+   $ python -m bench --compare old.json new.json
+
+(run from the top directory of the source tree). Each workload (see
+workloads.py) is run at a series of growing sizes, and the time each
+of its phases takes is reported, together with the peak memory used.
+For each size after the first, the runner also shows how fast the
+time is growing, as the exponent k in time ~ size**k: about 1 for
+work that is linear in the size, about 2 for quadratic work. See
+runner.py.
+"""
+
+#end
@@ -0,0 +1,9 @@
+# __main__.py = lets the benchmarks be run with "python -m bench"
+
+import sys
+
+from bench import runner
+
+sys.exit(runner.main(sys.argv[1:]))
+
+#end
@@ -0,0 +1,268 @@
+# runner.py = runs the benchmarks and reports on them
+
+""" The runner times each phase of a workload (see workloads.py) a
+few times and keeps the best time. Each workload is run at each of
+its sizes in a fresh Python process (unless --inline is given), so
+that the peak memory that process used (its maximum resident set
+size) can be reported for it.
+
+For each phase and each size after the first, the report shows k, the
+exponent in time ~ work**k found from that size and the one before:
+about 1 means the phase is linear in the size, about 2 quadratic.
+
+With --json FILE the results are also written to FILE:
+
+   {"python": "2.7.18 ...", "when": "2026-10-18 12:00:00",
+    "results": [{"workload": "fib", "size": 12, "work": 465,
+                 "setup": 0.12, "maxrss": 9304, "phases":
+                 [["seval", 0.0031], ["compile", 0.0012]]},
+                ...]}
+
+(times in seconds, maxrss in kilobytes). --compare OLD NEW shows how
+each phase's time has changed between two such files.
+"""
+
+import gc
+import json
+import math
+import optparse
+import os
+import subprocess
+import sys
+import time
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path: sys.path.insert(0, ROOT)
+
+debug = 0
+
+timer = timeit.default_timer
+
+# how many times to time each phase, by default
+REPEAT = 3
+
+#---------------------------------------------------------------------
+# running
+
+def maxRss():
+    """ the peak memory this process has used
+    @return [int] kilobytes, or None if we can't tell
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # it's in bytes on Mac OS X, kilobytes elsewhere
+    if sys.platform=="darwin": rss //= 1024
+    return rss
+
+def bestTime(f, state, repeat):
+    """ the shortest of (repeat) timings of f(state)
+    @return [float] seconds
+    """
+    best = None
+    for i in xrange(repeat):
+        gc.collect()
+        t0 = timer()
+        f(state)
+        t = timer() - t0
+        if best is None or t < best: best = t
+    return best
+
+def runWorkload(w, size, repeat=REPEAT):
+    """ run one workload at one size, in this process
+    @param w [workloads.Workload]
+    @return [dict] the results, as described above
+    """
+    t0 = timer()
+    state = w.setup(size)
+    setupTime = timer() - t0
+    phases = []
+    for name, f in w.phases:
+        phases.append([name, bestTime(f, state, repeat)])
+        if debug: print "%s %d %s: %.6f" % (w.name, size, name, phases[-1][1])
+    return {
+        'workload': w.name,
+        'size': size,
+        'work': w.work(size),
+        'setup': setupTime,
+        'maxrss': maxRss(),
+        'phases': phases,
+    }
+
+def runChild(name, size, repeat):
+    """ run one workload at one size in a child process, for the
+    peak memory it used
+    @return [dict]
+    """
+    cmd = [sys.executable, "-m", "bench", "--child", name, str(size),
+           "--repeat", str(repeat)]
+    p = subprocess.Popen(cmd, cwd=ROOT, stdout=subprocess.PIPE)
+    out = p.communicate()[0]
+    if p.returncode!=0:
+        raise RuntimeError("%s %d failed" % (name, size))
+    # the results are on the last line, after any output of its own
+    return json.loads(out.strip().splitlines()[-1])
+
+def runAll(names=None, quick=False, repeat=REPEAT, inline=False,
+           report=None):
+    """ run some workloads at each of their sizes
+    @param names [list of str] which workloads; defaults to all
+    @param quick [bool] only run the two smallest sizes
+    @param inline [bool] run them in this process, rather than
+       each in a fresh one; then the memory figures aren't useful
+    @param report [file] write the report to this as it goes
+    @return [list of dict] the results, as described above
+    """
+    from bench import workloads
+    if names:
+        todo = [workloads.byName[name] for name in names]
+    else:
+        todo = workloads.WORKLOADS
+    results = []
+    for w in todo:
+        sizes = w.sizes
+        if quick: sizes = sizes[:2]
+        previous = None
+        for size in sizes:
+            if inline:
+                r = runWorkload(w, size, repeat)
+            else:
+                r = runChild(w.name, size, repeat)
+            results.append(r)
+            if report:
+                report.write(formatResult(r, previous))
+                report.flush()
+            previous = r
+    return results
+
+#---------------------------------------------------------------------
+# reporting
+
+def exponent(t0, t1, work0, work1):
+    """ k, in t ~ work**k, from two timings
+    @return [float] or None if it can't be worked out
+    """
+    if t0 <= 0 or t1 <= 0 or work1==work0: return None
+    return math.log(t1/t0) / math.log(float(work1)/work0)
+
+def formatResult(r, previous=None):
+    """ the report on one workload at one size
+    @param previous [dict] the results at the size before, if any
+    @return [str]
+    """
+    before = {}
+    if previous and previous['workload']==r['workload']:
+        before = dict(previous['phases'])
+    lines = []
+    for name, t in r['phases']:
+        k = None
+        if name in before:
+            k = exponent(before[name], t, previous['work'], r['work'])
+        kStr = ""
+        if k is not None: kStr = "%6.2f" % (k,)
+        lines.append("%-10s %7d  %-28s %11.6f %6s" % (
+            r['workload'], r['size'], name, t, kStr))
+    mem = ""
+    if r['maxrss'] is not None: mem = ", peak memory %.1f MB" % (
+        r['maxrss'] / 1024.0,)
+    lines.append("%-10s %7d  (setup %.6f%s)" % (
+        r['workload'], r['size'], r['setup'], mem))
+    return "\n".join(lines) + "\n"
+
+HEADER = "%-10s %7s  %-28s %11s %6s\n" % (
+    "workload", "size", "phase", "seconds", "k")
+
+def writeJson(results, filename):
+    data = {
+        'python': sys.version,
+        'when': time.strftime("%Y-%m-%d %H:%M:%S"),
+        'results': results,
+    }
+    f = open(filename, "w")
+    try:
+        json.dump(data, f, indent=1)
+    finally:
+        f.close()
+
+def readJson(filename):
+    f = open(filename)
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+def compare(old, new):
+    """ how each phase's time has changed between two runs
+    @param old, new [dict] as written by writeJson()
+    @return [str] a report
+    """
+    oldTimes = {}
+    for r in old['results']:
+        for name, t in r['phases']:
+            oldTimes[(r['workload'], r['size'], name)] = t
+    lines = ["%-10s %7s  %-28s %11s %11s %8s" % (
+        "workload", "size", "phase", "old", "new", "change")]
+    for r in new['results']:
+        for name, t in r['phases']:
+            t0 = oldTimes.get((r['workload'], r['size'], name))
+            if t0 is None: continue
+            change = ""
+            if t0 > 0: change = "%+7.1f%%" % ((t/t0 - 1) * 100,)
+            lines.append("%-10s %7d  %-28s %11.6f %11.6f %8s" % (
+                r['workload'], r['size'], name, t0, t, change))
+    return "\n".join(lines) + "\n"
+
+#---------------------------------------------------------------------
+
+USAGE = """%prog [options] [workload ...]
+       %prog --compare OLD.json NEW.json"""
+
+def main(args):
+    op = optparse.OptionParser(usage=USAGE)
+    op.add_option("--quick", action="store_true",
+                  help="only run the two smallest sizes")
+    op.add_option("--repeat", type="int", default=REPEAT,
+                  help="time each phase this many times [%default]")
+    op.add_option("--inline", action="store_true",
+                  help="run everything in this process")
+    op.add_option("--json", metavar="FILE",
+                  help="write the results to FILE")
+    op.add_option("--compare", action="store_true",
+                  help="compare the results in two JSON files")
+    op.add_option("--list", action="store_true",
+                  help="list the workloads")
+    op.add_option("--child", action="store_true",
+                  help=optparse.SUPPRESS_HELP)
+    options, args = op.parse_args(args)
+
+    if options.compare:
+        if len(args)!=2: op.error("--compare needs two files")
+        sys.stdout.write(compare(readJson(args[0]), readJson(args[1])))
+        return 0
+    from bench import workloads
+    if options.list:
+        for w in workloads.WORKLOADS:
+            print "%-10s %s" % (w.name, w.doc)
+        return 0
+    if options.child:
+        name, size = args
+        r = runWorkload(workloads.byName[name], int(size), options.repeat)
+        print json.dumps(r)
+        return 0
+    for name in args:
+        if name not in workloads.byName:
+            op.error("no workload called %r" % (name,))
+
+    sys.stdout.write(HEADER)
+    results = runAll(args, options.quick, options.repeat, options.inline,
+                     report=sys.stdout)
+    if options.json: writeJson(results, options.json)
+    return 0
+
+if __name__=='__main__':
+    sys.exit(main(sys.argv[1:]))
+
+#end
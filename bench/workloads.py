@@ -0,0 +1,326 @@
+# workloads.py = the benchmark workloads
+
+""" Each Workload is run at a series of sizes. For each size, setup()
+makes the input -- e.g. generates a source file of that many forms --
+and then each phase is timed in turn. Phases are run in order, and a
+phase can leave its result in the state for later ones to use (e.g.
+"read" uses the tokens "scan" made).
+
+A workload's work() says how much work a size stands for, if that
+isn't the size itself (e.g. the number of calls (fib n) makes), so
+that the runner's scaling exponents are about 1 for anything that
+does a constant amount of work per unit.
+"""
+
+import StringIO
+
+import lexer
+import reader
+import spill
+import spilltypes
+
+try:
+    import parser
+except ImportError:
+    # it needs SPARK, which may not be installed
+    parser = None
+
+debug = 0
+
+#---------------------------------------------------------------------
+
+class Workload:
+
+    def __init__(self, name, sizes, setup, phases, work=None, doc=""):
+        """
+        @param name [str]
+        @param sizes [list of int] the sizes to run it at, smallest
+           first
+        @param setup [function] setup(size) returns the state (a dict)
+           the phases work on. It isn't timed.
+        @param phases [list of (str, function)] each phase's name,
+           and a function taking the state
+        @param work [function] work(size) is how much work (size)
+           stands for; defaults to the size itself
+        @param doc [str] what it measures
+        """
+        self.name = name
+        self.sizes = sizes
+        self.setup = setup
+        self.phases = phases
+        self.work = work or (lambda n: n)
+        self.doc = doc
+
+# all the workloads, in the order they're run
+WORKLOADS = []
+
+# workload name -> Workload
+byName = {}
+
+def addWorkload(w):
+    WORKLOADS.append(w)
+    byName[w.name] = w
+
+def newSpillSys(engine='seval'):
+    # no form cache, so loading the library is timed the same each run
+    return spill.SpillSys(engine=engine, cache=False)
+
+#---------------------------------------------------------------------
+# lexing and parsing a large source file
+
+SOURCE_FORM = """\
+; form %(i)d
+(def f%(i)d (fn (a b * rest)
+   #| a comment
+      over two lines |#
+   (if (< a %(i)d)
+       (list "string %(i)d\\n" 'sym%(i)d 35 -%(i)d a)
+       `(a ,b ,@rest (nested (lists (of (depth 4))))))))
+"""
+
+def sourceText(n):
+    """ Spill source code with (n) top-level forms
+    @return [str]
+    """
+    return "".join([SOURCE_FORM % {'i': i} for i in xrange(n)])
+
+def setupSource(n):
+    return {'text': sourceText(n)}
+
+def scanPhase(state):
+    state['tokens'] = lexer.scan(state['text'])
+
+def tokenizePhase(state):
+    state['posTokens'] = lexer.Lexer().tokenize(state['text'])
+
+def istreamPhase(state):
+    lexer.Lexer(mode='istream').tokenize(state['text'])
+
+def readPhase(state):
+    for form in reader.readForms(state['tokens']): pass
+
+def iterFormsPhase(state):
+    for form in reader.iterForms(StringIO.StringIO(state['text'])): pass
+
+def spillParserPhase(state):
+    parser.SpillParser().parse(state['posTokens'], lambda form: None)
+
+sourcePhases = [
+    ("scan", scanPhase),
+    ("Lexer.tokenize", tokenizePhase),
+    ("Lexer istream", istreamPhase),
+    ("readForms", readPhase),
+    ("iterForms", iterFormsPhase),
+]
+if parser: sourcePhases.append(("SpillParser", spillParserPhase))
+
+addWorkload(Workload("source", [250, 500, 1000, 2000],
+    setupSource, sourcePhases,
+    doc="lexing and parsing a source file of (size) top-level forms"))
+
+#---------------------------------------------------------------------
+# macro expansion
+
+MACRO_FORM = """\
+(defn m%(i)d (a b)
+   (and (and2 a (and b %(i)d))
+        (and2 (and a b) (defn inner (x) (and2 x (and x b))))))
+"""
+
+def setupMacros(n):
+    si = newSpillSys()
+    text = "".join([MACRO_FORM % {'i': i} for i in xrange(n)])
+    forms = list(reader.readForms(lexer.scan(text)))
+    return {'si': si, 'forms': forms}
+
+def expandColdPhase(state):
+    si = state['si']
+    for form in state['forms']:
+        # forget the expansions made so far, so every call is expanded
+        si.macroTable.expansions.clear()
+        si.macroExpand(form)
+
+def expandPhase(state):
+    si = state['si']
+    si.macroTable.expansions.clear()
+    state['expanded'] = [si.macroExpand(form) for form in state['forms']]
+
+def expandMemoPhase(state):
+    si = state['si']
+    for form in state['forms']: si.macroExpand(form)
+
+def optimisePhase(state):
+    si = state['si']
+    for form in state['expanded']: si.optimise(form)
+
+def evalDefsPhase(state):
+    si = state['si']
+    for form in state['expanded']: si.eval(form)
+
+addWorkload(Workload("macros", [100, 200, 400, 800],
+    setupMacros, [
+        ("expand, one form at a time", expandColdPhase),
+        ("expand", expandPhase),
+        ("expand again", expandMemoPhase),
+        ("optimise", optimisePhase),
+        ("eval", evalDefsPhase),
+    ],
+    doc="expanding (size) forms full of macro calls, and evaluating"
+        " the expansions"))
+
+#---------------------------------------------------------------------
+# evaluation
+
+FIB = """
+(def fib (fn (n)
+   (if (< n 2) n
+       (+ (fib (- n 1)) (fib (- n 2))))))
+"""
+
+def fibCalls(n):
+    """ how many calls (fib n) makes """
+    a, b = 1, 1
+    for i in xrange(n): a, b = b, a+b
+    return 2*a - 1
+
+def setupFib(n):
+    state = {'call': ('fib', n)}
+    for engine in spill.ENGINES:
+        si = newSpillSys(engine)
+        si.readEval(FIB)
+        state[engine] = si
+    return state
+
+def fibPhase(engine):
+    def phase(state):
+        state[engine].eval(state['call'])
+    return phase
+
+addWorkload(Workload("fib", [12, 14, 16, 18],
+    setupFib, [(engine, fibPhase(engine)) for engine in spill.ENGINES],
+    work=fibCalls,
+    doc="recursive (fib size), on each engine; the work is the number"
+        " of calls"))
+
+def setupLists(n):
+    si = newSpillSys()
+    si.readEval("(def xs (fromto 1 %d))" % (n,))
+    return {'si': si, 'n': n}
+
+def listPhase(code):
+    def phase(state):
+        state['si'].readEval(code % state)
+    return phase
+
+addWorkload(Workload("lists", [2000, 4000, 8000, 16000],
+    setupLists, [
+        ("fromto", listPhase("(fromto 1 %(n)d)")),
+        ("map", listPhase("(map (fn (x) (* x x)) xs)")),
+        ("filter", listPhase("(filter odd? xs)")),
+        ("reduce", listPhase("(reduce + 0 xs)")),
+        ("length", listPhase("(length xs)")),
+        ("reverse", listPhase("(reverse xs)")),
+        ("sort", listPhase("(sort (reverse xs))")),
+    ],
+    doc="list primitives on a list of (size) numbers"))
+
+addWorkload(Workload("append", [250, 500, 1000, 2000],
+    setupLists, [
+        ("append", listPhase(
+            "(reduce (fn (acc x) (append acc (list x))) '() xs)")),
+        ("cons+reverse", listPhase(
+            "(reverse (reduce (fn (acc x) (cons x acc)) '() xs))")),
+    ],
+    doc="building a list of (size) numbers an element at a time, by"
+        " appending to the end (quadratic) and by consing to the front"))
+
+def nestedClosures(n):
+    """ (n) nested fns, each called as soon as it's made; the
+    innermost one uses all their parameters
+    @return [str]
+    """
+    params = ["a%d" % i for i in xrange(n)]
+    code = "(list %s)" % (" ".join(params),)
+    for p in reversed(params):
+        code = "((fn (%s) %s) 1)" % (p, code)
+    return code
+
+def setupClosures(n):
+    state = {'code': nestedClosures(n)}
+    for engine in spill.ENGINES:
+        si = newSpillSys(engine)
+        si.readEval("(def deep (fn () %s))" % (state['code'],))
+        state[engine] = si
+    return state
+
+def closurePhase(engine):
+    def phase(state):
+        state[engine].readEval("(deep)")
+    return phase
+
+def closureCompilePhase(state):
+    state['compile'].readEval(state['code'])
+
+addWorkload(Workload("closures", [25, 50, 100, 200],
+    setupClosures,
+    [(engine, closurePhase(engine)) for engine in spill.ENGINES]
+    + [("compile and run", closureCompilePhase)],
+    doc="(size) nested closures, each looking up all the variables of"
+        " the ones around it"))
+
+#---------------------------------------------------------------------
+# show
+
+def balancedTree(n):
+    """ a tree of nested lists with (n) leaves """
+    if n <= 2: return spilltypes.toCons(range(n))
+    return spilltypes.toCons([balancedTree(n//2), balancedTree(n - n//2)])
+
+def setupShow(n):
+    return {
+        'flat': spilltypes.toCons(range(n)),
+        'tree': balancedTree(n),
+        'strings': spilltypes.toCons(
+            [spilltypes.LStr('line %d: "quoted"\n' % i)
+             for i in xrange(n)]),
+        'vector': spilltypes.toVector(range(n)),
+    }
+
+def showPhase(key):
+    def phase(state):
+        spilltypes.show(state[key])
+    return phase
+
+addWorkload(Workload("show", [2000, 4000, 8000, 16000],
+    setupShow, [(key, showPhase(key))
+                for key in ('flat', 'tree', 'strings', 'vector')],
+    doc="show() on structures with (size) elements"))
+
+#---------------------------------------------------------------------
+# maps
+
+def setupMaps(n):
+    keys = ["key%d" % (i,) for i in xrange(n)]
+    return {'keys': keys, 'map': spilltypes.toMap(zip(keys, keys))}
+
+def assocPhase(state):
+    m = spilltypes.EMPTY_MAP
+    for key in state['keys']: m = m.assoc(key, key)
+
+def getPhase(state):
+    m = state['map']
+    for key in state['keys']: m.get(key)
+
+def dissocPhase(state):
+    m = state['map']
+    for key in state['keys']: m = m.dissoc(key)
+
+addWorkload(Workload("maps", [2000, 4000, 8000, 16000],
+    setupMaps, [
+        ("assoc", assocPhase),
+        ("get", getPhase),
+        ("dissoc", dissocPhase),
+    ],
+    doc="building, reading and emptying a map with (size) keys"))
+
+#end
@@ -1,5 +1,21 @@
 # lexer.py = a lexical analyser for Spill
 
+""" There are two lexers here:
+
+scan() makes a single pass over the source with one regular
+expression, and puts the tokens it finds into a TokenArrays: parallel
+arrays of type codes, start/end offsets and line numbers, rather than
+a Python object per token. The value of a token (e.g. the int an
+INTEGER stands for) is only worked out when it's asked for.
+
+Lexer is the original lexer, built on istream.ScanString. By
+default, its tokenize() method now uses scan() and converts the
+result to PosTokens, so it's as fast as scan(), but the original
+algorithm is still there with Lexer(mode='istream').
+"""
+
+from array import array
+import re
 import string
 
 import addpath
@@ -42,6 +58,19 @@ HEX_TO_DEC = {
    'f':15, 'F':15,
 }
 
+ESCAPE_RE = re.compile(r"\\(x.{0,2}|.?)", re.S)
+
+def replaceEscape(m):
+    """ replace one escape found by ESCAPE_RE """
+    e = m.group(1)
+    if e=="n": return "\n"
+    if e[:1]=="x":
+        try:
+            return chr(HEX_TO_DEC[e[1]]*16 + HEX_TO_DEC[e[2]])
+        except (KeyError, IndexError):
+            return ""
+    return e
+
 def replaceStringEscapes(s):
     r""" replace Spill escapes in a string. Spill escapes are:
 
@@ -57,6 +86,13 @@ def replaceStringEscapes(s):
     """
     if debug:
         print "replaceStringEscapes(s=%r)" % (s,)
+    if "\\" not in s: return s
+    return ESCAPE_RE.sub(replaceEscape, s)
+
+def replaceStringEscapesSlow(s):
+    """ the original, character-at-a-time version of
+    replaceStringEscapes(), which it should always agree with
+    """
     r = ""
     ix = 0
     while 1:
@@ -95,11 +131,137 @@ def replaceStringEscapes(s):
 IDENT_START_CHAR = string.ascii_letters + "_~?!+-*/<>="
 IDENT_CHAR = IDENT_START_CHAR + "0123456789"
 
+#---------------------------------------------------------------------
+# the regular expression lexer
+
+# token type codes
+(INTEGER, IDENTIFIER, STRING, QUOTE, QUASIQUOTE, UNQUOTE,
+ UNQUOTESPLICING, LPAREN, RPAREN, VECTOR, OTHER) = range(11)
+
+# token types as PosToken has them; an OTHER token's type is its text
+TOKEN_TYPES = ('INTEGER', 'IDENTIFIER', 'STRING', 'QUOTE', 'QUASIQUOTE',
+               'UNQUOTE', 'UNQUOTESPLICING', '(', ')', '#(', None)
+TYPE_CODES = dict([(t, ix) for ix, t in enumerate(TOKEN_TYPES) if t])
+
+def tokenCode(tokenType):
+    """ the type code for a PosToken type """
+    return TYPE_CODES.get(tokenType, OTHER)
+
+SKIP = -1
+
+# each alternative is a group; the type code for a match is
+# GROUP_CODES[m.lastindex]
+TOKEN_RE = re.compile(r"""
+   ([ \t\r\n]+)
+ | (;\{\{.*?(?:;\}\}|\Z) | \#\|.*?(?:\|\#|\Z) | ;[^\n]*)
+ | (-?[0-9]+)
+ | ([A-Za-z_~?!+\-*/<>=][A-Za-z0-9_~?!+\-*/<>=]*)
+ | ("(?:[^"\\]|\\.)*")
+ | (".*)
+ | (')
+ | (`)
+ | (,@)
+ | (,)
+ | (\#\()
+ | (\()
+ | (\))
+ | (.)
+""", re.S | re.X)
+GROUP_CODES = (None, SKIP, SKIP, INTEGER, IDENTIFIER, STRING,
+               OTHER, # a string with no closing quote
+               QUOTE, QUASIQUOTE, UNQUOTESPLICING, UNQUOTE, VECTOR, LPAREN,
+               RPAREN, OTHER)
+
+class TokenArrays:
+    """ the tokens of a piece of source text, stored compactly.
+    Token (i) has type code types[i], is text[starts[i]:ends[i]],
+    and is on line lines[i].
+    For code expecting a list of PosTokens, len() and indexing
+    also work, creating the PosTokens on the fly.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.types = array('B')
+        self.starts = array('l')
+        self.ends = array('l')
+        self.lines = array('l')
+
+    def __len__(self):
+        return len(self.types)
+
+    def typeName(self, i):
+        """ the type of token (i), as a PosToken would have it """
+        code = self.types[i]
+        if code==OTHER: return self.text[self.starts[i]]
+        return TOKEN_TYPES[code]
+
+    def value(self, i):
+        """ the value of token (i): an int for an INTEGER, a str for
+        an IDENTIFIER or STRING, None for anything else
+        """
+        code = self.types[i]
+        if code==IDENTIFIER:
+            return intern(self.text[self.starts[i]:self.ends[i]])
+        if code==INTEGER:
+            return int(self.text[self.starts[i]:self.ends[i]])
+        if code==STRING:
+            s = self.text[self.starts[i]+1:self.ends[i]-1]
+            return replaceStringEscapes(s)
+        return None
+
+    def where(self, i):
+        """ where token (i) starts
+        @return [int,int] line and column, both counting from 1
+        """
+        start = self.starts[i]
+        col = start - self.text.rfind("\n", 0, start)
+        return self.lines[i], col
+
+    def __getitem__(self, i):
+        line, col = self.where(i)
+        return PosToken(self.typeName(i), self.value(i), line, col)
+
+    def posTokens(self):
+        return [self[i] for i in xrange(len(self))]
+
+def scan(text):
+    """ Tokenize a string in one pass
+    @param text [str]
+    @return [TokenArrays]
+    """
+    ta = TokenArrays(text)
+    addType = ta.types.append
+    addStart = ta.starts.append
+    addEnd = ta.ends.append
+    addLine = ta.lines.append
+    count = text.count
+    line = 1
+    for m in TOKEN_RE.finditer(text):
+        code = GROUP_CODES[m.lastindex]
+        start, end = m.span()
+        if code==SKIP:
+            line += count("\n", start, end)
+            continue
+        addType(code)
+        addStart(start)
+        addEnd(end)
+        addLine(line)
+        if code==STRING or code==OTHER:
+            line += count("\n", start, end)
+    #//for
+    return ta
+
 #---------------------------------------------------------------------
 
 class Lexer:
 
-    def __init__(self):
+    def __init__(self, mode='regex'):
+        """
+        @param mode [str] 'regex' to tokenize using scan(),
+           'istream' for the original lexer
+        """
+        self.mode = mode
         self.rv = []
 
     def tokenize(self, s):
@@ -107,6 +269,8 @@ class Lexer:
         @param s [string]
         @return [list of PosToken]
         """
+        if self.mode=='regex':
+            return scan(s).posTokens()
         self.rv = []
         self.ss = istream.ScanString(s)
         self.lex()
@@ -6,6 +6,7 @@ import addpath
 import spark07; spark = spark07 # SPARK parsing framework
 
 import lexer
+import reader
 import spilltypes
 
 debug = 0
@@ -13,8 +14,7 @@ debug = 0
 #---------------------------------------------------------------------
 # exceptions for parsing errors
 
-class SpillSyntaxError(Exception):
-    """ an error occurred while parsing Spill code or literals """
+SpillSyntaxError = reader.SpillSyntaxError
 
 
 # debugging:
@@ -111,8 +111,7 @@ expressionParser = SpillParser('exp')
 
 def parseExp(expStr):
     """ parse an expression """
-    tokens = lexer.Lexer().tokenize(expStr)
-    return expressionParser.parse(tokens)
+    return reader.readExp(lexer.scan(expStr))
 
 
 #---------------------------------------------------------------------
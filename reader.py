@@ -0,0 +1,240 @@
+# reader.py = a fast reader (parser) for Spill
+
+""" The reader
+
+Spill's syntax is just s-expressions, so rather than use a general
+parser (as parser.SpillParser does) the reader goes through the tokens
+once, keeping a stack of the lists that are open. It does a constant
+amount of work per token, doesn't recurse, and produces the same
+values as SpillParser:
+
+   (a b c)   => ('a', 'b', 'c')
+   "text"    => LStr("text")
+   'x        => ('quote', x)
+   `x        => ('quasiquote', x)
+   ,x        => ('unquote', x)
+   ,@x       => ('unquotesplicing', x)
+   #(1 2 3)  => a spilltypes.Vector
+
+readForms() is a generator, so the caller can deal with each top-level
+form as soon as it has been read. iterForms() does the same for a file,
+reading it a chunk at a time.
+"""
+
+import lexer
+import spilltypes
+
+debug = 0
+
+# whether string literals are interned (see spilltypes.internLStr()),
+# so that the same string appearing many times is only stored once
+internStrings = True
+
+#---------------------------------------------------------------------
+
+class SpillSyntaxError(Exception):
+    """ an error occurred while parsing Spill code or literals """
+
+# prefix tokens, and the expression they wrap the following one in
+PREFIXES = {
+    lexer.QUOTE: 'quote',
+    lexer.QUASIQUOTE: 'quasiquote',
+    lexer.UNQUOTE: 'unquote',
+    lexer.UNQUOTESPLICING: 'unquotesplicing',
+}
+
+def syntaxError(where, message):
+    """ make an exception for a syntax error
+    @param where [int,int] the line and column of the error, or None
+    """
+    if where and where[0] > 0:
+        message = "line %s col %s: %s" % (where[0], where[1], message)
+    return SpillSyntaxError(message)
+
+#---------------------------------------------------------------------
+
+def readForms(tokens):
+    """ read top-level forms from a sequence of tokens
+    @param tokens [lexer.TokenArrays|list of lexer.PosToken]
+    @return [generator of s-exp]
+    """
+    if isinstance(tokens, lexer.TokenArrays):
+        return readCoded(tokens.types, tokens.value, tokens.where)
+    tokens = list(tokens)
+    def value(i): return tokens[i].attr
+    def where(i): return tokens[i].line, tokens[i].col
+    codes = [lexer.tokenCode(tok.type) for tok in tokens]
+    return readCoded(codes, value, where)
+
+def readCoded(codes, value, where):
+    """ read top-level forms from tokens given by type code
+    @param codes [sequence of int] the type code of each token
+    @param value [function] value(i) is the value of token (i)
+    @param where [function] where(i) is the (line, column) of token (i)
+    @return [generator of s-exp]
+    """
+    QUOTE, UNQUOTESPLICING = lexer.QUOTE, lexer.UNQUOTESPLICING
+    LPAREN, RPAREN, VECTOR = lexer.LPAREN, lexer.RPAREN, lexer.VECTOR
+    INTEGER, IDENTIFIER, STRING = lexer.INTEGER, lexer.IDENTIFIER, \
+                                  lexer.STRING
+    LStr = spilltypes.LStr
+    if internStrings: LStr = spilltypes.internLStr
+    openLists = []  # (items, pending, vectorAt) for each enclosing list
+    items = None    # items of the innermost open list; None at top level
+    pending = []    # prefixes waiting for the next expression
+    vectorAt = None # if the innermost list is a vector, where it starts
+    i = -1
+    for i, code in enumerate(codes):
+        if QUOTE <= code <= UNQUOTESPLICING:
+            pending.append(PREFIXES[code])
+            continue
+        if code==LPAREN or code==VECTOR:
+            openLists.append((items, pending, vectorAt))
+            items = []
+            pending = []
+            vectorAt = None
+            if code==VECTOR: vectorAt = i
+            continue
+        if code==RPAREN:
+            if items is None:
+                raise syntaxError(where(i), "unexpected ')'")
+            if pending:
+                raise syntaxError(where(i),
+                                  "nothing after %s" % (pending[-1],))
+            if vectorAt is None:
+                v = tuple(items)
+            else:
+                try:
+                    v = spilltypes.toVector(items)
+                except TypeError:
+                    raise syntaxError(where(vectorAt),
+                                      "a vector can only hold numbers")
+            items, pending, vectorAt = openLists.pop()
+        elif code==INTEGER or code==IDENTIFIER:
+            v = value(i)
+        elif code==STRING:
+            v = LStr(value(i))
+        else:
+            raise syntaxError(where(i), "unexpected token")
+
+        while pending:
+            v = (pending.pop(), v)
+        if items is None:
+            yield v
+        else:
+            items.append(v)
+    #//for
+
+    if items is not None:
+        raise syntaxError(i>=0 and where(i), "missing ')' at end of input")
+    if pending:
+        raise syntaxError(where(i), "nothing after %s" % (pending[-1],))
+
+def readExp(tokens):
+    """ read a single expression
+    @param tokens [lexer.TokenArrays|list of lexer.PosToken]
+    @return [s-exp]
+    """
+    forms = list(readForms(tokens))
+    if len(forms)!=1:
+        raise SpillSyntaxError("expected 1 expression, got %d"
+                               % (len(forms),))
+    return forms[0]
+
+#---------------------------------------------------------------------
+# reading from files
+
+CHUNK_SIZE = 64*1024
+
+def iterForms(f, chunkSize=CHUNK_SIZE):
+    """ read top-level forms from a file a chunk at a time, yielding
+    each form as soon as all of it has been read. Only the current,
+    incomplete, form is kept in memory.
+    @param f [file] an open file, or anything with a read() method
+    @param chunkSize [int] how much to read at a time
+    @return [generator of s-exp]
+    """
+    buf = ""
+    lineBase = 0
+    readSize = chunkSize
+    eof = False
+    while not eof:
+        chunk = f.read(readSize)
+        eof = not chunk
+        buf += chunk
+        ta = lexer.scan(buf)
+        n = completeTokens(ta, eof)
+        if n==0 and not eof:
+            # a form bigger than we've read so far; read more each
+            # time so we don't re-scan it too often
+            readSize *= 2
+            continue
+        readSize = chunkSize
+
+        def where(i, ta=ta, lineBase=lineBase):
+            line, col = ta.where(i)
+            return line+lineBase, col
+        for form in readCoded(ta.types[:n], ta.value, where):
+            yield form
+        if not eof:
+            cut = ta.ends[n-1]
+            lineBase += buf.count("\n", 0, cut)
+            buf = buf[cut:]
+    #//while
+
+def completeTokens(ta, eof):
+    """ how many tokens, from the start of (ta), make up complete
+    top-level forms?
+    @param ta [lexer.TokenArrays] tokens from the start of a file
+    @param eof [bool] is this all of the file?
+    @return [int]
+    """
+    types = ta.types
+    if eof: return len(types)
+    QUOTE, UNQUOTESPLICING = lexer.QUOTE, lexer.UNQUOTESPLICING
+    LPAREN, RPAREN = lexer.LPAREN, lexer.RPAREN
+    depth = 0
+    last = prevLast = 0
+    for i, code in enumerate(types):
+        if code==LPAREN or code==lexer.VECTOR:
+            depth += 1
+            continue
+        if code==RPAREN:
+            depth -= 1
+            # too many ')'s: let the reader report it
+            if depth < 0: return i+1
+        elif QUOTE <= code <= UNQUOTESPLICING:
+            continue
+        if depth==0:
+            prevLast, last = last, i+1
+    #//for
+    if last and types[last-1]!=RPAREN and types[last-1]!=lexer.STRING \
+           and ta.ends[last-1]==len(ta.text):
+        # an atom at the end of what we've read might continue in
+        # the next chunk
+        return prevLast
+    return last
+
+#---------------------------------------------------------------------
+
+class Reader:
+    """ can be used in place of parser.SpillParser """
+
+    def __init__(self, startSymbol=None):
+        """
+        @param startSymbol [str] 'sourceFile' to read any number of
+           top-level forms, or 'exp' to read one expression
+        """
+        if startSymbol==None: startSymbol = 'sourceFile'
+        self.startSymbol = startSymbol
+
+    def parse(self, tokenList, callbackFun=None):
+        """ read tokens. For a source file, call (callbackFun) with
+        each top-level form as it is read.
+        """
+        if self.startSymbol=='exp':
+            return readExp(tokenList)
+        for form in readForms(tokenList):
+            if callbackFun: callbackFun(form)
+
+#end
@@ -1,14 +1,24 @@
 # spill.py = short practical implementation of a Lisplike language
 
+import os
 import sys
+import threading
 
 import addpath
-import butil
 
 from decspill import *
 import spilltypes
 import lexer
-import parser
+import reader
+import spillcomp
+import spillmemo
+import spillopt
+import spillaot
+import spillcache
+import spillpar
+import spillport
+import spillprof
+import spilltrace
 
 debug = 0
 isa = isinstance
@@ -18,11 +28,88 @@ isa = isinstance
 
 An environment is a list of variables and bindings. The top-level
 binding contains global variables and primitive (built-in) functions
+
+An environment can be frozen, after which nothing can be defined in
+it. A frozen environment can be shared as the parent of other
+environments, so that several SpillSys instances can use the same
+primitives and library without each loading them (see
+SpillSys.spawn()). Setting a variable that lives in a frozen
+environment (with set!) creates a new binding for it in the global
+environment of the SpillSys doing it instead (copy-on-write), so the
+shared one is left unchanged. That's so even when it's done by a
+function defined in the frozen environment; and from then on, that
+function sees the new binding too, while it's running in that
+SpillSys.
+
+Compiled code (see spillcomp.py) doesn't look global variables up by
+name each time they're used. Instead each place a global variable is
+referred to keeps the Cell holding its value, found the first time it
+is used. Redefining the variable changes the value in the Cell. If
+the variables an environment holds change -- a new one is defined,
+e.g. one that hides a variable of the same name in a parent
+environment, or one is removed -- the version of the Stamp it
+shares with the other environments of its tree goes up, and the
+Cells are looked up again. A tree stops at a frozen environment: each
+SpillSys spawned from a base has a Stamp of its own, chained to the
+base's, which can't change any more. So other trees, including other
+instances spawned from the same base, aren't affected.
 """
 
 class VariableNotFound(Exception): pass
 
+# the global environment of the SpillSys each thread is running
+running = threading.local()
+
+def runningEnvOver(env):
+    """ the global environment of the SpillSys this thread is
+    running, if it is (env) or is on top of it
+    @param env [Environment]
+    @return [Environment|None]
+    """
+    own = getattr(running, 'globalEnv', None)
+    e = own
+    while e is not None:
+        if e is env: return own
+        e = e.parent
+    return None
+
+class Cell(object):
+    """ holds the value of a global variable """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+class Stamp(object):
+    """ counts the changes to which variables the watched
+    environments hold
+    """
+    __slots__ = ('version', 'parent')
+
+    def __init__(self, parent=None):
+        """
+        @param parent [Stamp|None] the stamp of the frozen environment
+           the watched ones are on top of
+        """
+        self.version = 0
+        self.parent = parent
+
+class EnvironmentFrozen(Exception):
+    """ tried to define a variable in a frozen environment """
+
 class Environment:
+    frozen = False
+    macroTable = None  # global environments keep their macros in one
+    hooks = ()         # spillprof.GlobalHooks wrapping our functions
+    cells = None       # name -> Cell, for the variables asked for
+    watched = False    # do changes to our variables change stamp?
+    stamp = None       # shared by a tree of watched environments,
+                       # down to a frozen one
+    copied = None      # names set! has copied into us out of frozen parents
+    copying = 0        # how many environments have copied names; until
+                       # some have, frozen ones needn't look for copies
+    copyingLock = threading.Lock()
+
     def __init__(self, parent=None, initialValue=None):
         self.parent = parent
         if initialValue == None:
@@ -34,23 +121,189 @@ class Environment:
         """ return the value of (k)
         @param k [str]
         """
-        if self.data.has_key(k):
-            return self.data[k]
-        elif self.parent!=None:
-            return self.parent.get(k)
-        else:
-            raise VariableNotFound("Can't find variable '%s'" % (k,))
+        env = self
+        while env is not None:
+            data = env.data
+            if k in data:
+                if env.frozen and env.copying:
+                    own = env.ownCopy(k)
+                    if own is not None: return own.data[k]
+                return data[k]
+            env = env.parent
+        raise VariableNotFound("Can't find variable '%s'" % (k,))
     __getitem__ = get
 
+    def has(self, k):
+        """ is (k) defined in this environment or its parents? """
+        env = self
+        while env is not None:
+            if env.data.has_key(k): return True
+            env = env.parent
+        return False
+
     def define(self, k, value):
         """ create a new variable in this environment """
+        if self.frozen:
+            raise EnvironmentFrozen("can't define '%s' in a frozen "
+                                    "environment" % (k,))
+        for hook in self.hooks:
+            value = hook.wrap(k, value)
+        self.bind(k, value)
+        if self.macroTable is not None and k.startswith("macro~"):
+            self.macroTable.define(k[len("macro~"):], value)
+
+    def bind(self, k, value):
+        """ set (k) to (value) in this environment, without the checks
+        and hooks of define()
+        """
+        new = k not in self.data
         self.data[k] = value
+        if self.cells is not None:
+            cell = self.cells.get(k)
+            if cell is not None: cell.value = value
+        # only after (k) is there to be found again
+        if new and self.watched: self.stamp.version += 1
+
+    def unbind(self, k):
+        """ remove (k) from this environment """
+        del self.data[k]
+        if self.cells is not None: self.cells.pop(k, None)
+        if self.watched: self.stamp.version += 1
+
+    def watch(self):
+        """ make changes to which variables this environment and its
+        parents hold change the stamp, so that Cells got from us with
+        cell() are looked up again. Frozen parents are left alone:
+        nothing can change in them, and they're shared.
+        """
+        root = self
+        while root.parent is not None and not root.parent.frozen:
+            root = root.parent
+        if root.stamp is None:
+            base = None
+            if root.parent is not None: base = root.parent.stamp
+            root.stamp = Stamp(base)
+        env = self
+        while env is not root.parent:
+            env.watched = True
+            env.stamp = root.stamp
+            env = env.parent
+
+    def cell(self, k):
+        """ the Cell holding the value of (k), in the innermost
+        environment that includes it. It stays the right Cell until
+        stamp.version changes, if we're watched.
+        @return [Cell]
+        """
+        env = self
+        while env is not None:
+            if k in env.data:
+                if env.frozen and env.copying:
+                    env = env.ownCopy(k) or env
+                cells = env.cells
+                if cells is None: cells = env.cells = {}
+                cell = cells.get(k)
+                if cell is None: cell = cells[k] = Cell(env.data[k])
+                return cell
+            env = env.parent
+        raise VariableNotFound("Can't find variable '%s'" % (k,))
+
+    def getMacroTable(self):
+        """ the macro table of the global environment we're in
+        @return [MacroTable] or None
+        """
+        env = self
+        while env is not None:
+            if env.macroTable is not None: return env.macroTable
+            env = env.parent
+        return None
 
     def getEnvFor(self, var):
-        """ return the innermost environment that includes (var) """
-        if self.data.has_key(var): return self
-        if self.parent!=None: self.parent.getEnvFor(var)
-        raise VariableNotFound("Can't find variable '%s'" % (var,))
+        """ return the innermost environment that includes (var).
+        If that is a frozen environment, return the global environment
+        of the SpillSys this thread is running instead (or if there
+        isn't one, the global environment just inside it), so the
+        variable can be given a new value there.
+        """
+        env = self
+        inside = None
+        while env is not None:
+            if var in env.data: break
+            if env.macroTable is not None and not env.frozen:
+                inside = env
+            env = env.parent
+        else:
+            raise VariableNotFound("Can't find variable '%s'" % (var,))
+        if not env.frozen: return env
+        own = runningEnvOver(env)
+        if own is None or own.frozen: return inside or env
+        # recorded in (own), not (env), which other instances share
+        own.addCopy(var)
+        return own
+
+    def addCopy(self, k):
+        """ make our binding of (k) hide the one in a frozen parent,
+        even from code defined there, while our SpillSys is running
+        """
+        if self.copied and k in self.copied: return
+        with Environment.copyingLock:
+            if not self.copied:
+                self.copied = set()
+                Environment.copying += 1
+            self.copied.add(k)
+
+    def dropCopy(self, k):
+        """ undo addCopy(k) """
+        if not self.copied or k not in self.copied: return
+        with Environment.copyingLock:
+            self.copied.discard(k)
+            if not self.copied: Environment.copying -= 1
+
+    def ownCopy(self, k):
+        """ if (k), which is in this frozen environment, has been
+        given a new value with set! in the SpillSys this thread is
+        running, the environment holding that value
+        @return [Environment|None]
+        """
+        if not self.copiedByRunning(k): return None
+        own = runningEnvOver(self)
+        if own is not None and k in own.data: return own
+        return None
+
+    def copiedByRunning(self, k):
+        """ has the SpillSys this thread is running copied (k) out
+        of a frozen environment with set!? A quick check, which
+        doesn't look at whether that environment is one of ours.
+        """
+        own = getattr(running, 'globalEnv', None)
+        return (own is not None and own.copied is not None
+                and k in own.copied)
+
+    def isCopied(self, k):
+        """ does (k) live in a frozen environment, from which set!
+        has copied it? If so, its value depends on which SpillSys is
+        running.
+        """
+        env = self
+        while env is not None:
+            if k in env.data:
+                return env.frozen and env.copying \
+                       and env.ownCopy(k) is not None
+            env = env.parent
+        return False
+
+    def bindings(self):
+        """ all the variables visible in this environment
+        @return [dict]
+        """
+        if self.parent is None: return self.data.copy()
+        result = self.parent.bindings()
+        result.update(self.data)
+        return result
+
+    def freeze(self):
+        """ stop anything more being defined in this environment """
+        self.frozen = True
 
     def debugPrintVars(self, level=0):
         """ print our variables for debugging """
@@ -89,32 +342,267 @@ def spillTrue(v):
     Everything else is true.
     @return 'true'|'false'
     """
-    if v=='false' or v==0 or v==[]: return 'false'
-    if isa(v, spilltypes.LStr) and v.s=="":
-        return 'false'
-    return 'true'
+    if spillcomp.isTrue(v): return 'true'
+    return 'false'
 
 def spillEq(x, y):
     return spillTrue(x==y)
 
 def isPair(x):
     """ is (x) a list of length at least 1? """
-    return isa(x, tuple) and len(x)>0
+    return x.__class__ is spilltypes.Pair or (isa(x, tuple) and len(x)>0)
+
+def car(a):
+    if a.__class__ is spilltypes.Pair: return a.car
+    return a[0]
+
+def cdr(a):
+    if a.__class__ is spilltypes.Pair: return a.cdr
+    return spilltypes.toCons(a[1:])
+
+def cons(x, xs):
+    if isa(xs, tuple) and len(xs)>0:
+        xs = spilltypes.toCons(xs)
+    return spilltypes.Pair(x, xs)
 
 def append(*lists):
-    """ catenate lists """
-    result = []
-    for a in lists:
-        result = result + list(a)
-    return tuple(result)
+    """ catenate lists. The result shares the last list. """
+    if not lists: return ()
+    result = lists[-1]
+    if isa(result, tuple): result = spilltypes.toCons(result)
+    for a in reversed(lists[:-1]):
+        result = spilltypes.toCons(spilltypes.listItems(a), result)
+    return result
+
+#---------------------------------------------------------------------
+""" list library
+
+These are the list functions that used to be written in Spill, in
+<libcore.l>. They loop rather than recurse, and build their results
+a Pair at a time, so they work on lists of any length in linear time.
+"""
+
+Pair = spilltypes.Pair
+Vector = spilltypes.Vector
 
+def asCons(a):
+    """ (a) as a Pair list, converting it if it's a tuple """
+    if isa(a, tuple) and len(a)>0: return spilltypes.toCons(a)
+    return a
+
+def spillList(*args):
+    """ (list x y ...) => (x y ...) """
+    return spilltypes.toCons(args)
+
+def spillMap(f, a):
+    """ (map f a) => a list of (f x) for each x in a. If a is a
+    vector, so is the result.
+    """
+    if a.__class__ is Vector: return spilltypes.toVector(map(f, a))
+    a = asCons(a)
+    head = tail = Pair(None, ())
+    while a.__class__ is Pair:
+        cell = Pair(f(a.car), ())
+        tail.cdr = cell
+        tail = cell
+        a = a.cdr
+    return head.cdr
+
+def spillFilter(f, a):
+    """ (filter f a) => those elements x of a for which (f x) is true """
+    isTrue = spillcomp.isTrue
+    if a.__class__ is Vector:
+        return spilltypes.toVector([x for x in a if isTrue(f(x))])
+    a = asCons(a)
+    head = tail = Pair(None, ())
+    while a.__class__ is Pair:
+        if isTrue(f(a.car)):
+            cell = Pair(a.car, ())
+            tail.cdr = cell
+            tail = cell
+        a = a.cdr
+    return head.cdr
+
+def fromto(f, t):
+    """ (fromto f t) => (f f+1 ... t) """
+    r = ()
+    while t >= f:
+        r = Pair(t, r)
+        t -= 1
+    return r
+
+def spillReduce(f, init, a):
+    """ (reduce f init (x1 x2 ... xn)) => (f ... (f (f init x1) x2) ... xn)
+    """
+    acc = init
+    if a.__class__ is Vector:
+        for x in a: acc = f(acc, x)
+        return acc
+    a = asCons(a)
+    while a.__class__ is Pair:
+        acc = f(acc, a.car)
+        a = a.cdr
+    return acc
+
+def length(a):
+    """ (length a) => the number of elements in a """
+    if a.__class__ is not Pair: return len(a)
+    n = 0
+    while a.__class__ is Pair:
+        n += 1
+        a = a.cdr
+    return n
+
+def reverse(a):
+    """ (reverse a) => the elements of a in reverse order """
+    a = asCons(a)
+    r = ()
+    while a.__class__ is Pair:
+        r = Pair(a.car, r)
+        a = a.cdr
+    return r
+
+def nth(n, a):
+    """ (nth n a) => element n of a, counting from 0 """
+    if a.__class__ is not Pair: return a[n]
+    if n < 0: raise IndexError("nth: negative index %d" % (n,))
+    for i in xrange(n):
+        a = a.cdr
+        if a.__class__ is not Pair:
+            raise IndexError("nth: index %d out of range" % (n,))
+    return a.car
+
+def pmap(f, a):
+    """ (pmap f a) => the same as (map f a), computed by worker
+    processes (see spillpar.py)
+    """
+    return spillpar.pmap(f, a, spillMap, LIBRARY)
+
+class LessThan:
+    """ a sort key that compares values using a Spill function """
+    def __init__(self, value, lessFun):
+        self.value = value
+        self.lessFun = lessFun
+    def __lt__(self, other):
+        return spillcomp.isTrue(self.lessFun(self.value, other.value))
+
+def spillSort(a, lessFun=None):
+    """ (sort a) => the elements of a in ascending order
+    (sort a less?) => the same, where (less? x y) says whether x
+       comes before y
+    The sort is stable.
+    """
+    items = spilltypes.listItems(a)
+    if lessFun is None:
+        items.sort()
+    else:
+        items.sort(key=lambda x: LessThan(x, lessFun))
+    return spilltypes.toCons(items)
+
+#---------------------------------------------------------------------
+""" vectors
+
+Arithmetic on vectors is done by the usual +, -, * and / primitives,
+which work elementwise (see spilltypes.Vector).
+"""
+
+def requireVector(name, v):
+    if v.__class__ is not Vector:
+        raise TypeError("%s: %s isn't a vector" % (name,
+                                                   spilltypes.show(v)))
+    return v
+
+def vectorFromArgs(*args):
+    """ (vector 1 2 3) => #(1 2 3) """
+    return spilltypes.toVector(args)
+
+def vectorToList(v):
+    """ (vector->list v) => the elements of v as a list """
+    return spilltypes.toCons(requireVector('vector->list', v).tolist())
+
+def vectorCompare(name, op):
+    """ an elementwise comparison primitive, e.g. (v< a b) => a
+    vector with 1 where a<b, else 0
+    """
+    def compare(a, b):
+        return requireVector(name, a).compare(b, op)
+    compare.__name__ = name
+    return compare
+
+def vsum(v):
+    """ (vsum v) => the sum of the elements of v """
+    return requireVector('vsum', v).sum()
+
+def vmin(v):
+    return requireVector('vmin', v).min()
+
+def vmax(v):
+    return requireVector('vmax', v).max()
+
+def dot(a, b):
+    """ (dot a b) => the dot product of vectors a and b """
+    return requireVector('dot', a).dot(b)
+
+def vslice(v, start, end):
+    """ (vslice v start end) => elements start to end-1 of v """
+    return requireVector('vslice', v).slice(start, end)
+
+#---------------------------------------------------------------------
+""" maps
+
+A map (see spilltypes.PMap) is immutable: assoc and dissoc return a
+new map, leaving the one they're given as it was.
+
+(hash-map k1 v1 k2 v2 ...) => a map from each k to its v
+(get m k [default]) => the value of k in m, or default (or ()) if
+   it isn't there
+(assoc m k v ...) => m, with each k bound to its v
+(dissoc m k ...) => m, without each k
+(has-key? m k), (keys m), (vals m), (count m)
+"""
+
+def requireMap(name, m):
+    if m.__class__ is not spilltypes.PMap:
+        raise TypeError("%s: %s isn't a map" % (name, spilltypes.show(m)))
+    return m
+
+def keyValues(name, args):
+    """ pair up keys and values
+    @param args [tuple] k1 v1 k2 v2 ...
+    @return [list of (key, value)]
+    """
+    if len(args)%2!=0:
+        raise TypeError("%s: a key without a value" % (name,))
+    return zip(args[0::2], args[1::2])
+
+def hashMap(*args):
+    return spilltypes.toMap(keyValues('hash-map', args))
+
+def mapGet(m, key, default=spilltypes.NIL):
+    return requireMap('get', m).get(key, default)
+
+def assoc(m, *args):
+    m = requireMap('assoc', m)
+    for key, value in keyValues('assoc', args): m = m.assoc(key, value)
+    return m
+
+def dissoc(m, *keys):
+    m = requireMap('dissoc', m)
+    for key in keys: m = m.dissoc(key)
+    return m
+
+def hasKey(m, key):
+    return spillTrue(key in requireMap('has-key?', m))
+
+def mapKeys(m):
+    return spilltypes.toCons(requireMap('keys', m).keys())
+
+def mapValues(m):
+    return spilltypes.toCons(requireMap('vals', m).values())
+
+def mapCount(m):
+    return len(requireMap('count', m))
 
-def pr(*args):
-    """ print the arguments to stdout """
-    #print "pr(args=%r)" % (args,)
-    outStr = "".join([spilltypes.showStr(arg) for arg in args])
-    sys.stdout.write(outStr)
-    return spilltypes.LStr(outStr)
 
 import operator
 primitives = {
@@ -122,12 +610,46 @@ primitives = {
     '-': operator.sub,
     '*': operator.mul,
     '/': operator.div,
-    'car': lambda a: a[0],
-    'cdr': lambda a: a[1:],
-    'cons': lambda x, xs: tuple([x]+list(xs)),
-    'null?': lambda a: a==(),
+    'car': car,
+    'cdr': cdr,
+    'cons': cons,
+    'null?': spilltypes.isNull,
     'pair?': isPair,
     'append': append,
+    'list': spillList,
+    'map': spillMap,
+    'pmap': pmap,
+    'filter': spillFilter,
+    'fromto': fromto,
+    'reduce': spillReduce,
+    'length': length,
+    'reverse': reverse,
+    'nth': nth,
+    'sort': spillSort,
+    'vector': vectorFromArgs,
+    'list->vector': spilltypes.toVector,
+    'vector->list': vectorToList,
+    'vector?': spilltypes.isVector,
+    'vrange': spilltypes.vectorRange,
+    'v<': vectorCompare('v<', operator.lt),
+    'v>': vectorCompare('v>', operator.gt),
+    'v<=': vectorCompare('v<=', operator.le),
+    'v>=': vectorCompare('v>=', operator.ge),
+    'v==': vectorCompare('v==', operator.eq),
+    'vsum': vsum,
+    'vmin': vmin,
+    'vmax': vmax,
+    'dot': dot,
+    'vslice': vslice,
+    'hash-map': hashMap,
+    'hash-map?': spilltypes.isMap,
+    'get': mapGet,
+    'assoc': assoc,
+    'dissoc': dissoc,
+    'has-key?': hasKey,
+    'keys': mapKeys,
+    'vals': mapValues,
+    'count': mapCount,
     '?': spillTrue,
     'eq?': lambda x,y: x==y,
     '==': lambda x,y: x==y,
@@ -138,23 +660,59 @@ primitives = {
     'eq?': spillEq,
     '==': spillEq,
     '!=': lambda x,y: spillTrue(not(x==y)),
-    'pr': pr
 }
+primitives.update(spillport.primitives)
+primitives.update(spillmemo.primitives)
+
+# the primitives with no side effects, which the optimiser can call
+# when their arguments are constants (see spillopt.py)
+PURE_PRIMITIVES = ['+', '-', '*', '/', '<', '>', '<=', '>=', 'eq?', '==',
+    '!=', '?', 'car', 'cdr', 'cons', 'list', 'append', 'length',
+    'reverse', 'nth', 'null?', 'pair?']
+
+def purePrimitives():
+    """ @return [dict] name -> function, for PURE_PRIMITIVES """
+    return dict((name, primitives[name]) for name in PURE_PRIMITIVES)
 
 def addPrimitivesToEnv(env):
     for k,v in primitives.items():
         p = Primitive(v, k)
-        env.data[k] = p
+        env.bind(k, p)
 
 #---------------------------------------------------------------------
 """ closures
+
+A closure's parameters are laid out once, in a spillcomp.Scope shared
+by all the closures with the same parameter list, and each call gets a
+spillcomp.Frame holding the arguments in that order, as compiled
+closures do. Variables are still looked up by name, through the
+Scope's slotIndex.
 """
 
+Frame = spillcomp.Frame
+
+# parameter list -> spillcomp.Scope
+paramScopes = {}
+
+def paramScope(params):
+    """ the layout of the frames of closures taking (params)
+    @param params [tuple of str]
+    @return [spillcomp.Scope]
+    """
+    scope = paramScopes.get(params)
+    if scope is None:
+        # variables (def)ined in the body go in the frame's extra dict
+        scope = paramScopes[params] = spillcomp.Scope(params, None, None)
+    return scope
+
 class Closure:
+    name = None  # the variable it was first (def)ined as
+
     def __init__(self, params, body, env):
         self.params = params
         self.body = body
         self.env = env
+        self.scope = paramScope(params)
 
     def __repr__(self):
         return "<closure %s %s>" %\
@@ -163,16 +721,22 @@ class Closure:
 
     def __call__(self, *args):
         if debug: print "calling %s\n        args=%r" % (self, args)
-        paramBindings = {}
-        for ix in range(len(args)):
-            if self.params[ix]=='*':
-                paramBindings[self.params[ix+1]] = tuple(args[ix:])
-                #print "bindings=%r" % (paramBindings,)
-                break
-            else:
-                paramBindings[self.params[ix]] = args[ix]
-        newEnv = Environment(self.env, paramBindings)
-        return seval(self.body, newEnv)
+        return seval(self.body, self.bindArgs(args))
+
+    def bindArgs(self, args):
+        """ make the environment for a call of this closure
+        @param args [tuple|list] the arguments
+        @return [spillcomp.Frame]
+        """
+        scope = self.scope
+        if len(args)==scope.nfixed and scope.rest is None:
+            frame = Frame(args)
+        else:
+            frame = Frame(scope.bindArgs(args))
+        frame.parent = self.env
+        frame.scope = scope
+        frame.extra = None
+        return frame
 
 
 #---------------------------------------------------------------------
@@ -187,42 +751,67 @@ Special forms are:
        c2 ex2
        c3 ex3) = evaluates conditions c[n] until one is true,
                  then evaluates the corresponding ex[n].
+
+Expressions in tail position -- the chosen branch of an if, the last
+form of a begin, the body of a closure being called -- are evaluated
+by going round seval()'s loop again rather than by a recursive call,
+so tail-recursive Spill functions run in constant Python stack.
 """
 
 #@evalargs
 def seval(x, env):
     #if debug: print "seval x=%r" % (x,)
 
-    if type(x)==str:
-        return env[x]
-    if not isinstance(x, tuple):
-        return x
+    while True:
+        if type(x)==str:
+            return env.get(x)
+        if not isinstance(x, tuple):
+            return x
 
-    #>>> it's a list, special forms
-    h = x[0]
-    if h=='quote': return x[1]
-    if h=='if': return evalIf(x, env)
-    if h=='def':
-        var = x[1]; value = seval(x[2], env)
-        env.define(var, value)
-        return value
-    if h=='set!':
-        var = x[1]; value = seval(x[2], env)
-        env.getEnvFor(var).define(var, value)
-        return value
-    if h=='begin':
-        for ex in x[1:]:
-            value = seval(ex, env)
-        return value
-    if h=='fn':
-        args = x[1]; body = x[2]
-        return Closure(args, body, env)
-    if h=='eval':
-        return seval(seval(x[1], env), env)
+        #>>> it's a list, special forms
+        h = x[0]
+        if h=='quote':
+            x = x[1]
+            if isa(x, tuple) and len(x)>0:
+                # a list in code rather than data
+                return spilltypes.toConsDeep(x)
+            return x
+        if h=='if':
+            isExp, r = selectIfBranch(x, env)
+            if not isExp: return r
+            x = r
+            continue
+        if h=='def':
+            var = x[1]; value = seval(x[2], env)
+            if value.__class__ is Closure and value.name is None:
+                value.name = var
+            env.define(var, value)
+            return value
+        if h=='set!':
+            var = x[1]; value = seval(x[2], env)
+            env.getEnvFor(var).define(var, value)
+            return value
+        if h=='begin':
+            for ex in x[1:-1]:
+                seval(ex, env)
+            x = x[-1]
+            continue
+        if h=='fn':
+            args = x[1]; body = x[2]
+            return Closure(args, body, env)
+        if h=='eval':
+            x = expandForEval(seval(x[1], env), env)
+            continue
 
-    #>>> it's a list, evaluate arguments and run it
-    evaled = [seval(arg, env) for arg in x]
-    return evaled[0](*evaled[1:])
+        #>>> it's a list, evaluate arguments and run it
+        evaled = [seval(arg, env) for arg in x]
+        f = evaled[0]
+        if f.__class__ is Closure:
+            # a tail call: carry on in the closure's body
+            env = f.bindArgs(evaled[1:])
+            x = f.body
+            continue
+        return f(*evaled[1:])
 
 def evalIf(x, env):
     """ evaluate an if, which is of the form:
@@ -233,30 +822,158 @@ def evalIf(x, env):
     An alternate form is without the ex_n, in which case
     the result of con_n is returned.
     """
+    isExp, r = selectIfBranch(x, env)
+    if isExp: return seval(r, env)
+    return r
+
+def selectIfBranch(x, env):
+    """ evaluate the conditions of an if (see evalIf()) until one
+    is true.
+    @return [bool, s-exp] (True, ex) if the if's value is that of
+       expression ex, which is yet to be evaluated, or
+       (False, value) if it is the value of the last condition.
+    """
     if debug: print "evalCond %s" % (spilltypes.show(x),)
     current = 1
     while True:
         lastEval = seval(x[current], env)
         if spillTrue(lastEval)=='true':
             if debug: print "evalCond() current=%r" % current
-            return seval(x[current+1], env)
+            return True, x[current+1]
         current += 2
         if current+1 == len(x):
-            return seval(x[current], env)
+            return True, x[current]
         if current == len(x):
-            return lastEval
+            return False, lastEval
     #//while
 
 #---------------------------------------------------------------------
 # big system object
 
+ENGINES = ('seval', 'compile')
+
+# the standard library, loaded into every SpillSys
+LIBRARY = "libcore.l"
+
 class SpillSys:
-    def __init__(self):
-        self.globalEnv = Environment()
-        addPrimitivesToEnv(self.globalEnv)
-        self.parser = parser.SpillParser()
+    def __init__(self, engine='seval', library=LIBRARY, parser=None,
+                 cache=None, base=None, optimise=True):
+        """
+        @param engine [str] how to evaluate expressions: 'seval' walks
+           the expression tree each time (the reference engine);
+           'compile' compiles each form into Python closures first
+        @param library [str|None] library file to load at startup
+        @param parser what to parse source code with: anything with
+           a parse(tokens, callback) method. Defaults to a
+           reader.Reader; parser.SpillParser() also works.
+        @param cache [str|spillcache.FormCache|None] where loadFile()
+           caches expanded forms: a directory, or a FormCache (which
+           can be shared between SpillSys instances). Defaults to the
+           directory in $SPILL_CACHE_DIR, if that is set.
+        @param base [Environment|None] a frozen global environment,
+           already containing the primitives and library, to put our
+           own global environment on top of. Normally set by spawn().
+        @param optimise [bool] optimise each form after expanding its
+           macros (see spillopt.py)
+        """
+        if engine not in ENGINES:
+            raise ValueError("unknown engine %r" % (engine,))
+        self.engine = engine
+        if base is None:
+            self.globalEnv = Environment()
+            self.globalEnv.macroTable = MacroTable()
+            addPrimitivesToEnv(self.globalEnv)
+        else:
+            self.globalEnv = Environment(base)
+            self.globalEnv.macroTable = MacroTable(base.macroTable)
+            library = None
+        self.macroTable = self.globalEnv.macroTable
+        if optimise:
+            self.optimiser = spillopt.Optimiser(self.globalEnv,
+                                                purePrimitives())
+        else:
+            self.optimiser = None
+        self.profiler = None
+        self.tracer = None
+        if engine=='compile':
+            self.compiler = spillcomp.Compiler(self.globalEnv)
+        else:
+            self.compiler = None
+        if parser is None: parser = reader.Reader()
+        self.parser = parser
+        if cache is None: cache = os.environ.get("SPILL_CACHE_DIR")
+        if isinstance(cache, str):
+            cache = spillcache.FormCache(cache)
+        self.cache = cache
         self.lastResult = None
-        self.loadFile("libcore.l")
+        if library: self.loadFile(library)
+
+    def startProfiling(self):
+        """ start recording calls of global functions (see
+        spillprof.py). If we've been profiled before, the new
+        calls are added to what was recorded then.
+        @return [spillprof.Profiler]
+        """
+        if self.profiler is None:
+            self.profiler = spillprof.Profiler(self.globalEnv)
+        self.profiler.start()
+        return self.profiler
+
+    def startTracing(self, size=spilltrace.DEFAULT_SIZE):
+        """ start recording events (see spilltrace.py). If we've been
+        traced before, the new events are added to what was recorded
+        then.
+        @param size [int] how many events to keep, for a new tracer
+        @return [spilltrace.Tracer]
+        """
+        if self.tracer is None:
+            self.tracer = spilltrace.Tracer(self.globalEnv, size)
+        self.tracer.start()
+        self.macroTable.tracer = self.tracer
+        return self.tracer
+
+    def stopTracing(self):
+        """ stop recording events
+        @return [spilltrace.Tracer] what was recorded
+        """
+        if self.tracer:
+            self.tracer.stop()
+            self.macroTable.tracer = None
+        return self.tracer
+
+    def stopProfiling(self):
+        """ stop recording calls
+        @return [spillprof.Profiler] what was recorded
+        """
+        if self.profiler: self.profiler.stop()
+        return self.profiler
+
+    def freeze(self):
+        """ freeze our global environment, so that it can be shared
+        by the instances spawn() creates.
+        @return [SpillSys] self
+        """
+        self.globalEnv.freeze()
+        return self
+
+    def spawn(self):
+        """ create a new SpillSys sharing our (frozen) global
+        environment, instead of loading the primitives and library
+        again. Its own definitions go in a global environment of its
+        own, so don't affect us or any other spawned instance:
+
+           base = SpillSys().freeze()
+           si = base.spawn()
+
+        @return [SpillSys]
+        """
+        if not self.globalEnv.frozen:
+            raise EnvironmentFrozen("freeze() a SpillSys before "
+                                    "spawning from it")
+        return SpillSys(engine=self.engine, library=None,
+                        parser=self.parser, cache=self.cache,
+                        base=self.globalEnv,
+                        optimise=self.optimiser is not None)
 
     #@printargs
     def readEval(self, evalStr):
@@ -265,23 +982,120 @@ class SpillSys:
            and run.
         @return [s-exp] the result
         """
-        tokens = lexer.Lexer().tokenize(evalStr)
-        self.parser.parse(tokens, self.evalResultFromParsing)
+        tokens = lexer.scan(evalStr)
+        try:
+            self.parser.parse(tokens, self.evalResultFromParsing)
+        finally:
+            spillport.flushOutput()
         return self.lastResult
 
     def eval(self, ex):
         """ evaluate an s-expression, using the global environment """
-        return seval(ex, self.globalEnv)
+        outer = getattr(running, 'globalEnv', None)
+        running.globalEnv = self.globalEnv
+        try:
+            if self.compiler:
+                return self.compiler.compile(ex)(self.globalEnv)
+            return seval(ex, self.globalEnv)
+        finally:
+            running.globalEnv = outer
 
     #@printargs
     def evalResultFromParsing(self, result):
         expanded = self.macroExpand(result)
-        self.lastResult = seval(expanded, self.globalEnv)
+        self.lastResult = self.eval(self.optimise(expanded))
 
     def loadFile(self, filename):
-        if debug: print "loading <%s>" % (filename,)
-        fileContents = butil.readFile(filename)
-        self.readEval(fileContents)
+        """ load and run a source file. If it has been compiled with
+        "spill compile" and the compiled module is up to date, run
+        that instead; otherwise if its expanded forms are in the form
+        cache, run those.
+        """
+        for result in self.iterLoadFile(filename): pass
+
+    def iterLoadFile(self, filename):
+        """ load and run a source file a top-level form at a time.
+        Each form is run as soon as it has been read, and only the
+        form being read is held in memory.
+        @return [generator] yielding the result of each form
+        """
+        tracer = self.tracer
+        if tracer and tracer.running:
+            tracer.record('B', spilltrace.LOAD, filename)
+        try:
+            if debug: print "loading <%s>" % (filename,)
+            forms = spillaot.loadCompiled(filename, self.macroState())
+            if forms is not None:
+                for ex in forms:
+                    self.lastResult = self.eval(self.optimise(ex))
+                    yield self.lastResult
+                return
+            writer = None
+            if self.cache:
+                macroState = self.macroState()
+                key = self.cache.key(filename, macroState)
+                forms = self.cache.load(key)
+                if forms is not None:
+                    for ex in forms:
+                        self.lastResult = self.eval(self.optimise(ex))
+                        yield self.lastResult
+                    return
+                writer = self.cache.writer(key)
+            f = open(filename)
+            try:
+                for form in reader.iterForms(f):
+                    expanded = self.macroExpand(form)
+                    # the cache holds forms as they were before being
+                    # optimised, as whether a call can be folded
+                    # depends on the global environment
+                    if writer: writer.add(expanded)
+                    self.lastResult = self.eval(self.optimise(expanded))
+                    yield self.lastResult
+                # don't cache it if the file changed while we were reading it
+                if writer and self.cache.key(filename, macroState)==key:
+                    writer.commit()
+            finally:
+                f.close()
+                if writer: writer.close()
+        finally:
+            spillport.flushOutput()
+            if tracer and tracer.running:
+                tracer.record('E', spilltrace.LOAD, filename)
+
+    def compileFile(self, filename):
+        """ load and run a source file, writing its macro-expanded
+        forms into a Python module (see spillaot.py)
+        @return [str] the pathname of the module written
+        """
+        key = spillcache.formsKey(filename, self.macroState())
+        forms = []
+        f = open(filename)
+        try:
+            for form in reader.iterForms(f):
+                expanded = self.macroExpand(form)
+                forms.append(expanded)
+                self.lastResult = self.eval(self.optimise(expanded))
+        finally:
+            f.close()
+        return spillaot.writeModule(filename, forms, key)
+
+    def macroNames(self):
+        """ return the names of the macros currently defined
+        @return [list of str]
+        """
+        return self.macroTable.macros.keys()
+
+    def macroState(self):
+        """ the macros currently defined, and their definitions
+        @return [list of (str,str)]
+        """
+        return [(name, repr(f))
+                for name, f in self.macroTable.macros.items()]
+
+    def optimise(self, ex):
+        """ optimise a macro-expanded form, if the optimiser is on """
+        if self.optimiser is None: return ex
+        return self.optimiser.optimise(ex)
 
     def macroExpand(self, ex):
         ex2 = self.macroExpand2(ex)
@@ -293,50 +1107,306 @@ class SpillSys:
 
     def macroExpand2(self, ex):
         """ perform macro expansion """
-        #print "macroExpand2() ex=%r" % (ex,)
-        if not isinstance(ex, tuple) or len(ex)==0: return ex
-        #print "macroExpand2()"
-        h = ex[0]
-        #print "macroExpand2() h=%r" % (h,)
-        if h == 'quote': return ex
-        elif h == 'quasiquote': return expandQuasi(ex[1])
-        elif self.isMacro(h):
-            #print "expanding ex=%r" % (ex,)
-            expanded = self.expandAMacro(h, ex)
-            #print "macroExpand2() expanded=%r" % (expanded,)
-            return self.macroExpand2(expanded)
+        return self.macroTable.expand(ex)
+
+    def isMacro(self, sym):
+        return self.macroTable.get(sym) is not None
+
+#---------------------------------------------------------------------
+# macros
+
+class MacroTable:
+    """ the macros of a global environment, by name, and an expander
+    that uses them.
+
+    The table is kept up to date by Environment.define(), which is
+    what (def macro~foo ...) calls. Expanding a form returns the form
+    itself if nothing in it needed expanding, so code without macros
+    isn't copied. The expansion of each macro call is remembered, so
+    identical calls are only expanded once; this assumes macros are
+    pure functions of their arguments. The remembered expansions are
+    forgotten whenever a macro is (re)defined.
+    """
+
+    # forget remembered expansions when there are more than this many
+    MAX_EXPANSIONS = 10000
+
+    def __init__(self, parent=None):
+        """
+        @param parent [MacroTable|None] the table of a frozen base
+           environment, whose macros we start with
+        """
+        if parent is None:
+            self.macros = {}
         else:
-            return tuple([self.macroExpand2(e) for e in ex])
+            self.macros = parent.macros.copy()
+        self.expansions = {}
+        self.hits = 0
+        self.tracer = None
 
+    def define(self, name, macroFunction):
+        self.macros[name] = macroFunction
+        self.expansions.clear()
 
-    def isMacro(self, sym):
-        return self.globalEnv.data.has_key("macro~" + sym)
+    def get(self, name):
+        """ the macro function called (name), or None """
+        if name.__class__ is not str: return None
+        return self.macros.get(name)
+
+    def expand(self, ex):
+        """ macro-expand an s-expression. Forms are expanded innermost
+        first using an explicit stack, rather than by recursion, so
+        they can be nested any depth.
+        @param ex [s-exp]
+        @return [s-exp] (ex) itself, if nothing in it was expanded
+        """
+        stack = []   # ExpandFrames for the forms being expanded
+        value = self.expandForm(ex, stack)
+        while stack:
+            frame = stack[-1]
+            if value is not PENDING: frame.add(value)
+            e = frame.nextList()
+            if e is not None:
+                value = self.expandForm(e, stack)
+            else:
+                stack.pop()
+                value = frame.result()
+                self.remember(frame.calls, value)
+        return value
+
+    def expandForm(self, x, stack):
+        """ start expanding a form
+        @param stack [list of ExpandFrame]
+        @return [s-exp] what (x) expands to, or PENDING if its items
+           have to be expanded first, in which case an ExpandFrame
+           for it has been pushed on (stack)
+        """
+        calls = []   # the macro calls (x) is the expansion of
+        while True:
+            cls = x.__class__
+            if cls is spilltypes.Pair:
+                x = spilltypes.toCode(x)
+                continue
+            if cls is not tuple or len(x)==0: break
+            h = x[0]
+            if h.__class__ is str:
+                if h == 'quote':
+                    # quoted lists are data, so make them into Pairs
+                    if len(x)>1 and isa(x[1], tuple) and len(x[1])>0:
+                        x = ('quote', spilltypes.toConsDeep(x[1]))
+                    break
+                elif h == 'quasiquote':
+                    x = expandQuasi(x[1])
+                    continue
+                macroFunction = self.macros.get(h)
+                if macroFunction is not None:
+                    result = self.remembered(x)
+                    if result is not None:
+                        x = result
+                        break
+                    calls.append(x)
+                    x = self.callMacro(macroFunction, x)
+                    continue
+            stack.append(ExpandFrame(x, calls))
+            return PENDING
+        #//while
+        self.remember(calls, x)
+        return x
 
-    def expandAMacro(self, h, ex):
-        macroFunction = self.globalEnv["macro~" + h]
-        return macroFunction(*ex[1:])
+    def callMacro(self, macroFunction, ex):
+        """ call a macro
+        @param ex [tuple] the call
+        @return [s-exp] its result, as code
+        """
+        tracer = self.tracer
+        if tracer is None:
+            return spilltypes.toCode(macroFunction(*ex[1:]))
+        tracer.record('B', spilltrace.MACRO, ex[0])
+        try:
+            return spilltypes.toCode(macroFunction(*ex[1:]))
+        finally:
+            tracer.record('E', spilltrace.MACRO, ex[0])
+
+    def remembered(self, call):
+        """ the expansion of a macro call, if we remember it
+        @return [s-exp|None]
+        """
+        try:
+            result = self.expansions.get(call)
+        except TypeError:
+            # something in (call) can't be compared
+            return None
+        if result is not None: self.hits += 1
+        return result
+
+    def remember(self, calls, result):
+        """ remember that each of some macro calls expands to (result) """
+        for call in calls:
+            if len(self.expansions) >= self.MAX_EXPANSIONS:
+                self.expansions.clear()
+            try:
+                self.expansions[call] = result
+            except TypeError:
+                pass
+
+# what MacroTable.expandForm() returns for a form it hasn't finished
+PENDING = object()
+
+class ExpandFrame(object):
+    """ a form whose items MacroTable.expand() is expanding """
+    __slots__ = ('form', 'items', 'i', 'calls')
+
+    def __init__(self, form, calls):
+        self.form = form
+        self.items = None    # the expanded items, once one has changed
+        self.i = -1          # which item is being expanded
+        self.calls = calls   # the macro calls the form is the expansion of
+
+    def add(self, value):
+        """ item (i) has expanded to (value) """
+        if self.items is None:
+            if value is self.form[self.i]: return
+            # copy the form, from the first change on
+            self.items = list(self.form[:self.i])
+        self.items.append(value)
+
+    def nextList(self):
+        """ move on to the next item that is a list
+        @return [tuple|Pair] or None if there are no more
+        """
+        form = self.form
+        i = self.i + 1
+        while i < len(form):
+            e = form[i]
+            if e.__class__ is tuple or e.__class__ is spilltypes.Pair:
+                self.i = i
+                return e
+            if self.items is not None: self.items.append(e)
+            i += 1
+        self.i = i
+        return None
+
+    def result(self):
+        if self.items is None: return self.form
+        return tuple(self.items)
+
+def expandForEval(ex, env):
+    """ turn a value passed to (eval ...) into code, expanding any
+    macros in it
+    @param ex [s-exp]
+    @param env [Environment] where it will be evaluated
+    """
+    macroTable = env.getMacroTable()
+    if macroTable is None: return spilltypes.toCode(ex)
+    return macroTable.expand(ex)
 
 def expandQuasi(ex):
     """ expand an expression in quasi-quotes
     `  = quasi                  `x => 'x
     ,  = unquote                `,x => x
-    '@ = unquotesplicing (uqs)  `(x ,@y z) =>
+    ,@ = unquotesplicing        `(x ,@y z) => (append (list 'x) y '(z))
 
+    Lists are expanded innermost first using an explicit stack, so
+    quasi-quoted data can be nested any depth, and a list takes time
+    in proportion to its length.
     """
     if not isPair(ex):
         return ('quote', ex)
-    h = ex[0]
-    require(ex, h!='unquotesplicing', "can't splice here")
-    if h == 'unquote':
+    ex = tuple(spilltypes.listItems(ex))
+    require(ex, ex[0]!='unquotesplicing', "can't splice here")
+    if ex[0] == 'unquote':
         require(ex, len(ex)==2)
         return ex[1]
-    elif isPair(h) and h[0]=='unquotesplicing':
-        require(h, len(h)==2)
-        return ('append', h[1], expandQuasi(ex[1:]))
+    # for each list being expanded: [its items, and for each item
+    # expanded so far, (whether it has unquotes, whether it's spliced,
+    # its expansion)]. Items without unquotes are left as they are.
+    stack = [[ex, []]]
+    while True:
+        items, done = stack[-1]
+        if len(done) < len(items):
+            e = items[len(done)]
+            if not isPair(e):
+                done.append((False, False, e))
+                continue
+            e = tuple(spilltypes.listItems(e))
+            if e[0] == 'unquote':
+                require(e, len(e)==2)
+                done.append((True, False, e[1]))
+            elif e[0] == 'unquotesplicing':
+                require(e, len(e)==2)
+                done.append((True, True, e[1]))
+            else:
+                stack.append([e, []])
+            continue
+        stack.pop()
+        result = quasiList(items, done)
+        if not stack:
+            if result is None: return ('quote', spilltypes.toConsDeep(ex))
+            return result
+        if result is None:
+            stack[-1][1].append((False, False, items))
+        else:
+            stack[-1][1].append((True, False, result))
+    #//while
+
+def quasiList(items, done):
+    """ the expansion of a quasi-quoted list
+    @param items [tuple] the list
+    @param done [list] what each of its items expands to (see
+       expandQuasi())
+    @return [s-exp] or None if there are no unquotes in it
+    """
+    for hasUnquote, spliced, x in done:
+        if hasUnquote: break
     else:
-        return ('cons', expandQuasi(h), expandQuasi(ex[1:]))
+        return None
+    n = len(items)
+    # does each tail of the list have unquotes in it? One that starts
+    # with unquote does: `(a . ,b) is read as (a unquote b)
+    tailHas = [False] * (n+1)
+    for i in xrange(n-1, 0, -1):
+        e = items[i]
+        tailHas[i] = done[i][0] or tailHas[i+1] or (e.__class__ is str
+            and (e=='unquote' or e=='unquotesplicing'))
+    tail = ('quote', ())
+    parts = []
+    for i in xrange(n):
+        e = items[i]
+        if i>0:
+            if not tailHas[i]:
+                tail = ('quote', spilltypes.toConsDeep(items[i:]))
+                break
+            if e.__class__ is str:
+                # only slice the list for the error message, or
+                # checking each item would take time in its length
+                if e=='unquotesplicing':
+                    require(items[i:], False, "can't splice here")
+                if e == 'unquote':
+                    if n-i!=2: require(items[i:], False)
+                    tail = items[i+1]
+                    break
+        parts.append(done[i])
+    #//for
+    # (append (list a 'b ...) spliced ... tail), which doesn't nest
+    # however long the list is
+    args = []
+    run = None   # a (list ...) of items that aren't spliced
+    for hasUnquote, spliced, x in parts:
+        if spliced:
+            if run: args.append(tuple(run))
+            run = None
+            args.append(x)
+            continue
+        if not hasUnquote: x = ('quote', spilltypes.toConsDeep(x))
+        if run is None: run = ['list']
+        run.append(x)
+    #//for
+    if run:
+        if not args and tail==('quote', ()): return tuple(run)
+        args.append(tuple(run))
+    return ('append',) + tuple(args) + (tail,)
 
-def require(self, predicate, message=""):
+def require(x, predicate, message=""):
     "Signal a syntax error if predicate is false."
     if not predicate:
         raise SyntaxError(spilltypes.show(x) + ': ' + message)
@@ -345,11 +1415,35 @@ def require(self, predicate, message=""):
 # if called as __main__
 
 
+def compileMain(filenames):
+    """ spill compile file.l ...
+    Compile each file into a Python module. The files are run in
+    order, after the library, as they would be by "spill file.l ..."
+    """
+    si = SpillSys(library=None)
+    libraryLoaded = False
+    for filename in filenames:
+        if filename==LIBRARY:
+            path = si.compileFile(filename)
+            libraryLoaded = True
+        else:
+            if not libraryLoaded:
+                si.loadFile(LIBRARY)
+                libraryLoaded = True
+            path = si.compileFile(filename)
+        print "compiled <%s> to <%s>" % (filename, path)
+
 if __name__=='__main__':
     #print "Welcome to Spill, args=%r" % (sys.argv,)
-    si = SpillSys()
-    for arg in sys.argv[1:]:
-        si.loadFile(arg)
+    if sys.argv[1:2]==['compile']:
+        compileMain(sys.argv[2:])
+    elif sys.argv[1:2]==['serve']:
+        import spillserver
+        sys.exit(spillserver.main(sys.argv[1:]))
+    else:
+        si = SpillSys()
+        for arg in sys.argv[1:]:
+            si.loadFile(arg)
 
 
 
@@ -0,0 +1,193 @@
+# spillaot.py = ahead-of-time compilation of Spill files into Python modules
+
+""" Ahead-of-time compilation
+
+"spill compile foo.l" reads, parses and macro-expands <foo.l> once and
+writes the expanded top-level forms into a compiled Python module
+<foo_l.pyc> next to it. When SpillSys.loadFile() is later asked for
+<foo.l>, and <foo_l.pyc> is up to date, it imports the module and
+evaluates its forms directly, without lexing, parsing or macro
+expansion.
+
+The module is built as a Python abstract syntax tree (using the ast
+module), which is compiled, and the code object written out as a .pyc
+file. Python 2 can't turn a syntax tree back into source, so there is
+no .py file; a module written by a different version of Python is
+ignored, as Python's magic number at the start of the file doesn't
+match.
+
+A compiled module is up to date if:
+- it was written with the current FORMAT
+- its KEY is the one the form cache would use for the source file
+  now (see spillcache.formsKey()), i.e. the source file has the same
+  contents, and the same macros, with the same definitions, were in
+  effect when the file started loading
+
+Modules are imported under a name made from the full pathname of the
+module, so that compiled files with the same name in different
+directories don't replace each other in sys.modules.
+"""
+
+import ast
+import hashlib
+import imp
+import marshal
+import os.path
+import re
+import struct
+import time
+
+import spillcache
+import spilltypes
+
+debug = 0
+
+# change this if the layout of compiled modules changes
+FORMAT = 4
+
+#---------------------------------------------------------------------
+# names of things
+
+def moduleName(filename):
+    """ the name of the module a source file compiles into
+    @param filename [str] e.g. "lib/foo-bar.l"
+    @return [str] e.g. "foo_bar_l"
+    """
+    base = os.path.basename(filename)
+    name = re.sub(r"[^A-Za-z0-9_]", "_", base)
+    if name[:1].isdigit(): name = "_" + name
+    return name
+
+def modulePath(filename):
+    """ the pathname of the module a source file compiles into
+    @param filename [str] e.g. "lib/foo.l"
+    @return [str] e.g. "lib/foo_l.pyc"
+    """
+    return os.path.join(os.path.dirname(filename),
+                        moduleName(filename) + ".pyc")
+
+def importName(filename):
+    """ the name the module a source file compiles into is imported
+    under, which is different for each directory
+    @param filename [str] e.g. "lib/foo.l"
+    @return [str] e.g. "spillaot_3f2a..._foo_l"
+    """
+    path = os.path.abspath(modulePath(filename))
+    return "spillaot_%s_%s" % (hashlib.sha1(path).hexdigest()[:16],
+                               moduleName(filename))
+
+#---------------------------------------------------------------------
+# building the syntax tree
+
+def exToAst(ex):
+    """ convert an s-expression into a Python expression that
+    re-creates it
+    @param ex [s-exp]
+    @return [ast.expr]
+    """
+    if isinstance(ex, spilltypes.LStr):
+        return ast.Call(ast.Name('LStr', ast.Load()), [ast.Str(ex.s)],
+                        [], None, None)
+    if isinstance(ex, tuple):
+        return ast.Tuple([exToAst(e) for e in ex], ast.Load())
+    if isinstance(ex, spilltypes.Pair):
+        # a data list, e.g. in (quote ...)
+        items = spilltypes.listItems(ex)
+        tail = ex
+        while tail.__class__ is spilltypes.Pair: tail = tail.cdr
+        args = [ast.Tuple([exToAst(e) for e in items], ast.Load())]
+        if not spilltypes.isNull(tail):
+            # an improper list, e.g. (a . b)
+            args.append(exToAst(tail))
+        return ast.Call(ast.Name('toCons', ast.Load()), args,
+                        [], None, None)
+    if isinstance(ex, spilltypes.Vector):
+        items = ast.Tuple([exToAst(e) for e in ex.tolist()], ast.Load())
+        return ast.Call(ast.Name('toVector', ast.Load()), [items],
+                        [], None, None)
+    if isinstance(ex, str):
+        return ast.Str(ex)
+    if isinstance(ex, (int, long, float)):
+        return ast.Num(ex)
+    raise TypeError("can't compile constant %r" % (ex,))
+
+def assign(name, valueNode):
+    return ast.Assign([ast.Name(name, ast.Store())], valueNode)
+
+def buildModule(filename, forms, key):
+    """ build the syntax tree for a compiled module
+    @param filename [str] the source file
+    @param forms [list of s-exp] the macro-expanded top-level forms
+    @param key [str] the spillcache.formsKey() of the source file
+       and the macros in effect before loading it
+    @return [ast.Module]
+    """
+    doc = "%s compiled by \"spill compile\"" % (
+        os.path.basename(filename),)
+    body = [
+        ast.Expr(ast.Str(doc)),
+        ast.ImportFrom('spilltypes', [ast.alias('LStr', None),
+                                      ast.alias('toCons', None),
+                                      ast.alias('toVector', None)], 0),
+        assign('FORMAT', ast.Num(FORMAT)),
+        assign('SOURCE', ast.Str(os.path.basename(filename))),
+        assign('KEY', ast.Str(key)),
+        assign('FORMS', ast.Tuple([exToAst(f) for f in forms],
+                                  ast.Load())),
+    ]
+    tree = ast.Module(body)
+    ast.fix_missing_locations(tree)
+    return tree
+
+#---------------------------------------------------------------------
+# writing the module
+
+def writeModule(filename, forms, key):
+    """ write the compiled module for a source file
+    @param filename [str] the source file
+    @param forms [list of s-exp] the macro-expanded top-level forms
+    @param key [str] the spillcache.formsKey() of the source file
+       and the macros in effect before loading it
+    @return [str] the pathname of the module written
+    """
+    tree = buildModule(filename, forms, key)
+    path = modulePath(filename)
+    code = compile(tree, path, 'exec')
+    # laid out as Python writes .pyc files: magic number, time, code
+    f = open(path, "wb")
+    try:
+        f.write(imp.get_magic())
+        f.write(struct.pack("<I", int(time.time())))
+        marshal.dump(code, f)
+    finally:
+        f.close()
+    return path
+
+#---------------------------------------------------------------------
+# loading
+
+def loadCompiled(filename, macroState):
+    """ load the compiled forms for a source file, if there is an
+    up-to-date compiled module for it.
+    @param filename [str] the source file
+    @param macroState [list of (str,str)] the name and definition of
+       each macro in effect now
+    @return [tuple of s-exp] the expanded forms, or None if there's
+       no usable compiled module
+    """
+    path = modulePath(filename)
+    if not os.path.exists(path): return None
+    try:
+        key = spillcache.formsKey(filename, macroState)
+        module = imp.load_compiled(importName(filename), path)
+    except (OSError, IOError, ImportError, EOFError, ValueError,
+            TypeError):
+        # unreadable, or written by another version of Python
+        return None
+    if (getattr(module, 'FORMAT', None)!=FORMAT
+           or getattr(module, 'KEY', None)!=key):
+        if debug: print "compiled module <%s> is out of date" % (path,)
+        return None
+    return module.FORMS
+
+#end
@@ -0,0 +1,254 @@
+# spillcache.py = on-disk cache of parsed and macro-expanded forms
+
+""" The form cache
+
+Loading a source file means lexing, parsing and macro-expanding it.
+The results only depend on the contents of the file and on the macros
+in effect when it starts loading, so they can be kept on disk and
+re-used: SpillSys.loadFile() asks the cache for a file's expanded
+forms before reading it.
+
+Each cache entry is a file in the cache directory, named by a hash of
+the source file's contents and of the macros in effect. It holds the
+expanded top-level forms in marshal format, one after the other,
+followed by None. Since marshal only knows about Python types, Spill
+values that aren't are encoded:
+
+   Spill         Python          in the cache
+   -----         ------          ------------
+   string        LStr            unicode (the bytes, as latin-1)
+   data list     Pair            list
+   improper list Pair            dict {0: list of items, 1: tail}
+   vector        Vector          dict {2: list of elements}
+
+Symbols, ints and code lists (tuples) are stored as they are.
+
+Entries are written to a temporary file and renamed into place when
+complete, so a reader never sees a partly-written entry.
+"""
+
+import hashlib
+import marshal
+import os
+import tempfile
+
+import spilltypes
+
+debug = 0
+
+# change this when the format of cache entries changes
+FORMAT = 1
+
+MAGIC = "spill-forms-%d\n" % (FORMAT,)
+
+class Uncacheable(Exception):
+    """ a form contains a value that can't be stored in the cache """
+
+#---------------------------------------------------------------------
+# encoding Spill values for marshal
+
+def encode(ex):
+    """ encode an s-expression so that marshal can store it
+    @param ex [s-exp]
+    @return a value marshal can store
+    """
+    return convert(ex, encodePart)
+
+def encodePart(ex):
+    cls = ex.__class__
+    if cls is str or cls is int or cls is long:
+        return None, ex
+    if cls is tuple:
+        return ex, tuple
+    if cls is spilltypes.Pair:
+        items = []
+        while ex.__class__ is spilltypes.Pair:
+            items.append(ex.car)
+            ex = ex.cdr
+        if spilltypes.isNull(ex): return items, list
+        items.append(ex)
+        return items, lambda v: {0: v[:-1], 1: v[-1]}
+    if isinstance(ex, spilltypes.LStr):
+        return None, ex.s.decode('latin-1')
+    if cls is spilltypes.Vector:
+        return None, {2: ex.tolist()}
+    raise Uncacheable("can't cache %r" % (ex,))
+
+def decode(v):
+    """ the inverse of encode() """
+    return convert(v, decodePart)
+
+def decodePart(v):
+    cls = v.__class__
+    if cls is str or cls is int or cls is long:
+        return None, v
+    if cls is tuple:
+        return v, tuple
+    if cls is list:
+        return v, spilltypes.toCons
+    if cls is unicode:
+        return None, spilltypes.LStr(v.encode('latin-1'))
+    if cls is dict:
+        if 2 in v: return None, spilltypes.toVector(v[2])
+        return v[0] + [v[1]], lambda d: spilltypes.toCons(d[:-1], d[-1])
+    raise ValueError("bad value in cache: %r" % (v,))
+
+def convert(x, convertPart):
+    """ convert a value and the values inside it, innermost first,
+    using an explicit stack rather than recursion, so that any depth
+    of nesting can be converted
+    @param convertPart [function] convertPart(y) returns (None, the
+       converted value) if (y) has no parts, or (its parts, a function
+       making the converted value from the converted parts)
+    """
+    # for each value being converted: [its parts, their converted
+    # values, function]; the first holds just (x)
+    stack = [[(x,), [], None]]
+    while True:
+        parts, done, make = stack[-1]
+        if len(done) < len(parts):
+            subParts, v = convertPart(parts[len(done)])
+            if subParts is None:
+                done.append(v)
+            else:
+                stack.append([subParts, [], v])
+            continue
+        stack.pop()
+        if not stack: return done[0]
+        stack[-1][1].append(make(done))
+
+#---------------------------------------------------------------------
+
+class FormCache:
+    """ a directory of cached expanded forms """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def stats(self):
+        """ how well is the cache doing?
+        @return [dict]
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'writes': self.writes}
+
+    def key(self, filename, macroState):
+        """ the key for a source file
+        @param filename [str]
+        @param macroState [list of (str,str)] the name and definition
+           of each macro in effect
+        @return [str]
+        """
+        return formsKey(filename, macroState)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".forms")
+
+    def load(self, key):
+        """ the cached forms for (key)
+        @return [generator of s-exp] or None if they aren't cached
+        """
+        try:
+            f = open(self.path(key), "rb")
+        except IOError:
+            self.misses += 1
+            if debug: print "form cache miss %s" % (key,)
+            return None
+        if f.readline()!=MAGIC:
+            f.close()
+            self.misses += 1
+            return None
+        self.hits += 1
+        if debug: print "form cache hit %s" % (key,)
+        return self.iterEntry(f)
+
+    def iterEntry(self, f):
+        try:
+            while True:
+                v = marshal.load(f)
+                if v is None: break
+                yield decode(v)
+        finally:
+            f.close()
+
+    def writer(self, key):
+        """ something to write the forms for (key) to
+        @return [CacheWriter]
+        """
+        return CacheWriter(self, key)
+
+class CacheWriter:
+    """ writes a cache entry, one form at a time """
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        fd, self.tempPath = tempfile.mkstemp(".tmp", "", cache.directory)
+        self.f = os.fdopen(fd, "wb")
+        self.f.write(MAGIC)
+        self.ok = True
+
+    def add(self, form):
+        """ add the next form """
+        if not self.ok: return
+        try:
+            marshal.dump(encode(form), self.f)
+        except (Uncacheable, ValueError):
+            # ValueError: nested too deeply for marshal
+            if debug: print "can't cache %s" % (self.key,)
+            self.ok = False
+
+    def commit(self):
+        """ all the forms have been added: make the entry visible """
+        if self.f is None: return
+        marshal.dump(None, self.f)
+        self.f.close()
+        self.f = None
+        if self.ok:
+            os.rename(self.tempPath, self.cache.path(self.key))
+            self.cache.writes += 1
+        else:
+            os.remove(self.tempPath)
+
+    def close(self):
+        """ throw away the entry, unless it has been committed """
+        if self.f is None: return
+        self.f.close()
+        self.f = None
+        os.remove(self.tempPath)
+
+def formsKey(filename, macroState):
+    """ a key for the expanded forms of a source file, which
+    changes if its contents or the macros in effect do
+    @param filename [str]
+    @param macroState [list of (str,str)] the name and definition
+       of each macro in effect
+    @return [str]
+    """
+    h = hashlib.sha1(MAGIC)
+    for name, definition in sorted(macroState):
+        h.update("%s=%s\n" % (name, definition))
+    h.update(fileHash(filename))
+    return h.hexdigest()
+
+def fileHash(filename):
+    """ a hash of a file's contents
+    @return [str]
+    """
+    h = hashlib.sha1()
+    f = open(filename, "rb")
+    try:
+        while True:
+            chunk = f.read(64*1024)
+            if not chunk: break
+            h.update(chunk)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+#end
@@ -0,0 +1,555 @@
+# spillcomp.py = compile Spill s-expressions into Python closures
+
+""" The closure compiler
+
+seval() re-examines the shape of an expression every time it is
+evaluated. The compiler does that work once: each (macro-expanded)
+s-expression is turned into a Python function of one argument, the
+environment, which when called returns the value of the expression.
+Closure bodies are compiled when the (fn ...) form is compiled, so
+calling a compiled closure is just a chain of Python calls.
+
+Usage:
+   c = Compiler(globalEnv)
+   code = c.compile(ex)
+   result = code(globalEnv)
+"""
+
+import spilltypes
+
+debug = 0
+
+#---------------------------------------------------------------------
+# truth
+
+def isTrue(v):
+    """ does (v) count as true? Same rules as spill.spillTrue(), but
+    returns a Python bool.
+    """
+    cls = v.__class__
+    if cls is str: return v!='false'
+    if cls is spilltypes.Pair or cls is tuple: return True
+    if isinstance(v, spilltypes.LStr):
+        return len(v)>0
+    return not (v=='false' or v==0 or v==[])
+
+#---------------------------------------------------------------------
+# environment frames for compiled closures
+
+class Unbound:
+    """ the value of a frame slot whose variable hasn't been bound yet """
+    def __repr__(self): return "<unbound>"
+UNBOUND = Unbound()
+
+class Frame(list):
+    """ the variables of one call of a closure, compiled or not.
+
+    The values are held in the list itself, in the order given by
+    the closure's Scope, so compiled code can reach a variable by
+    (depth, index) without looking its name up. For code that
+    does need to look up names (e.g. (eval ...)), Frame has the same
+    get/define/getEnvFor interface as spill.Environment, with which it
+    can be chained.
+    """
+    __slots__ = ('parent', 'scope', 'extra')
+
+    def get(self, k):
+        env = self
+        while isinstance(env, Frame):
+            ix = env.scope.slotIndex.get(k)
+            if ix is not None and env[ix] is not UNBOUND:
+                return env[ix]
+            if env.extra and k in env.extra:
+                return env.extra[k]
+            env = env.parent
+        return env.get(k)
+
+    def define(self, k, value):
+        ix = self.scope.slotIndex.get(k)
+        if ix is not None:
+            self[ix] = value
+        else:
+            # a variable created at run-time, e.g. by (eval '(def x 1))
+            if self.extra is None: self.extra = {}
+            self.extra[k] = value
+
+    def getEnvFor(self, var):
+        ix = self.scope.slotIndex.get(var)
+        if ((ix is not None and self[ix] is not UNBOUND)
+               or (self.extra and var in self.extra)):
+            return self
+        return self.parent.getEnvFor(var)
+
+    def getMacroTable(self):
+        env = self
+        while isinstance(env, Frame): env = env.parent
+        return env.getMacroTable()
+
+#---------------------------------------------------------------------
+# scopes: what the compiler knows about variables
+
+class Scope:
+    """ the variables of a (fn ...) form, known at compile time.
+    These are its parameters followed by any variables (def)ined
+    directly in its body, in that order; the order gives their
+    index in a Frame.
+    """
+    dynamic = False
+
+    def __init__(self, params, body, parent):
+        """
+        @param params [tuple] the parameter list
+        @param body [s-exp] the body of the fn
+        @param parent [Scope|None] the scope of the enclosing fn
+        """
+        self.parent = parent
+        fixed, rest = splitParams(params)
+        self.nfixed = len(fixed)
+        self.rest = rest
+        names = list(fixed)
+        if rest is not None: names.append(rest)
+        nparams = len(names)
+        for name in localDefs(body):
+            if name not in names: names.append(name)
+        self.names = tuple(names)
+        self.slotIndex = {}
+        for ix, name in enumerate(names):
+            self.slotIndex[name] = ix
+        self.padding = (UNBOUND,) * (len(names) - nparams)
+        self.dynamic = containsEval(body) or (parent is not None
+                                               and parent.dynamic)
+
+    def resolve(self, name):
+        """ where is the variable (name)?
+        @return [int,int] its (depth, index), where depth is how many
+           frames out from this one it is; or None if it's not a
+           local variable of any enclosing fn
+        """
+        depth = 0
+        scope = self
+        while scope is not None:
+            ix = scope.slotIndex.get(name)
+            if ix is not None: return depth, ix
+            scope = scope.parent
+            depth += 1
+        return None
+
+    def bindArgs(self, args):
+        """ make the initial values for a frame of this scope, for
+        a call with (args). Both engines bind arguments this way.
+        @return [list]
+        """
+        n = len(args)
+        nfixed = self.nfixed
+        if self.rest is None:
+            if n!=nfixed:
+                raise TypeError("%d arguments given to a function "
+                                "taking %d" % (n, nfixed))
+            values = list(args)
+        else:
+            if n < nfixed:
+                raise TypeError("%d arguments given to a function "
+                                "taking at least %d" % (n, nfixed))
+            values = list(args[:nfixed])
+            values.append(spilltypes.toCons(args[nfixed:]))
+        values.extend(self.padding)
+        return values
+
+class DynamicScope:
+    """ the scope for code compiled at run-time by (eval ...), which
+    knows nothing about the frames it will run in
+    """
+    parent = None
+    slotIndex = {}
+    dynamic = True
+
+    def resolve(self, name):
+        return None
+DYNAMIC = DynamicScope()
+
+def localDefs(body):
+    """ the variables (def)ined in a fn body, not counting those in
+    nested fns
+    @return [list of str]
+    """
+    names = []
+    stack = [body]
+    while stack:
+        x = stack.pop()
+        if not isinstance(x, tuple) or len(x)==0: continue
+        h = x[0]
+        if h=='quote' or h=='fn': continue
+        if h=='def' and len(x)>1 and type(x[1])==str:
+            if x[1] not in names: names.append(x[1])
+        stack.extend(reversed(x))
+    return names
+
+def containsEval(body):
+    """ does (body) include an (eval ...) form?
+    If so, variables may be created at run-time that the compiler
+    doesn't know about.
+    """
+    stack = [body]
+    while stack:
+        x = stack.pop()
+        if not isinstance(x, tuple) or len(x)==0: continue
+        h = x[0]
+        if h=='quote': continue
+        if h=='eval': return True
+        stack.extend(x)
+    return False
+
+#---------------------------------------------------------------------
+# compiled closures
+
+class CompiledClosure:
+    name = None  # the variable it was first (def)ined as
+
+    def __init__(self, params, body, env, code, scope):
+        """
+        @param params [tuple] the parameter list, as written
+        @param body [s-exp] the body, as written
+        @param env the environment the closure was created in
+        @param code [function] the compiled body
+        @param scope [Scope] the scope of the body
+        """
+        self.params = params
+        self.body = body
+        self.env = env
+        self.code = code
+        self.scope = scope
+
+    def __repr__(self):
+        return "<closure %s %s>" %\
+           (spilltypes.show(self.params),
+            spilltypes.show(self.body))
+
+    def __call__(self, *args):
+        closure = self
+        while True:
+            scope = closure.scope
+            if len(args)==scope.nfixed and scope.rest is None:
+                frame = Frame(args)
+                if scope.padding: frame.extend(scope.padding)
+            else:
+                frame = Frame(scope.bindArgs(args))
+            frame.parent = closure.env
+            frame.scope = scope
+            frame.extra = None
+            result = closure.code(frame)
+            if result.__class__ is not TailCall: return result
+            # the body ended by calling another compiled closure
+            closure = result.closure
+            args = result.args
+
+class TailCall(object):
+    """ returned by compiled code in tail position, instead of
+    calling a CompiledClosure directly. CompiledClosure.__call__()
+    makes the call, so that tail calls don't use Python stack.
+    """
+    __slots__ = ('closure', 'args')
+
+    def __init__(self, closure, args):
+        self.closure = closure
+        self.args = args
+
+def splitParams(params):
+    """ split a parameter list into the fixed parameters and the
+    rest parameter (the one following '*')
+    @param params [tuple of str]
+    @return [tuple of str, str|None]
+    """
+    if '*' in params:
+        ix = list(params).index('*')
+        return tuple(params[:ix]), params[ix+1]
+    return tuple(params), None
+
+#---------------------------------------------------------------------
+
+class Compiler:
+    """ compiles s-expressions for a particular global environment """
+
+    def __init__(self, globalEnv):
+        self.globalEnv = globalEnv
+        # so that globalVar()'s cached Cells are kept right
+        globalEnv.watch()
+        self.specialForms = {
+            'quote': self.compileQuote,
+            'if': self.compileIf,
+            'def': self.compileDef,
+            'set!': self.compileSet,
+            'begin': self.compileBegin,
+            'fn': self.compileFn,
+            'eval': self.compileEval,
+        }
+
+    def compile(self, x, scope=None, tail=False):
+        """ compile an s-expression
+        @param x [s-exp] a macro-expanded expression
+        @param scope [Scope|DynamicScope|None] the scope (x) is in;
+           None for top-level code
+        @param tail [bool] is (x) in tail position in a fn body? If
+           so, the compiled code may return a TailCall
+        @return [function] taking an environment and returning the
+           value of (x) in that environment
+        """
+        if type(x)==str:
+            return self.compileVar(x, scope)
+        if not isinstance(x, tuple) or len(x)==0:
+            return constant(x)
+        h = x[0]
+        if type(h)==str and h in self.specialForms:
+            return self.specialForms[h](x, scope, tail)
+        return self.compileCall(x, scope, tail)
+
+    #========================================================
+    # variables and constants
+
+    def compileVar(self, name, scope):
+        if scope is None:
+            return globalVar(self.globalEnv, name)
+        addr = scope.resolve(name)
+        if addr is not None:
+            return localVar(name, addr[0], addr[1])
+        if scope.dynamic:
+            return dynamicVar(name)
+        return globalVar(self.globalEnv, name)
+
+    def compileQuote(self, x, scope, tail):
+        if isinstance(x[1], tuple):
+            # a list in code rather than data
+            return constant(spilltypes.toConsDeep(x[1]))
+        return constant(x[1])
+
+    #========================================================
+    # special forms
+
+    def compileIf(self, x, scope, tail):
+        """ (if con1 ex1 con2 ex2 ... [else]) -- see spill.evalIf() """
+        parts = []
+        for ix, e in enumerate(x[1:]):
+            # the branches and the final else are in tail position,
+            # the conditions aren't
+            isBranch = ix%2==1 or ix==len(x)-2
+            parts.append(self.compile(e, scope, tail and isBranch))
+        if len(parts)==3:
+            # the common case
+            con, ex1, ex2 = parts
+            def if3(env):
+                if isTrue(con(env)): return ex1(env)
+                return ex2(env)
+            return if3
+        pairs = []
+        for ix in range(0, len(parts)-1, 2):
+            pairs.append((parts[ix], parts[ix+1]))
+        hasElse = len(parts)%2==1
+        if hasElse: final = parts[-1]
+        def ifN(env):
+            lastEval = None
+            for con, ex in pairs:
+                lastEval = con(env)
+                if isTrue(lastEval): return ex(env)
+            if hasElse: return final(env)
+            return lastEval
+        return ifN
+
+    def compileDef(self, x, scope, tail):
+        var = x[1]; value = self.compile(x[2], scope)
+        if scope is not None and var in scope.slotIndex:
+            ix = scope.slotIndex[var]
+            def defineLocal(env):
+                v = value(env)
+                if v.__class__ is CompiledClosure and v.name is None:
+                    v.name = var
+                env[ix] = v
+                return v
+            return defineLocal
+        def define(env):
+            v = value(env)
+            if v.__class__ is CompiledClosure and v.name is None:
+                v.name = var
+            env.define(var, v)
+            return v
+        return define
+
+    def compileSet(self, x, scope, tail):
+        var = x[1]; value = self.compile(x[2], scope)
+        addr = None
+        if scope is not None: addr = scope.resolve(var)
+        if addr is not None:
+            depth, ix = addr
+            def setLocal(env):
+                v = value(env)
+                for i in xrange(depth): env = env.parent
+                env[ix] = v
+                return v
+            return setLocal
+        if scope is None or not scope.dynamic:
+            globalEnv = self.globalEnv
+            def setGlobal(env):
+                v = value(env)
+                globalEnv.getEnvFor(var).define(var, v)
+                return v
+            return setGlobal
+        def setBang(env):
+            v = value(env)
+            env.getEnvFor(var).define(var, v)
+            return v
+        return setBang
+
+    def compileBegin(self, x, scope, tail):
+        forms = [self.compile(e, scope) for e in x[1:-1]]
+        forms.append(self.compile(x[-1], scope, tail))
+        if len(forms)==1: return forms[0]
+        init = forms[:-1]; last = forms[-1]
+        def begin(env):
+            for f in init: f(env)
+            return last(env)
+        return begin
+
+    def compileFn(self, x, scope, tail):
+        params = x[1]; body = x[2]
+        fnScope = Scope(params, body, scope)
+        code = self.compile(body, fnScope, True)
+        def fn(env):
+            return CompiledClosure(params, body, env, code, fnScope)
+        return fn
+
+    def compileEval(self, x, scope, tail):
+        arg = self.compile(x[1], scope)
+        # expand macros in the form, if our global environment has any
+        macroTable = getattr(self.globalEnv, 'macroTable', None)
+        if macroTable is None:
+            toCode = spilltypes.toCode
+        else:
+            toCode = macroTable.expand
+        def evalForm(env):
+            return self.compile(toCode(arg(env)), DYNAMIC)(env)
+        return evalForm
+
+    #========================================================
+    # function application
+
+    def compileCall(self, x, scope, tail):
+        fun = self.compile(x[0], scope)
+        args = [self.compile(e, scope) for e in x[1:]]
+        if tail: return tailCall(fun, args)
+        nargs = len(args)
+        if nargs==0:
+            def call0(env):
+                return fun(env)()
+            return call0
+        if nargs==1:
+            a0 = args[0]
+            def call1(env):
+                return fun(env)(a0(env))
+            return call1
+        if nargs==2:
+            a0, a1 = args
+            def call2(env):
+                return fun(env)(a0(env), a1(env))
+            return call2
+        if nargs==3:
+            a0, a1, a2 = args
+            def call3(env):
+                return fun(env)(a0(env), a1(env), a2(env))
+            return call3
+        def callN(env):
+            return fun(env)(*[a(env) for a in args])
+        return callN
+
+#---------------------------------------------------------------------
+# compiled pieces
+
+def tailCall(fun, args):
+    """ a call in tail position. Calls to compiled closures are
+    returned as TailCalls, anything else is called now.
+    """
+    nargs = len(args)
+    if nargs==1:
+        a0 = args[0]
+        def tailCall1(env):
+            f = fun(env)
+            if f.__class__ is CompiledClosure:
+                return TailCall(f, (a0(env),))
+            return f(a0(env))
+        return tailCall1
+    if nargs==2:
+        a0, a1 = args
+        def tailCall2(env):
+            f = fun(env)
+            if f.__class__ is CompiledClosure:
+                return TailCall(f, (a0(env), a1(env)))
+            return f(a0(env), a1(env))
+        return tailCall2
+    def tailCallN(env):
+        f = fun(env)
+        argValues = tuple([a(env) for a in args])
+        if f.__class__ is CompiledClosure:
+            return TailCall(f, argValues)
+        return f(*argValues)
+    return tailCallN
+
+def constant(value):
+    def const(env):
+        return value
+    return const
+
+def globalVar(globalEnv, name):
+    """ a variable that isn't local to any enclosing fn. The Cell
+    holding its value is looked up the first time it's used, and
+    again only if the version of globalEnv.stamp, which Compiler()
+    set up by watching globalEnv, has changed since (see
+    spill.Environment). A variable set! has copied out of a frozen
+    environment has a Cell for each SpillSys that copied it, so isn't
+    cached while one of them is running.
+    """
+    stamp = globalEnv.stamp
+    # (cell, the version it was looked up at), replaced in one go
+    # so other threads never see a cell with the wrong version
+    cached = [(None, -1)]
+    def glob(env):
+        cell, version = cached[0]
+        if version==stamp.version:
+            if not (globalEnv.frozen and globalEnv.copying
+                    and globalEnv.copiedByRunning(name)):
+                return cell.value
+        version = stamp.version
+        cell = globalEnv.cell(name)
+        if not globalEnv.isCopied(name):
+            cached[0] = (cell, version)
+        return cell.value
+    return glob
+
+def dynamicVar(name):
+    """ a variable that has to be looked up by name at run-time """
+    def dynamic(env):
+        return env.get(name)
+    return dynamic
+
+def localVar(name, depth, ix):
+    """ a variable in slot (ix) of the frame (depth) frames out from
+    the current one. If the slot is unbound, the variable is
+    looked up by name further out, as spill.Environment would.
+    """
+    if depth==0:
+        def local0(env):
+            v = env[ix]
+            if v is UNBOUND: return env.parent.get(name)
+            return v
+        return local0
+    if depth==1:
+        def local1(env):
+            env = env.parent
+            v = env[ix]
+            if v is UNBOUND: return env.parent.get(name)
+            return v
+        return local1
+    def localN(env):
+        for i in xrange(depth): env = env.parent
+        v = env[ix]
+        if v is UNBOUND: return env.parent.get(name)
+        return v
+    return localN
+
+#end
@@ -0,0 +1,202 @@
+# spillmemo.py = memoised functions
+
+""" Memoised functions
+
+(memo f [size]) wraps a function so that the result of each call is
+remembered, keyed by its arguments, and a later call with the same
+arguments returns the remembered result rather than calling (f)
+again. At most (size) results are kept (DEFAULT_SIZE if not given);
+when there's no room for another, the least recently used one is
+forgotten. (defmemo ...) in libcore.l defines a memoised function:
+
+   (defmemo fib (n)
+      (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))
+
+   (memo f [size])      a memoised (f)
+   (memo-stats m)       ((hits h) (misses m) (evictions e) (size s)
+                         (max-size n))
+   (memo-clear! m)      forget all the remembered results
+
+Only use it on functions whose results depend on nothing but their
+arguments, and which have no side effects. Numbers, strings and
+symbols are keyed by their type and value; lists, vectors and maps
+by their contents; and anything else, e.g. a closure, by its
+identity. Calls that raise an exception aren't remembered.
+"""
+
+import threading
+
+from collections import OrderedDict
+
+import spilltypes
+
+debug = 0
+
+# how many results a memoised function keeps, by default
+DEFAULT_SIZE = 1000
+
+# the types whose values are keyed by their type and value
+PLAIN = (int, long, float, str, bool, spilltypes.LStr)
+
+class Identity(object):
+    """ a key for a value that is only equal to itself, e.g. a
+    closure. It keeps the value alive, so its id can't be reused.
+    """
+    __slots__ = ('x',)
+
+    def __init__(self, x):
+        self.x = x
+
+    def __hash__(self):
+        return id(self.x)
+
+    def __eq__(self, other):
+        return other.__class__ is Identity and other.x is self.x
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+def argKey(x):
+    """ a hashable key for an argument. Numbers, strings and symbols
+    are keyed by their type and value, so that e.g. 1 and true
+    (which Python thinks are equal) and 1 and 1.0 have different
+    keys; lists, vectors and maps by their contents, without
+    recursing; and anything else by its identity.
+    """
+    # for each list or map being keyed: [its tag, its parts, their keys]
+    stack = [[None, [x], []]]
+    while True:
+        tag, parts, done = stack[-1]
+        if len(done) < len(parts):
+            e = parts[len(done)]
+            cls = e.__class__
+            if cls in PLAIN:
+                done.append((cls, e))
+            elif cls is spilltypes.Pair or isinstance(e, tuple):
+                # an improper list's parts include the dot before its tail
+                stack.append(['#list', list(spilltypes.listParts(e)), []])
+            elif cls is spilltypes.PMap:
+                stack.append(['#map',
+                              list(spilltypes.mapParts(e)), []])
+            elif cls is spilltypes.Vector:
+                done.append(('#vector', tuple([(n.__class__, n)
+                                               for n in e.tolist()])))
+            else:
+                done.append(Identity(e))
+            continue
+        stack.pop()
+        if tag is None: return done[0]
+        if tag=='#map':
+            key = (tag, frozenset(zip(done[0::2], done[1::2])))
+        else:
+            key = (tag, tuple(done))
+        stack[-1][2].append(key)
+    #//while
+
+def memoKey(args):
+    """ a hashable key for a call's arguments
+    @param args [tuple]
+    """
+    if len(args)==1:
+        cls = args[0].__class__
+        if cls in PLAIN: return (cls, args[0])
+    return argKey(args)
+
+#---------------------------------------------------------------------
+
+class Memo(spilltypes.SpillType):
+    """ a function, memoised """
+    __slots__ = ('f', 'maxSize', 'results', 'hits', 'misses',
+                 'evictions', 'lock')
+
+    def __init__(self, f, maxSize=DEFAULT_SIZE):
+        """
+        @param f [callable] the function to memoise
+        @param maxSize [int] how many results to keep, at most
+        """
+        if not callable(f):
+            raise TypeError("memo: %s is not a function"
+                            % (spilltypes.show(f),))
+        if maxSize < 1:
+            raise ValueError("memo: size must be at least 1, not %r"
+                             % (maxSize,))
+        self.f = f
+        self.maxSize = maxSize
+        self.results = OrderedDict() # least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def show(self):
+        return "#<memo %r>" % (self.f,)
+    showStr = show
+
+    def __repr__(self):
+        return self.show()
+
+    def __call__(self, *args):
+        key = memoKey(args)
+        results = self.results
+        with self.lock:
+            if key in results:
+                self.hits += 1
+                # move it to the most recently used end
+                value = results.pop(key)
+                results[key] = value
+                return value
+            self.misses += 1
+        # not holding the lock, as (f) may well call us again
+        value = self.f(*args)
+        with self.lock:
+            if key in results:
+                del results[key]
+            elif len(results) >= self.maxSize:
+                results.popitem(last=False)
+                self.evictions += 1
+            results[key] = value
+        if debug: print "memo %r%r => %r" % (self.f, args, value)
+        return value
+
+    def stats(self):
+        """ how well the memo has worked
+        @return [dict]
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'size': len(self.results),
+                'max-size': self.maxSize}
+
+    def clear(self):
+        """ forget the remembered results, and the stats """
+        with self.lock:
+            self.results.clear()
+            self.hits = self.misses = self.evictions = 0
+
+#---------------------------------------------------------------------
+# primitives
+
+STAT_NAMES = ['hits', 'misses', 'evictions', 'size', 'max-size']
+
+def requireMemo(name, m):
+    if not isinstance(m, Memo):
+        raise TypeError("%s: %s is not a memoised function"
+                        % (name, spilltypes.show(m)))
+    return m
+
+def memoStats(m):
+    """ (memo-stats m) => ((hits h) (misses m) ...) """
+    st = requireMemo('memo-stats', m).stats()
+    return spilltypes.toCons([spilltypes.toCons([name, st[name]])
+                              for name in STAT_NAMES])
+
+def memoClear(m):
+    requireMemo('memo-clear!', m).clear()
+    return m
+
+primitives = {
+    'memo': Memo,
+    'memo-stats': memoStats,
+    'memo-clear!': memoClear,
+}
+
+#end
@@ -0,0 +1,274 @@
+# spillopt.py = an optimiser for macro-expanded Spill code
+
+""" The optimiser
+
+SpillSys runs each top-level form through Optimiser.optimise() after
+expanding its macros and before evaluating it. The optimiser:
+
+- folds calls of pure primitives whose arguments are all constants,
+  e.g. (+ 1 2) => 3, (list 'a 1) => '(a 1)
+- drops '() arguments of append that make no difference: any but the
+  last, e.g. (append x '() y) => (append x y), and the last if the
+  one before it is a constant list, e.g. (append x '(1) '()) =>
+  (append x '(1)). (append x '()) is left alone, as it raises an
+  error if x isn't a list.
+- prunes the branches of ifs whose conditions are constants, e.g.
+  (if 'true a b) => a
+- flattens nested begins, and drops constants from begins where
+  their values aren't used, e.g. (begin 1 (begin a b)) => (begin a b)
+
+A primitive is only called at optimisation time if the variable it
+is called through is bound to it in the global environment, and isn't
+(def)ined or (set!)ed anywhere in the form; calls in a form containing
+(eval ...) are never folded. Calls inside a fn body aren't folded at
+all: the fn may run after the primitive has been redefined, so only
+code that runs as the form is evaluated is folded. The other changes
+don't depend on what any variable is bound to, so are made in fn
+bodies too.
+
+A call that raises an exception, e.g. (/ 1 0), is left to raise it
+at run-time. Forms with nothing to optimise are returned as they are,
+not copied.
+"""
+
+import sys
+
+import spillcomp
+import spillprof
+import spilltypes
+
+debug = 0
+
+#---------------------------------------------------------------------
+# constants
+
+def isConstant(x):
+    """ is (x) an expression whose value is known before it's
+    evaluated?
+    """
+    cls = x.__class__
+    if cls is int or cls is long or cls is float \
+           or cls is spilltypes.LStr:
+        return True
+    return cls is tuple and len(x)==2 and x[0]=='quote'
+
+def constantValue(x):
+    """ the value of an expression for which isConstant() is true """
+    if x.__class__ is not tuple: return x
+    v = x[1]
+    if isinstance(v, tuple) and len(v)>0:
+        # a list in code rather than data
+        return spilltypes.toConsDeep(v)
+    return v
+
+def isConstantList(x):
+    """ is (x) an expression whose value is known to be a list? """
+    return x.__class__ is tuple and len(x)==2 and x[0]=='quote' \
+           and x[1].__class__ in (tuple, spilltypes.Pair)
+
+def literal(v):
+    """ an expression whose value is (v)
+    @return [s-exp] or None if there's no such expression
+    """
+    cls = v.__class__
+    if cls is int or cls is long or cls is float \
+           or cls is spilltypes.LStr:
+        return v
+    if cls is str or cls is spilltypes.Pair or cls is tuple:
+        return ('quote', v)
+    return None
+
+EMPTY = ('quote', ())
+
+NO_NAMES = frozenset()
+
+def countNodes(x):
+    """ how many lists and atoms there are in an expression """
+    n = 0
+    stack = [x]
+    while stack:
+        x = stack.pop()
+        n += 1
+        if x.__class__ is tuple: stack.extend(x)
+    return n
+
+def assignedNames(x):
+    """ the variables (def)ined or (set!)ed anywhere in an expression
+    @return [set of str] or None if it contains (eval ...), which may
+       assign any variable
+    """
+    names = set()
+    stack = [x]
+    while stack:
+        x = stack.pop()
+        if x.__class__ is not tuple or len(x)==0: continue
+        h = x[0]
+        if h=='quote': continue
+        if h=='eval': return None
+        if (h=='def' or h=='set!') and len(x)>1 and x[1].__class__ is str:
+            names.add(x[1])
+        stack.extend(x)
+    return names
+
+def rebuilt(x, items):
+    """ (x) if (items) are the same as its items, else a new form """
+    if len(items)==len(x):
+        for a, b in zip(items, x):
+            if a is not b: break
+        else:
+            return x
+    return tuple(items)
+
+#---------------------------------------------------------------------
+
+class Optimiser:
+    """ optimises forms to be evaluated in a global environment """
+
+    def __init__(self, globalEnv, pure):
+        """
+        @param globalEnv [spill.Environment]
+        @param pure [dict] name -> function, for the primitives that
+           have no side effects, and so can be called by the optimiser
+        """
+        self.globalEnv = globalEnv
+        self.pure = pure
+        self.dump = None    # a file to write forms to, before and after
+        self.folded = 0     # calls folded
+        self.pruned = 0     # if branches pruned
+        self.flattened = 0  # nested begins flattened
+
+    def stats(self):
+        """ what has been optimised so far
+        @return [dict]
+        """
+        return {'folded': self.folded, 'pruned': self.pruned,
+                'flattened': self.flattened}
+
+    def optimise(self, ex):
+        """ optimise a top-level form
+        @param ex [s-exp] a macro-expanded form
+        @return [s-exp]
+        """
+        if ex.__class__ is not tuple: return ex
+        result = self.walk(ex, self.foldable(ex))
+        if result is not ex and (debug or self.dump):
+            f = self.dump or sys.stdout
+            f.write("optimised (%d -> %d nodes):\n  %s\n  %s\n" % (
+                countNodes(ex), countNodes(result),
+                spilltypes.show(ex), spilltypes.show(result)))
+        return result
+
+    def foldable(self, ex):
+        """ the pure primitives whose calls can be folded in (ex)
+        @return [set of str]
+        """
+        assigned = assignedNames(ex)
+        if assigned is None: return NO_NAMES
+        names = set()
+        env = self.globalEnv
+        for name, f in self.pure.items():
+            if name in assigned or not env.has(name): continue
+            v = spillprof.unwrapped(env.get(name))
+            if getattr(v, 'f', None) is f: names.add(name)
+        return frozenset(names)
+
+    def walk(self, x, foldable):
+        """ optimise an expression
+        @param foldable [set of str] the primitives that can be
+           called at optimisation time here
+        """
+        if x.__class__ is not tuple or len(x)==0: return x
+        h = x[0]
+        if h=='quote':
+            return x
+        if h=='fn':
+            if len(x)!=3: return x
+            # it may be called after a primitive has been redefined
+            return rebuilt(x, [h, x[1], self.walk(x[2], NO_NAMES)])
+        if h=='def' or h=='set!':
+            return rebuilt(x, list(x[:2])
+                           + [self.walk(e, foldable) for e in x[2:]])
+        items = [self.walk(e, foldable) for e in x]
+        if h=='if':
+            return self.pruneIf(x, items)
+        if h=='begin':
+            return self.flattenBegin(x, items)
+        if h.__class__ is str and h in foldable:
+            return self.foldCall(rebuilt(x, items))
+        return rebuilt(x, items)
+
+    def foldCall(self, x):
+        """ a call of a pure primitive, folded if it can be """
+        h = x[0]
+        if h=='append' and len(x)>1:
+            # a '() adds nothing, but the last argument needn't be a
+            # list, so a trailing '() can only go if the argument
+            # before it is known to be one
+            args = [e for e in x[1:-1] if e!=EMPTY]
+            last = x[-1]
+            while last==EMPTY and args and isConstantList(args[-1]):
+                last = args.pop()
+            args.append(last)
+            if len(args) < len(x)-1:
+                self.folded += 1
+                if args==[EMPTY]: return EMPTY
+                x = (h,) + tuple(args)
+        args = []
+        for e in x[1:]:
+            if not isConstant(e): return x
+            args.append(constantValue(e))
+        try:
+            v = self.pure[h](*args)
+        except Exception:
+            # leave it to raise the exception at run-time
+            return x
+        result = literal(v)
+        if result is None: return x
+        self.folded += 1
+        return result
+
+    def pruneIf(self, x, items):
+        """ (if con1 ex1 con2 ex2 ... [else]), without the branches
+        that can't be taken
+        @param items [list] its items, optimised
+        """
+        parts = items[1:]
+        hasElse = len(parts)%2==1
+        kept = ['if']
+        for ix in range(0, len(parts)-1, 2):
+            con, ex = parts[ix], parts[ix+1]
+            if not isConstant(con):
+                kept.extend([con, ex])
+                continue
+            self.pruned += 1
+            if spillcomp.isTrue(constantValue(con)):
+                # this branch is taken, if we get this far
+                kept.append(ex)
+                break
+            if not hasElse and ix+2==len(parts):
+                # the last condition is false, so its value is the
+                # value of the if, if we get this far
+                kept.append(con)
+                break
+        else:
+            if hasElse: kept.append(parts[-1])
+        if len(kept)==2: return kept[1]
+        return rebuilt(x, kept)
+
+    def flattenBegin(self, x, items):
+        """ (begin ...) with nested begins flattened
+        @param items [list] its items, optimised
+        """
+        forms = []
+        for e in items[1:]:
+            if e.__class__ is tuple and len(e)>1 and e[0]=='begin':
+                forms.extend(e[1:])
+                self.flattened += 1
+            else:
+                forms.append(e)
+        # constants are only any use at the end
+        forms = [e for e in forms[:-1] if not isConstant(e)] + forms[-1:]
+        if len(forms)==1: return forms[0]
+        return rebuilt(x, ['begin'] + forms)
+
+#end
@@ -0,0 +1,282 @@
+# spillpar.py = parallel map, using worker processes
+
+""" Parallel map
+
+(pmap f a) is like (map f a), but shares the work between a pool of
+worker processes, one per core. It's for CPU-bound jobs where (f) is
+a pure function: anything (f) does to variables or output in a worker
+isn't seen by the caller.
+
+A closure can't be sent to another process as it is, since it holds
+a live environment. Instead it is shipped as its parameters and body,
+together with the values of the variables its body uses, found by
+looking them up in its environment. Where one of those values is
+itself a closure, that is shipped too (so recursive functions work);
+primitives are sent by name. Functions wrapped by the profiler or
+tracer are sent unwrapped; other functions, e.g. memoised ones, can't
+be sent. Data is sent in the same form as the form cache stores it
+(see spillcache.encode()).
+
+Each worker process runs its own SpillSys, with the library loaded,
+started when the pool is created. It rebuilds the closure, maps it
+over its chunk of the list, and sends back the results; the chunks'
+results are put back together in order.
+
+pmap falls back to an ordinary serial map when the list is short,
+when there's only one core, or when (f), the list or the results
+contain something that can't be sent between processes.
+"""
+
+import itertools
+
+import spillcache
+import spillcomp
+import spillport
+import spillprof
+import spilltypes
+
+debug = 0
+
+# lists shorter than this are mapped serially
+MIN_PARALLEL = 1000
+
+# how many worker processes to use; None means one per core
+PROCESSES = None
+
+# how many chunks to split a list into, per worker process
+CHUNKS_PER_PROCESS = 4
+
+class Unshippable(Exception):
+    """ something can't be sent to a worker process """
+
+#---------------------------------------------------------------------
+# shipping closures
+
+def fnLocals(params, body):
+    """ the variables local to a fn: its parameters, and those
+    (def)ined directly in its body
+    @return [set of str]
+    """
+    fixed, rest = spillcomp.splitParams(params)
+    names = set(fixed)
+    if rest is not None: names.add(rest)
+    names.update(spillcomp.localDefs(body))
+    return names
+
+def freeSymbols(params, body):
+    """ the symbols in the body of a fn taking (params), not counting
+    quoted data, or variables local to the fn or to fns nested in it
+    @return [set of str]
+    """
+    names = set()
+    stack = [(body, frozenset(fnLocals(params, body)))]
+    while stack:
+        x, bound = stack.pop()
+        cls = x.__class__
+        if cls is str:
+            if x not in bound: names.add(x)
+        elif cls is tuple and len(x)>0:
+            h = x[0]
+            if h=='quote': continue
+            if h=='fn' and len(x)==3:
+                inner = bound | fnLocals(x[1], x[2])
+                stack.append((x[2], inner))
+                continue
+            for e in x: stack.append((e, bound))
+    return names
+
+def shipClosure(closure):
+    """ describe a closure so that it can be rebuilt in another
+    process
+    @param closure [spill.Closure|spillcomp.CompiledClosure] possibly
+       wrapped by a GlobalHook
+    @return [list of (params, body, bindings)] the closure, followed
+       by any closures it refers to. (bindings) is a dict giving,
+       for each variable the body uses, ('closure', ix) for closure
+       number (ix) of the list, ('primitive', name) for a primitive,
+       or ('value', v) for data encoded by spillcache.encode().
+    """
+    import spill
+    table = []
+    ids = {}
+    todo = []
+    def closureRef(c):
+        ix = ids.get(id(c))
+        if ix is None:
+            ix = ids[id(c)] = len(table)
+            table.append(None)
+            todo.append((ix, c))
+        return ('closure', ix)
+
+    closureRef(spillprof.unwrapped(closure))
+    while todo:
+        ix, c = todo.pop()
+        bindings = {}
+        for name in freeSymbols(c.params, c.body):
+            try:
+                v = c.env.get(name)
+            except Exception:
+                # VariableNotFound: a special form, or a local
+                # variable of the body
+                continue
+            v = spillprof.unwrapped(v)
+            if spilltypes.isClosure(v):
+                bindings[name] = closureRef(v)
+            elif isinstance(v, spill.Primitive):
+                bindings[name] = ('primitive', v.desc)
+            elif callable(v):
+                raise Unshippable("can't send the function '%s'" % (name,))
+            else:
+                try:
+                    bindings[name] = ('value', spillcache.encode(v))
+                except spillcache.Uncacheable:
+                    raise Unshippable("can't send the value of '%s'"
+                                      % (name,))
+        try:
+            table[ix] = (spillcache.encode(c.params),
+                         spillcache.encode(c.body), bindings)
+        except spillcache.Uncacheable:
+            raise Unshippable("can't send %r" % (c,))
+    #//while
+    return table
+
+def rebuildClosure(si, table):
+    """ the inverse of shipClosure()
+    @param si [spill.SpillSys] where to rebuild it
+    @param table [list] as returned by shipClosure()
+    @return the closure
+    """
+    import spill
+    closures = []
+    envs = []
+    for params, body, bindings in table:
+        env = spill.Environment(si.globalEnv)
+        fn = ('fn', spillcache.decode(params), spillcache.decode(body))
+        if si.compiler:
+            # its free variables are in (env), which the compiler
+            # can't know about, so they're looked up by name
+            closures.append(si.compiler.compile(fn, spillcomp.DYNAMIC)(env))
+        else:
+            closures.append(spill.seval(fn, env))
+        envs.append(env)
+    for (params, body, bindings), env in zip(table, envs):
+        for name, (kind, v) in bindings.items():
+            if kind=='closure':
+                env.define(name, closures[v])
+            elif kind=='primitive':
+                env.define(name, si.globalEnv.get(v))
+            else:
+                env.define(name, spillcache.decode(v))
+    return closures[0]
+
+#---------------------------------------------------------------------
+# worker processes
+
+# in a worker process, its SpillSys
+workerSys = None
+
+# in a worker process, the last (job, closure) it rebuilt
+workerJob = (None, None)
+
+def initWorker(engine, library):
+    global workerSys
+    import spill
+    workerSys = spill.SpillSys(engine=engine, library=library)
+
+def runChunk(args):
+    """ map a shipped closure over a chunk of a list, in a worker
+    @param args [job, table, items] (job) identifies the pmap
+       call, so the closure is only rebuilt once per worker
+    @return [list|Unshippable] the encoded results, or an Unshippable
+       saying why a result couldn't be encoded
+    """
+    global workerJob
+    job, table, items = args
+    if workerJob[0]!=job:
+        workerJob = (job, rebuildClosure(workerSys, table))
+    f = workerJob[1]
+    encode, decode = spillcache.encode, spillcache.decode
+    try:
+        try:
+            return [encode(f(decode(x))) for x in items]
+        except spillcache.Uncacheable, e:
+            # let the caller fall back to mapping serially
+            return Unshippable("can't send a result back: %s" % (e,))
+    finally:
+        # workers don't exit normally, so anything left in the buffer
+        # would be lost
+        spillport.flushOutput()
+
+# process pools, by engine
+pools = {}
+
+jobCounter = itertools.count()
+
+def getPool(engine, library):
+    """ the pool of worker processes for an engine, creating it if
+    need be
+    @return [multiprocessing.Pool] or None if we can't have one
+    """
+    pool = pools.get(engine)
+    if pool is not None or workerSys is not None: return pool
+    try:
+        import multiprocessing
+        processes = PROCESSES or multiprocessing.cpu_count()
+        if processes < 2: return None
+        pool = multiprocessing.Pool(processes, initWorker,
+                                    (engine, library))
+    except (ImportError, NotImplementedError, OSError):
+        return None
+    pool.processes = processes
+    pools[engine] = pool
+    return pool
+
+def closePools():
+    """ shut down the worker processes """
+    for pool in pools.values():
+        pool.close()
+        pool.join()
+    pools.clear()
+
+#---------------------------------------------------------------------
+
+def pmap(f, a, serialMap, library):
+    """ (pmap f a) => a list of (f x) for each x in a, computed in
+    parallel. If a is a vector, so is the result.
+    @param serialMap [function] map(f, a) done serially
+    @param library [str] the library the worker processes load
+    """
+    isVector = a.__class__ is spilltypes.Vector
+    if isVector:
+        items = a.tolist()
+    else:
+        items = spilltypes.listItems(a)
+    g = spillprof.unwrapped(f)
+    if len(items) < MIN_PARALLEL or not spilltypes.isClosure(g):
+        return serialMap(f, a)
+    try:
+        table = shipClosure(g)
+        encoded = [spillcache.encode(x) for x in items]
+    except (Unshippable, spillcache.Uncacheable), e:
+        if debug: print "pmap: running serially: %s" % (e,)
+        return serialMap(f, a)
+    engine = 'seval'
+    if isinstance(g, spillcomp.CompiledClosure): engine = 'compile'
+    pool = getPool(engine, library)
+    if pool is None: return serialMap(f, a)
+
+    job = next(jobCounter)
+    nchunks = pool.processes * CHUNKS_PER_PROCESS
+    size = max(1, -(-len(encoded) // nchunks))
+    chunks = [(job, table, encoded[i:i+size])
+              for i in xrange(0, len(encoded), size)]
+    results = []
+    for chunk in pool.map(runChunk, chunks):
+        if isinstance(chunk, Unshippable):
+            if debug: print "pmap: running serially: %s" % (chunk,)
+            return serialMap(f, a)
+        results.extend([spillcache.decode(r) for r in chunk])
+    if isVector: return spilltypes.toVector(results)
+    return spilltypes.toCons(results)
+
+#end
@@ -0,0 +1,271 @@
+# spillport.py = output ports
+
+""" Output ports
+
+Spill programs write output to a port: stdout, a file, or a string in
+memory. Each thread has a current output port, which (pr ...) writes
+to; it starts off as stdout.
+
+   (pr x ...)               write each x as showStr() displays it
+   (display x [port])       the same, for one value
+   (write x [port])         write x as show() displays it
+   (newline [port])
+   (current-output-port)
+   (set-output-port! port)  make (port) the current output port,
+                            returning the one it replaces
+   (with-output-to port f)  call (f) with (port) as the current port
+   (open-output-file filename)
+   (open-output-string)
+   (get-output-string port) what has been written to a string port
+   (flush-output [port])
+   (close-port port)
+
+A port collects what's written to it in a buffer, and writes it out
+in one go when there's BUFFER_SIZE bytes of it, or it's flushed or
+closed. Values are written a piece at a time (see
+spilltypes.writeShow()) rather than being turned into one big string
+first, so writing a large structure doesn't need memory in
+proportion to its size. SpillSys flushes the current port after each
+readEval() and loadFile(). A file port that isn't closed is flushed
+when it's garbage collected, or failing that when Python exits.
+"""
+
+import atexit
+import sys
+import threading
+import weakref
+
+import spilltypes
+
+debug = 0
+
+# how much output a port collects before writing it
+BUFFER_SIZE = 8192
+
+class PortError(Exception):
+    """ a closed port was written to """
+
+#---------------------------------------------------------------------
+
+class Port(spilltypes.SpillType):
+    """ an output port, writing to a file """
+    __slots__ = ('f', 'name', 'buffer', 'size', 'bufferSize', 'closed',
+                 '__weakref__')
+
+    def __init__(self, f, name, bufferSize=BUFFER_SIZE):
+        """
+        @param f [file] where to write to
+        @param name [str] what to show it as
+        @param bufferSize [int] how much to collect before writing
+        """
+        self.f = f
+        self.name = name
+        self.buffer = []
+        self.size = 0
+        self.bufferSize = bufferSize
+        self.closed = False
+
+    def show(self):
+        return "#<port %s>" % (self.name,)
+    showStr = show
+
+    def __repr__(self):
+        return self.show()
+
+    def write(self, s):
+        """ write a str """
+        if self.closed: raise PortError("%s is closed" % (self.show(),))
+        self.buffer.append(s)
+        self.size += len(s)
+        if self.size >= self.bufferSize: self.flush()
+
+    def flush(self):
+        """ write out what's in the buffer """
+        if not self.buffer: return
+        # swap in a new buffer before writing the old one, so that
+        # anything another thread writes meanwhile isn't lost
+        buffer = self.buffer
+        self.buffer = []
+        self.size = 0
+        f = self.file()
+        f.write("".join(buffer))
+        f.flush()
+
+    def file(self):
+        return self.f
+
+    def close(self):
+        if self.closed: return
+        self.flush()
+        self.closed = True
+        self.file().close()
+
+    def __del__(self):
+        # so that what's buffered isn't lost if we're never closed
+        try:
+            self.flush()
+        except Exception:
+            pass
+
+class StdoutPort(Port):
+    """ writes to whatever sys.stdout is when it's flushed """
+    __slots__ = ()
+
+    def __init__(self):
+        Port.__init__(self, None, "stdout")
+
+    def file(self):
+        return sys.stdout
+
+    def close(self):
+        # closing stdout would stop anything else writing to it
+        self.flush()
+
+class StringPort(Port):
+    """ collects what's written to it in memory """
+    __slots__ = ()
+
+    def __init__(self):
+        Port.__init__(self, None, "string")
+
+    def write(self, s):
+        if self.closed: raise PortError("%s is closed" % (self.show(),))
+        self.buffer.append(s)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def getvalue(self):
+        """ what has been written so far
+        @return [str]
+        """
+        s = "".join(self.buffer)
+        self.buffer = [s]
+        return s
+
+def openFile(filename, mode="w"):
+    """ a port writing to a file
+    @param mode [str] "w" to overwrite it, "a" to add to the end
+    @return [Port]
+    """
+    port = Port(open(filename, mode), filename)
+    openPorts.add(port)
+    return port
+
+# the file ports that haven't been garbage collected, to flush at exit
+openPorts = weakref.WeakSet()
+
+def flushAll():
+    """ flush all the file ports, and stdout """
+    for port in list(openPorts):
+        if not port.closed: port.flush()
+    stdoutPort.flush()
+
+#---------------------------------------------------------------------
+# the current output port
+
+stdoutPort = StdoutPort()
+atexit.register(flushAll)
+
+current = threading.local()
+
+def currentPort():
+    """ this thread's current output port """
+    return getattr(current, 'port', stdoutPort)
+
+def setPort(port):
+    """ make (port) this thread's current output port
+    @return [Port] the one it replaces
+    """
+    old = currentPort()
+    current.port = port
+    return old
+
+def flushOutput():
+    """ flush this thread's current output port """
+    currentPort().flush()
+
+#---------------------------------------------------------------------
+# primitives
+
+def requirePort(name, port):
+    if not isinstance(port, Port):
+        raise TypeError("%s: %s is not a port"
+                        % (name, spilltypes.show(port)))
+    return port
+
+def pr(*args):
+    """ (pr x ...) => write each x to the current output port, as
+    showStr() displays it. Returns the last argument.
+    """
+    write = currentPort().write
+    for arg in args:
+        spilltypes.writeShowStr(write, arg)
+    if args: return args[-1]
+    return spilltypes.NIL
+
+def display(x, port=None):
+    """ (display x [port]) => write x as showStr() displays it """
+    if port is None: port = currentPort()
+    spilltypes.writeShowStr(requirePort('display', port).write, x)
+    return x
+
+def write(x, port=None):
+    """ (write x [port]) => write x as show() displays it """
+    if port is None: port = currentPort()
+    spilltypes.writeShow(requirePort('write', port).write, x)
+    return x
+
+def newline(port=None):
+    if port is None: port = currentPort()
+    requirePort('newline', port).write("\n")
+    return spilltypes.NIL
+
+def setOutputPort(port):
+    """ (set-output-port! port) => the output port it replaces """
+    return setPort(requirePort('set-output-port!', port))
+
+def withOutputTo(port, f):
+    """ (with-output-to port f) => (f), called with (port) as the
+    current output port
+    """
+    old = setPort(requirePort('with-output-to', port))
+    try:
+        return f()
+    finally:
+        setPort(old)
+
+def getOutputString(port):
+    if not isinstance(port, StringPort):
+        raise TypeError("get-output-string: %s is not a string port"
+                        % (spilltypes.show(port),))
+    return spilltypes.LStr(port.getvalue())
+
+def flushPort(port=None):
+    if port is None: port = currentPort()
+    requirePort('flush-output', port).flush()
+    return port
+
+def closePort(port):
+    requirePort('close-port', port).close()
+    return port
+
+primitives = {
+    'pr': pr,
+    'display': display,
+    'write': write,
+    'newline': newline,
+    'current-output-port': currentPort,
+    'set-output-port!': setOutputPort,
+    'with-output-to': withOutputTo,
+    'open-output-file': openFile,
+    'open-output-string': StringPort,
+    'get-output-string': getOutputString,
+    'flush-output': flushPort,
+    'close-port': closePort,
+}
+
+#end
@@ -0,0 +1,316 @@
+# spillprof.py = a profiler for Spill programs
+
+""" The profiler
+
+   prof = si.startProfiling()
+   si.readEval("(main)")
+   si.stopProfiling()
+   print prof.report()
+   prof.dumpStats("main.prof")   # for python -m pstats
+
+While profiling, every closure and primitive bound to a global
+variable is replaced by a ProfiledFunction wrapping it, which records
+how many times it is called and how long the calls take; anything
+(def)ined while profiling is wrapped as it's defined. Stopping puts
+the originals back. Nothing is changed when the profiler isn't
+running, so it costs nothing then. The tracer (spilltrace.py) works
+the same way, using GlobalHook.
+
+For each function it records:
+- calls: how many times it was called
+- frames: how many environment frames were allocated from when it
+  was called until it returned. Each call of a closure allocates one
+  (an Environment when run by seval, a Frame when compiled), so this
+  counts the calls of profiled closures, its own included.
+- inclusive time: the time from when it was called until it returned
+- exclusive time: the inclusive time, less the time spent in other
+  profiled functions it called
+
+Closures are known by the name they were (def)ined with. Calls that
+don't go through a global variable, e.g. of a closure passed as an
+argument, are included in their caller's times, and the frames they
+allocate aren't counted.
+
+In a SpillSys spawned from a frozen base, the wrappers are bound in
+its own global environment, and the base's variables are made to
+refer to them while it's running (the way set! copies a variable out
+of the base), so calls that functions in the base library make to
+each other are profiled too.
+
+Calls of profiled functions use Python stack, so a deep tail-recursive
+loop may run out of stack while being profiled.
+"""
+
+import marshal
+import timeit
+
+import spilltypes
+
+debug = 0
+
+timer = timeit.default_timer
+
+#---------------------------------------------------------------------
+
+class FunctionStats(object):
+    """ what the profiler has recorded about one function """
+    __slots__ = ('name', 'kind', 'calls', 'primitiveCalls', 'frames',
+                 'inclusive', 'exclusive', 'active', 'callers')
+
+    def __init__(self, name, kind):
+        """
+        @param name [str]
+        @param kind [str] 'closure' or 'primitive'
+        """
+        self.name = name
+        self.kind = kind
+        self.calls = 0
+        self.primitiveCalls = 0   # calls not made from within itself
+        self.frames = 0
+        self.inclusive = 0.0
+        self.exclusive = 0.0
+        self.active = 0           # calls in progress
+        self.callers = {}         # caller -> [calls, exclusive, inclusive]
+
+    def key(self):
+        """ how pstats identifies this function """
+        return ("<spill %s>" % (self.kind,), 0, self.name)
+
+#---------------------------------------------------------------------
+# wrapping the functions in a global environment
+
+class Wrapper(object):
+    """ a function bound to a global variable, wrapped by a GlobalHook
+    so it can record its calls. Wrappers can be wrapped in turn, if
+    more than one hook is running.
+    """
+    __slots__ = ('f', 'hook')
+
+    def __repr__(self):
+        return repr(self.f)
+
+def unwrapped(value):
+    """ the function inside any Wrappers """
+    while isinstance(value, Wrapper): value = value.f
+    return value
+
+def hasHook(value, hook):
+    """ is (value) wrapped by (hook)? """
+    while isinstance(value, Wrapper):
+        if value.hook is hook: return True
+        value = value.f
+    return False
+
+def withoutHook(value, hook):
+    """ (value), without any of (hook)'s Wrappers """
+    if not isinstance(value, Wrapper): return value
+    inner = withoutHook(value.f, hook)
+    if value.hook is hook: return inner
+    value.f = inner
+    return value
+
+class GlobalHook:
+    """ wraps the closures and primitives bound to the variables of
+    a global environment while it's running, including any that are
+    (def)ined meanwhile, and puts them back when it stops. Subclasses
+    say how, with makeWrapper().
+    """
+
+    def __init__(self, env):
+        """
+        @param env [spill.Environment] the global environment
+        """
+        self.env = env
+        self.wrapped = set()
+        self.running = False
+
+    def makeWrapper(self, name, f, kind):
+        """ wrap a function
+        @param name [str] its name
+        @param f the function, possibly already wrapped by another hook
+        @param kind [str] 'closure' or 'primitive'
+        @return [Wrapper]
+        """
+        raise NotImplementedError
+
+    def wrap(self, name, value):
+        """ the value to bind to a global variable while running.
+        Environment.define() calls this for each new binding.
+        @param name [str] the variable
+        @param value the value being bound to it
+        """
+        if name.startswith("macro~") or not callable(value) \
+               or hasHook(value, self):
+            return value
+        self.wrapped.add(name)
+        f = unwrapped(value)
+        if spilltypes.isClosure(f):
+            return self.makeWrapper(getattr(f, 'name', None) or name,
+                                    value, 'closure')
+        return self.makeWrapper(name, value, 'primitive')
+
+    def start(self):
+        if self.running: return
+        self.running = True
+        env = self.env
+        for name, value in env.bindings().items():
+            w = self.wrap(name, value)
+            if w is not value:
+                # this goes in our own environment even if (name) is
+                # in a frozen one it's shared with, and code defined
+                # there is made to call it too
+                shared = name not in env.data
+                env.bind(name, w)
+                if shared: env.addCopy(name)
+        env.hooks = env.hooks + (self,)
+
+    def stop(self):
+        """ stop, putting back the functions we wrapped """
+        if not self.running: return
+        self.running = False
+        env = self.env
+        env.hooks = tuple([h for h in env.hooks if h is not self])
+        for name in self.wrapped:
+            v = env.data.get(name)
+            if not hasHook(v, self): continue
+            v = withoutHook(v, self)
+            if env.parent is not None and env.parent.has(name) \
+                   and env.parent.get(name) is v:
+                env.unbind(name)
+                env.dropCopy(name)
+            else:
+                env.bind(name, v)
+        self.wrapped = set()
+
+#---------------------------------------------------------------------
+
+class ProfiledFunction(Wrapper):
+    """ a closure or primitive, wrapped so its calls are recorded """
+    __slots__ = ('stats', 'isClosure')
+
+    def __init__(self, f, stats, profiler):
+        self.f = f
+        self.stats = stats
+        self.hook = profiler
+        self.isClosure = stats.kind=='closure'
+
+    def __call__(self, *args):
+        prof = self.hook
+        stats = self.stats
+        stack = prof.stack
+        frames0 = prof.frames
+        # a closure allocates a frame for each call
+        if self.isClosure: prof.frames += 1
+        outermost = stats.active==0
+        stats.active += 1
+        # time spent in the profiled functions this call calls
+        record = [0.0, stats]
+        stack.append(record)
+        t0 = timer()
+        try:
+            return self.f(*args)
+        finally:
+            t = timer() - t0
+            stack.pop()
+            stats.active -= 1
+            stats.calls += 1
+            exclusive = t - record[0]
+            stats.exclusive += exclusive
+            if outermost:
+                stats.primitiveCalls += 1
+                stats.inclusive += t
+                stats.frames += prof.frames - frames0
+            if stack:
+                caller = stack[-1]
+                caller[0] += t
+                edge = stats.callers.get(caller[1].name)
+                if edge is None:
+                    edge = stats.callers[caller[1].name] = [0, 0.0, 0.0]
+                edge[0] += 1
+                edge[1] += exclusive
+                edge[2] += t
+
+class Profiler(GlobalHook):
+    """ profiles calls made through the variables of a global
+    environment
+    """
+
+    def __init__(self, env):
+        """
+        @param env [spill.Environment] the global environment
+        """
+        GlobalHook.__init__(self, env)
+        self.stats = {}     # name -> FunctionStats
+        self.stack = []     # [child time, FunctionStats] per active call
+        self.frames = 0     # frames allocated by profiled closures so far
+
+    def statsFor(self, name, kind):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = FunctionStats(name, kind)
+        return stats
+
+    def makeWrapper(self, name, f, kind):
+        return ProfiledFunction(f, self.statsFor(name, kind), self)
+
+    def clear(self):
+        """ forget what has been recorded so far """
+        for s in self.stats.values():
+            s.__init__(s.name, s.kind)
+        self.frames = 0
+
+    #========================================================
+    # output
+
+    SORT_KEYS = {
+        'exclusive': lambda s: -s.exclusive,
+        'inclusive': lambda s: -s.inclusive,
+        'calls': lambda s: -s.calls,
+        'frames': lambda s: -s.frames,
+        'name': lambda s: s.name,
+    }
+
+    def report(self, sortBy='exclusive', limit=None):
+        """ a table of what's been recorded
+        @param sortBy [str] 'exclusive', 'inclusive', 'calls',
+           'frames' or 'name'
+        @param limit [int] show only this many functions
+        @return [str]
+        """
+        rows = [s for s in self.stats.values() if s.calls]
+        rows.sort(key=self.SORT_KEYS[sortBy])
+        if limit is not None: rows = rows[:limit]
+        lines = ["%10s %10s %12s %12s  %s" % (
+            "calls", "frames", "inclusive", "exclusive", "function")]
+        for s in rows:
+            name = s.name
+            if s.kind=='primitive': name += " (primitive)"
+            lines.append("%10d %10d %12.6f %12.6f  %s" % (
+                s.calls, s.frames, s.inclusive, s.exclusive, name))
+        return "\n".join(lines) + "\n"
+
+    def pstatsData(self):
+        """ what's been recorded, as the pstats module stores it
+        @return [dict]
+        """
+        data = {}
+        for s in self.stats.values():
+            if not s.calls: continue
+            callers = {}
+            for callerName, (n, tt, ct) in s.callers.items():
+                callers[self.stats[callerName].key()] = (n, n, tt, ct)
+            data[s.key()] = (s.primitiveCalls, s.calls, s.exclusive,
+                             s.inclusive, callers)
+        return data
+
+    def dumpStats(self, filename):
+        """ write what's been recorded to a file that pstats.Stats
+        can read
+        """
+        f = open(filename, "wb")
+        try:
+            marshal.dump(self.pstatsData(), f)
+        finally:
+            f.close()
+
+#end
@@ -0,0 +1,360 @@
+# spillserver.py = a server that evaluates Spill programs, and a client
+
+""" Evaluation server
+
+   $ python spillserver.py serve localhost:7474
+   $ python spillserver.py client localhost:7474 prog.l
+   $ echo "(+ 1 2)" | python spillserver.py client localhost:7474
+   3
+
+(or "spill serve ..."). The address is either host:port, for TCP, or
+the pathname of a Unix socket.
+
+The server keeps a pool of ready SpillSys instances, spawned from one
+base instance that has the library loaded (see SpillSys.spawn()).
+Each request gets an instance of its own, which is thrown away
+afterwards, so no request sees another's definitions. Each connection
+is handled by a thread of its own.
+
+The protocol: a connection carries any number of requests, each
+answered in turn. A request is
+
+   <command> <length>\\n<length bytes of data>
+
+where <command> is "eval" (the data is a program, whose value -- the
+value of its last form -- is returned) or "stats" (the data is empty).
+The reply has the same layout:
+
+   <status> <length>\\n<length bytes of data>
+
+where <status> is "ok" or "error", and the data is the result as
+spilltypes.show() displays it, or an error message. If the program
+wrote anything to its current output port, e.g. with (pr ...), that
+comes first, in a frame whose <status> is "output". Each request
+writes to a port of its own, which is thrown away afterwards with the
+instance.
+"""
+
+import os
+import Queue
+import socket
+import SocketServer
+import stat
+import sys
+import threading
+import time
+
+import spill
+import spillport
+import spilltypes
+
+debug = 0
+
+DEFAULT_ADDRESS = "localhost:7474"
+
+class ProtocolError(Exception):
+    """ a badly-formed request or reply """
+
+class SpillServerError(Exception):
+    """ the server couldn't evaluate a program """
+
+#---------------------------------------------------------------------
+# the protocol
+
+def parseAddress(address):
+    """ parse a server address
+    @param address [str] "host:port", or the pathname of a Unix socket
+    @return [(str,int)|str]
+    """
+    if "/" not in address and ":" in address:
+        host, port = address.rsplit(":", 1)
+        return host, int(port)
+    return address
+
+def readFrame(f):
+    """ read a request or reply
+    @param f [file]
+    @return [str,str] the command or status, and the data; or None
+       if the connection has been closed
+    """
+    header = f.readline()
+    if not header: return None
+    try:
+        word, length = header.split()
+        length = int(length)
+    except ValueError:
+        raise ProtocolError("bad header %r" % (header,))
+    data = f.read(length)
+    if len(data)!=length:
+        raise ProtocolError("connection closed part-way through")
+    return word, data
+
+def writeFrame(f, word, data):
+    f.write("%s %d\n" % (word, len(data)))
+    f.write(data)
+    f.flush()
+
+#---------------------------------------------------------------------
+# the server
+
+class InterpreterPool:
+    """ a supply of fresh SpillSys instances """
+
+    def __init__(self, size=8, engine='seval', library=spill.LIBRARY):
+        """
+        @param size [int] how many instances to keep ready
+        """
+        self.base = spill.SpillSys(engine=engine, library=library).freeze()
+        self.size = size
+        self.ready = Queue.Queue()
+        for i in range(size): self.ready.put(self.base.spawn())
+
+    def get(self):
+        """ an instance no-one else has used
+        @return [SpillSys]
+        """
+        try:
+            return self.ready.get_nowait()
+        except Queue.Empty:
+            return self.base.spawn()
+
+    def replenish(self):
+        """ make another instance ready, if we're short of them """
+        if self.ready.qsize() < self.size:
+            self.ready.put(self.base.spawn())
+
+class SpillRequestHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        server = self.server
+        while True:
+            try:
+                frame = readFrame(self.rfile)
+            except ProtocolError, e:
+                writeFrame(self.wfile, "error", str(e))
+                return
+            if frame is None: return
+            status, reply, output = server.execute(frame[0], frame[1])
+            if output: writeFrame(self.wfile, "output", output)
+            writeFrame(self.wfile, status, reply)
+            # get ready for the next one after replying, rather
+            # than before
+            server.pool.replenish()
+
+class SpillServerMixin:
+    """ what TCP and Unix socket servers have in common """
+
+    daemon_threads = True
+
+    def setUpSpill(self, pool):
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.evalTime = 0.0
+
+    def execute(self, command, data):
+        """ carry out a request
+        @return [str,str,str] the status, the reply, and what the
+           program wrote to its output port
+        """
+        if command=="stats":
+            return "ok", self.statsLine(), ""
+        if command!="eval":
+            return "error", "unknown command %r" % (command,), ""
+        si = self.pool.get()
+        port = spillport.StringPort()
+        # the connection's thread handles later requests too, so
+        # even a (set-output-port! ...) doesn't outlast this one
+        oldPort = spillport.setPort(port)
+        t0 = time.time()
+        try:
+            try:
+                status = "ok"
+                reply = spilltypes.show(si.readEval(data))
+            except Exception, e:
+                status = "error"
+                reply = "%s: %s" % (e.__class__.__name__, e)
+        finally:
+            spillport.setPort(oldPort)
+        t = time.time() - t0
+        self.lock.acquire()
+        try:
+            self.requests += 1
+            if status=="error": self.errors += 1
+            self.evalTime += t
+        finally:
+            self.lock.release()
+        if debug: print "%s %.6fs %r" % (status, t, data[:60])
+        return status, reply, port.getvalue()
+
+    def statsLine(self):
+        """ how busy we've been, as "name=value ..." """
+        return "requests=%d errors=%d evalTime=%.6f uptime=%.3f" % (
+            self.requests, self.errors, self.evalTime,
+            time.time() - self.started)
+
+class TCPSpillServer(SpillServerMixin, SocketServer.ThreadingMixIn,
+                     SocketServer.TCPServer):
+    allow_reuse_address = True
+
+class UnixSpillServer(SpillServerMixin, SocketServer.ThreadingMixIn,
+                      SocketServer.UnixStreamServer):
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+def makeServer(address=DEFAULT_ADDRESS, pool=None):
+    """ create a server. Call its serve_forever() method to run it.
+    @param address [str] see parseAddress(). For TCP, a port of 0
+       picks any free port; the server's server_address says which.
+    @param pool [InterpreterPool] defaults to a new one
+    """
+    if pool is None: pool = InterpreterPool()
+    addr = parseAddress(address)
+    if isinstance(addr, tuple):
+        server = TCPSpillServer(addr, SpillRequestHandler)
+    else:
+        # a socket left over from a previous run would stop us binding
+        if os.path.exists(addr) and stat.S_ISSOCK(os.stat(addr).st_mode):
+            os.remove(addr)
+        server = UnixSpillServer(addr, SpillRequestHandler)
+    server.setUpSpill(pool)
+    return server
+
+#---------------------------------------------------------------------
+# the client
+
+class SpillClient:
+    """ a connection to a server """
+
+    def __init__(self, address=DEFAULT_ADDRESS):
+        addr = parseAddress(address)
+        if isinstance(addr, tuple):
+            self.sock = socket.create_connection(addr)
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(addr)
+        self.rfile = self.sock.makefile("rb")
+        self.wfile = self.sock.makefile("wb")
+        self.output = ""   # what the last program wrote
+
+    def request(self, command, data=""):
+        """ send a request and wait for the reply. Any output that
+        comes before it goes in self.output.
+        @return [str,str] the status and reply
+        """
+        writeFrame(self.wfile, command, data)
+        self.output = ""
+        while True:
+            frame = readFrame(self.rfile)
+            if frame is None:
+                raise SpillServerError("the server closed the connection")
+            if frame[0]!="output": return frame
+            self.output += frame[1]
+
+    def eval(self, program):
+        """ evaluate a program on the server
+        @param program [str] Spill source code
+        @return [str] the value of its last form, as shown by
+           spilltypes.show(). What it wrote is in self.output.
+        """
+        status, reply = self.request("eval", program)
+        if status!="ok": raise SpillServerError(reply)
+        return reply
+
+    def stats(self):
+        """ how busy the server has been
+        @return [dict]
+        """
+        status, reply = self.request("stats")
+        result = {}
+        for item in reply.split():
+            name, value = item.split("=")
+            result[name] = float(value)
+        return result
+
+    def close(self):
+        self.rfile.close()
+        self.wfile.close()
+        self.sock.close()
+
+def loadTest(address, program, requests=1000, concurrency=8):
+    """ send (requests) copies of (program) to a server, from
+    (concurrency) connections at once
+    @return [float] requests per second
+    """
+    perThread = max(1, requests // concurrency)
+    errors = []
+    def run():
+        client = SpillClient(address)
+        try:
+            for i in xrange(perThread):
+                client.eval(program)
+        except Exception, e:
+            errors.append(e)
+        client.close()
+    threads = [threading.Thread(target=run) for i in range(concurrency)]
+    t0 = time.time()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    t = time.time() - t0
+    if errors: raise errors[0]
+    return perThread * concurrency / t
+
+#---------------------------------------------------------------------
+
+USAGE = """usage:
+   spillserver.py serve [address] [engine]
+   spillserver.py client [address] [file ...]
+   spillserver.py load [address] [requests] [concurrency] < program"""
+
+def main(args):
+    if not args or args[0] not in ("serve", "client", "load"):
+        print USAGE
+        return 2
+    command, args = args[0], args[1:]
+    address = DEFAULT_ADDRESS
+    if args: address, args = args[0], args[1:]
+    if command=="serve":
+        engine = 'seval'
+        if args: engine = args[0]
+        server = makeServer(address, InterpreterPool(engine=engine))
+        print "serving on %s" % (address,)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+    elif command=="client":
+        if args:
+            programs = [open(filename).read() for filename in args]
+        else:
+            programs = [sys.stdin.read()]
+        client = SpillClient(address)
+        try:
+            for program in programs:
+                value = client.eval(program)
+                sys.stdout.write(client.output)
+                print value
+        except SpillServerError, e:
+            sys.stdout.write(client.output)
+            print "error: %s" % (e,)
+            return 1
+        client.close()
+    else:
+        program = sys.stdin.read()
+        requests = 1000
+        concurrency = 8
+        if args: requests = int(args[0])
+        if args[1:]: concurrency = int(args[1])
+        rate = loadTest(address, program, requests, concurrency)
+        print "%.1f requests/s" % (rate,)
+    return 0
+
+if __name__=='__main__':
+    sys.exit(main(sys.argv[1:]))
+
+#end
@@ -0,0 +1,149 @@
+# spilltrace.py = an event tracer for Spill programs
+
+""" The tracer
+
+   tracer = si.startTracing()
+   si.readEval("(main)")
+   si.stopTracing()
+   tracer.exportChrome("main.json")
+
+and load <main.json> into a trace viewer (chrome://tracing, or
+Perfetto) to see a timeline.
+
+The tracer records an event when each global closure or primitive is
+entered and left (it wraps them, as the profiler does -- see
+spillprof.GlobalHook), when each macro call is expanded, and when each
+file is loaded. Events go into a ring buffer of fixed size, allocated
+when the tracer is created, so only the most recent events are kept
+and tracing a long run doesn't use more and more memory. Tracing can
+be started and stopped at any time.
+"""
+
+from array import array
+import json
+import os
+import thread
+
+import spillprof
+
+debug = 0
+
+# how many events to keep, by default
+DEFAULT_SIZE = 100000
+
+# event categories
+CATEGORIES = ('closure', 'primitive', 'macro', 'load')
+CLOSURE, PRIMITIVE, MACRO, LOAD = range(4)
+
+#---------------------------------------------------------------------
+
+class TracedFunction(spillprof.Wrapper):
+    """ a closure or primitive, wrapped so it's traced """
+    __slots__ = ('name', 'category')
+
+    def __init__(self, f, name, category, tracer):
+        self.f = f
+        self.name = name
+        self.category = category
+        self.hook = tracer
+
+    def __call__(self, *args):
+        tracer = self.hook
+        tracer.record('B', self.category, self.name)
+        try:
+            return self.f(*args)
+        finally:
+            tracer.record('E', self.category, self.name)
+
+class Tracer(spillprof.GlobalHook):
+    """ records events in a ring buffer """
+
+    def __init__(self, env, size=DEFAULT_SIZE):
+        """
+        @param env [spill.Environment] the global environment
+        @param size [int] how many events to keep
+        """
+        spillprof.GlobalHook.__init__(self, env)
+        self.size = size
+        self.phases = array('c', 'E' * size)
+        self.categories = array('B', [0] * size)
+        self.times = array('d', [0.0] * size)
+        self.threads = array('L', [0] * size)
+        self.names = [None] * size
+        self.next = 0     # where the next event goes
+        self.count = 0    # how many events have been recorded
+        self.t0 = spillprof.timer()
+
+    def makeWrapper(self, name, f, kind):
+        if kind=='closure':
+            return TracedFunction(f, name, CLOSURE, self)
+        return TracedFunction(f, name, PRIMITIVE, self)
+
+    def record(self, phase, category, name):
+        """ record an event
+        @param phase [str] 'B' for entering, 'E' for leaving
+        @param category [int] CLOSURE, PRIMITIVE, MACRO or LOAD
+        @param name [str]
+        """
+        i = self.next
+        self.phases[i] = phase
+        self.categories[i] = category
+        self.names[i] = name
+        self.threads[i] = thread.get_ident()
+        self.times[i] = spillprof.timer()
+        i += 1
+        if i==self.size: i = 0
+        self.next = i
+        self.count += 1
+
+    def clear(self):
+        """ forget the events recorded so far """
+        self.next = 0
+        self.count = 0
+
+    #========================================================
+    # output
+
+    def indexes(self):
+        """ the indexes of the events we have, oldest first """
+        if self.count <= self.size: return xrange(self.count)
+        return range(self.next, self.size) + range(0, self.next)
+
+    def traceEvents(self):
+        """ our events, in Chrome trace-event format. Events leaving
+        a function whose entry has been overwritten are left out.
+        @return [list of dict]
+        """
+        pid = os.getpid()
+        depths = {}   # thread -> events entered but not left
+        events = []
+        for i in self.indexes():
+            phase = self.phases[i]
+            tid = self.threads[i]
+            depth = depths.get(tid, 0)
+            if phase=='B':
+                depths[tid] = depth+1
+            elif depth==0:
+                continue
+            else:
+                depths[tid] = depth-1
+            events.append({
+                'name': self.names[i],
+                'cat': CATEGORIES[self.categories[i]],
+                'ph': phase,
+                'ts': (self.times[i] - self.t0) * 1e6,
+                'pid': pid,
+                'tid': tid,
+            })
+        return events
+
+    def exportChrome(self, filename):
+        """ write our events as a Chrome trace-event JSON file """
+        f = open(filename, "w")
+        try:
+            json.dump({'traceEvents': self.traceEvents(),
+                       'displayTimeUnit': 'ms'}, f)
+        finally:
+            f.close()
+
+#end
@@ -7,51 +7,702 @@ function  callable
 string    LStr
 symbol    str
 int       int
-list      list
+list      Pair, or () for the empty list
+vector    Vector
+map       PMap
 
 Notation -- in Spill: (fred (x y) a "hello" 45)
 implemented as Python: ['fred', ['x', 'y'], 'a', LStr("hello"), 45]
+
+Code (as produced by the parser, and as evaluated) uses Python tuples
+for lists, e.g. ('fred', ('x', 'y'), 'a', LStr("hello"), 45). Lists
+that are data -- quoted lists, and the results of list functions --
+are chains of Pairs (cons cells), so that cons, car and cdr take
+constant time. toCons() and toCode() convert between the two, and a
+Pair compares equal to a tuple with the same contents.
+
+A Vector is a sequence of numbers stored in an array, so that
+arithmetic on it is done a whole vector at a time by numpy (or,
+without numpy, by the array module).
+
+A PMap is an immutable hash map, e.g. (hash-map 'a 1 'b 2); updating
+it makes a new map which shares most of its structure with the old
+one. show() displays that map as {a 1 b 2}, but that's only for
+people to read: the reader has no syntax for maps, so it can't be read
+back in.
 """
 
+import array
+import itertools
+import operator
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 #---------------------------------------------------------------------
 """SpillTypes have to implement:
 show() -- equivlent of __repr__
 showStr() -- equivalent of __str__
 """
 
-class SpillType:
+class SpillType(object):
     """ abstract superclass for all spill types that are not
     predefined python types.
     """
-    pass
+    __slots__ = ()
 
-class LStr(SpillType):
-    def __init__(self, s):
-        self.s = s
-    def __eq__(self, anLStr):
-        if not isinstance(anLStr, LStr):
-            raise NotImplemented
-        return self.s==anLStr.s
-    def __ne__(self, anLStr):
-        return not self.__eq__(anLStr)
+class LStr(SpillType, str):
+    """ a Spill string. It is a str, so it takes no more room than one
+    and hashes like one, but it never compares equal to a symbol (a
+    plain str) with the same characters.
+    """
+    __slots__ = ()
+
+    def __eq__(self, other):
+        return other.__class__ is LStr and str.__eq__(self, other)
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    __hash__ = str.__hash__
+
+    @property
+    def s(self):
+        """ the characters, as a plain str """
+        return str.__str__(self)
 
-    def __str__(self): return self.s
-    showStr = __str__
+    def showStr(self):
+        return str.__str__(self)
 
     def __repr__(self):
         return "LStr(%r)" % (self.s,)
 
+    # str's versions of these would return plain strs, i.e. symbols,
+    # so as before LStr was a str, Spill strings don't support them
+    def unsupported(self, *args):
+        raise TypeError("strings don't support that: %s" % (self.show(),))
+    __add__ = __radd__ = __mul__ = __rmul__ = unsupported
+    __getitem__ = __getslice__ = __iter__ = unsupported
+
     def show(self):
-        retval = '"'
-        for ch in self.s:
-            if ch=="\n": retval += r"\n"
-            elif ch=="\\": retval += r"\\"
-            elif ch=='"': retval += r'\"'
+        s = str.__str__(self)
+        for ch, escaped in STRING_ESCAPES:
+            if ch in s: s = s.replace(ch, escaped)
+        return '"' + s + '"'
+
+# how show() escapes characters in strings; the backslash has to come
+# first, so the backslashes the others add aren't escaped again
+STRING_ESCAPES = (("\\", r"\\"), ('"', r'\"'), ("\n", r"\n"))
+
+# interned strings: characters -> LStr
+internedStrings = {}
+
+# strings longer than this aren't interned
+INTERN_MAX_LENGTH = 100
+
+# nor are any more once there are this many
+INTERN_MAX_STRINGS = 10000
+
+def internLStr(s):
+    """ an LStr of the characters (s). For short strings, this is the
+    same LStr each time, so e.g. a string literal that appears in many
+    places in a program is only stored once.
+    @param s [str]
+    @return [LStr]
+    """
+    v = internedStrings.get(s)
+    if v is None:
+        v = LStr(s)
+        if len(s) <= INTERN_MAX_LENGTH \
+               and len(internedStrings) < INTERN_MAX_STRINGS:
+            internedStrings[s] = v
+    return v
+
+#---------------------------------------------------------------------
+# lists
+
+NIL = ()
+
+class Pair(SpillType):
+    """ a cons cell. A list is a chain of Pairs whose last cdr is ()
+    """
+    __slots__ = ('car', 'cdr')
+
+    def __init__(self, car, cdr):
+        self.car = car
+        self.cdr = cdr
+
+    def __iter__(self):
+        x = self
+        while x.__class__ is Pair:
+            yield x.car
+            x = x.cdr
+        if not isNull(x):
+            raise TypeError("not a proper list: %s" % (show(self),))
+
+    def __len__(self):
+        n = 0
+        x = self
+        while x.__class__ is Pair:
+            n += 1
+            x = x.cdr
+        return n
+
+    def __nonzero__(self):
+        return True
+
+    def __eq__(self, other):
+        if isinstance(other, tuple):
+            x = self
+            for item in other:
+                if x.__class__ is not Pair or not (x.car == item):
+                    return False
+                x = x.cdr
+            return isNull(x)
+        if not isinstance(other, Pair): return False
+        a = self; b = other
+        while a.__class__ is Pair and b.__class__ is Pair:
+            if a is b: return True
+            if not (a.car == b.car): return False
+            a = a.cdr; b = b.cdr
+        return a == b
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        # the same as the equivalent tuple, since they compare equal
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return "<list %s>" % (show(self),)
+
+    def show(self):
+        return showList(self)
+    showStr = show
+
+def toCons(items, tail=NIL):
+    """ make a list out of a Python sequence
+    @param items [tuple|list]
+    @param tail [list] what the end of the list points to
+    @return [Pair|()]
+    """
+    r = tail
+    for item in reversed(items):
+        r = Pair(item, r)
+    return r
+
+def toConsDeep(ex):
+    """ convert an s-expression whose lists are tuples into one whose
+    lists are Pairs (e.g. the contents of a quoted list in code)
+    """
+    return rebuildLists(ex, toCons)
+
+def toCode(ex):
+    """ convert an s-expression whose lists may be Pairs (e.g. the
+    result of a macro, or the argument of eval) into code, whose
+    lists are tuples. The contents of (quote ...) forms are data,
+    and are left alone.
+    """
+    return rebuildLists(ex, tuple, keepQuoted=True)
+
+def rebuildLists(ex, makeList, keepQuoted=False):
+    """ rebuild each of the lists in an s-expression, innermost first,
+    using an explicit stack rather than recursion, so that it can be
+    nested as deeply as memory allows
+    @param ex [s-exp]
+    @param makeList [function] makes a list from a Python list of its
+       (rebuilt) items
+    @param keepQuoted [bool] leave the contents of (quote ...) forms
+       alone
+    @return [s-exp]
+    """
+    if ex.__class__ is not Pair and not isinstance(ex, tuple): return ex
+    # for each list being rebuilt: [its items, their rebuilt values]
+    # (the first holds just (ex))
+    stack = [[(ex,), []]]
+    while True:
+        items, done = stack[-1]
+        if len(done) < len(items):
+            e = items[len(done)]
+            if e.__class__ is Pair or isinstance(e, tuple):
+                sub = listItems(e)
+                if keepQuoted and len(sub)==2 and sub[0]=='quote':
+                    done.append(('quote', sub[1]))
+                else:
+                    stack.append([sub, []])
             else:
-                retval += ch
-        #//for
-        retval += '"'
-        return retval
+                done.append(e)
+            continue
+        stack.pop()
+        if not stack: return done[0]
+        stack[-1][1].append(makeList(done))
+
+def listItems(a):
+    """ return the elements of a list
+    @param a [Pair|tuple]
+    @return [list]
+    """
+    if a.__class__ is not Pair: return list(a)
+    r = []
+    while a.__class__ is Pair:
+        r.append(a.car)
+        a = a.cdr
+    return r
+
+def isNull(x):
+    """ is (x) the empty list? """
+    return x.__class__ is tuple and len(x)==0
+
+def isList(x):
+    """ is (x) a list (empty or not)? """
+    return x.__class__ is Pair or isinstance(x, tuple)
+
+#---------------------------------------------------------------------
+# vectors
+
+class Vector(SpillType):
+    """ a vector of numbers, e.g. #(1 2 3).
+
+    The numbers are held in a numpy array if numpy is available, or
+    else in an array.array. Arithmetic operators work elementwise,
+    on two vectors of the same length or on a vector and a number.
+    Integers are held as C longs; a vector with integers too big for
+    that holds floats instead.
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        """
+        @param data [numpy.ndarray|array.array] as made by
+           arrayOf(); not copied
+        """
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __getitem__(self, i):
+        if numpy is not None: return self.data[i].item()
+        return self.data[i]
+
+    def __nonzero__(self):
+        return True
+
+    def __eq__(self, other):
+        if other.__class__ is not Vector: return False
+        return len(self)==len(other) and self.tolist()==other.tolist()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    __hash__ = None
+
+    def tolist(self):
+        """ the elements, as a list of Python numbers """
+        return self.data.tolist()
+
+    def __repr__(self):
+        return "<vector %s>" % (self.show(),)
+
+    def show(self):
+        return showList(self)
+    showStr = show
+
+    #========================================================
+    # arithmetic
+
+    def binop(self, other, op, reverse=False):
+        """ apply (op) elementwise to us and (other)
+        @param other [Vector|number]
+        @param op [function] a binary function, e.g. operator.add
+        @param reverse [bool] apply op(other, self) instead
+        @return [list|numpy.ndarray]
+        """
+        a = self.data
+        if other.__class__ is Vector:
+            b = other.data
+            if len(a)!=len(b):
+                raise ValueError("vectors have different lengths "
+                                 "(%d and %d)" % (len(a), len(b)))
+        elif numpy is not None:
+            b = other
+        else:
+            b = itertools.repeat(other, len(a))
+        if reverse: a, b = b, a
+        if numpy is not None: return op(a, b)
+        return map(op, a, b)
+
+    def arith(self, other, op, reverse=False):
+        if other.__class__ is not Vector and \
+               not isinstance(other, (int, long, float)):
+            return NotImplemented
+        return Vector(arrayOf(self.binop(other, op, reverse)))
+
+    def __add__(self, other): return self.arith(other, operator.add)
+    def __radd__(self, other): return self.arith(other, operator.add, True)
+    def __sub__(self, other): return self.arith(other, operator.sub)
+    def __rsub__(self, other): return self.arith(other, operator.sub, True)
+    def __mul__(self, other): return self.arith(other, operator.mul)
+    def __rmul__(self, other): return self.arith(other, operator.mul, True)
+    def __div__(self, other): return self.arith(other, operator.div)
+    def __rdiv__(self, other): return self.arith(other, operator.div, True)
+
+    def __neg__(self):
+        return self.arith(-1, operator.mul)
+
+    def compare(self, other, op):
+        """ compare elementwise
+        @param op [function] e.g. operator.lt
+        @return [Vector] 1 where the comparison is true, else 0
+        """
+        r = self.binop(other, op)
+        if numpy is not None: return Vector(r.astype(numpy.int_))
+        return Vector(array.array('l', r))
+
+    #========================================================
+    # reductions
+
+    def sum(self):
+        if numpy is not None: return self.data.sum().item()
+        return sum(self.data)
+
+    def min(self):
+        if len(self.data)==0: raise ValueError("min of an empty vector")
+        if numpy is not None: return self.data.min().item()
+        return min(self.data)
+
+    def max(self):
+        if len(self.data)==0: raise ValueError("max of an empty vector")
+        if numpy is not None: return self.data.max().item()
+        return max(self.data)
+
+    def dot(self, other):
+        """ the dot product of two vectors """
+        if other.__class__ is not Vector:
+            raise TypeError("dot: %s isn't a vector" % (show(other),))
+        if numpy is not None: return numpy.dot(self.data, other.data).item()
+        return sum(self.binop(other, operator.mul))
+
+    def slice(self, start, end):
+        """ elements (start) up to but not including (end) """
+        return Vector(self.data[start:end])
+
+def arrayOf(items):
+    """ an array of numbers, for a Vector. Integers are kept as
+    integers, unless there are floats as well.
+    @param items [sequence of number]
+    @return [numpy.ndarray|array.array]
+    """
+    if numpy is not None:
+        a = numpy.asarray(items)
+        if a.dtype.kind not in "iuf":
+            if a.dtype.kind=='b': return a.astype(numpy.int_)
+            if len(a)==0: return a.astype(numpy.int_)
+            raise TypeError("a vector can only hold numbers")
+        return a
+    try:
+        return array.array('l', items)
+    except (TypeError, OverflowError):
+        try:
+            return array.array('d', items)
+        except TypeError:
+            raise TypeError("a vector can only hold numbers")
+
+def toVector(items):
+    """ make a Vector
+    @param items [Vector|list|tuple|Pair|sequence of number]
+    @return [Vector]
+    """
+    if items.__class__ is Vector: return items
+    if items.__class__ is Pair: items = listItems(items)
+    elif not isinstance(items, list): items = list(items)
+    return Vector(arrayOf(items))
+
+def vectorRange(start, end):
+    """ a Vector of the integers (start) to (end) inclusive """
+    if numpy is not None:
+        return Vector(numpy.arange(start, end+1))
+    return Vector(array.array('l', xrange(start, end+1)))
+
+def isVector(x):
+    return x.__class__ is Vector
+
+def isClosure(v):
+    """ is (v) a Spill closure (interpreted or compiled)? """
+    return hasattr(v, 'params') and hasattr(v, 'body') \
+           and hasattr(v, 'env')
+
+#---------------------------------------------------------------------
+# maps
+
+""" A PMap is an immutable map from keys to values, held as a hash
+array mapped trie. Each level of the trie uses BITS more bits of
+the keys' hashes: a MapNode has a slot for each value of those bits
+that some key has, holding either an entry -- a tuple (hash, key,
+value) -- or the MapNode for the keys whose hashes have that prefix.
+Keys whose hashes are all the same go in a Collisions node.
+
+assoc() and dissoc() copy only the nodes on the path to the key
+they change, and share the rest with the map they were made from,
+so they take O(log n) time and space; the trie is never more than
+HASH_BITS/BITS+1 levels deep, so get() is effectively constant time.
+"""
+
+BITS = 5
+MASK = (1 << BITS) - 1
+HASH_BITS = 32
+
+class MapNode(object):
+    """ a node of a PMap's trie """
+    __slots__ = ('bitmap', 'slots')
+
+    def __init__(self, bitmap, slots):
+        """
+        @param bitmap [int] which values of this level's bits are used
+        @param slots [tuple] an entry or node for each bit set in
+           (bitmap), lowest first
+        """
+        self.bitmap = bitmap
+        self.slots = slots
+
+class Collisions(object):
+    """ the entries whose keys have the same hash """
+    __slots__ = ('hash', 'entries')
+
+    def __init__(self, hash, entries):
+        self.hash = hash
+        self.entries = entries
+
+EMPTY_NODE = MapNode(0, ())
+
+def keyHash(key):
+    """ the hash of a key, consistent with how keys compare
+    @return [int] HASH_BITS bits
+    """
+    if key.__class__ is Vector:
+        return hash(tuple(key.tolist())) & 0xffffffff
+    try:
+        return hash(key) & 0xffffffff
+    except TypeError:
+        raise TypeError("can't use %s as a key" % (show(key),))
+
+def bitCount(n):
+    return bin(n).count("1")
+
+def nodeGet(node, h, key):
+    """ the entry for (key), whose hash is (h), in a trie
+    @return [tuple] or None if it's not there
+    """
+    shift = 0
+    while True:
+        if node.__class__ is Collisions:
+            for e in node.entries:
+                if e[1]==key: return e
+            return None
+        bit = 1 << ((h >> shift) & MASK)
+        if not node.bitmap & bit: return None
+        x = node.slots[bitCount(node.bitmap & (bit-1))]
+        if x.__class__ is tuple:
+            if x[0]==h and (x[1] is key or x[1]==key): return x
+            return None
+        node = x
+        shift += BITS
+    #//while
+
+def splitNode(h1, x1, h2, x2, shift):
+    """ a node holding two entries or nodes, whose hashes differ
+    @param h1, h2 [int] their hashes
+    """
+    i1 = (h1 >> shift) & MASK
+    i2 = (h2 >> shift) & MASK
+    if i1==i2:
+        return MapNode(1 << i1, (splitNode(h1, x1, h2, x2, shift+BITS),))
+    if i1 > i2: x1, x2 = x2, x1
+    return MapNode((1 << i1) | (1 << i2), (x1, x2))
+
+def nodeAssoc(node, entry, shift):
+    """ a trie with (entry) added, replacing any entry with the same
+    key
+    @return [node, bool] the new trie (node itself if nothing
+       changed), and whether the key is new
+    """
+    h, key = entry[0], entry[1]
+    if node.__class__ is Collisions:
+        if h!=node.hash:
+            return splitNode(node.hash, node, h, entry, shift), True
+        entries = node.entries
+        for i, e in enumerate(entries):
+            if e[1]==key:
+                if e[2] is entry[2]: return node, False
+                return Collisions(h, entries[:i] + (entry,)
+                                  + entries[i+1:]), False
+        return Collisions(h, entries + (entry,)), True
+    bit = 1 << ((h >> shift) & MASK)
+    ix = bitCount(node.bitmap & (bit-1))
+    slots = node.slots
+    if not node.bitmap & bit:
+        return MapNode(node.bitmap | bit,
+                       slots[:ix] + (entry,) + slots[ix:]), True
+    x = slots[ix]
+    if x.__class__ is tuple:
+        if x[0]==h and (x[1] is key or x[1]==key):
+            if x[2] is entry[2]: return node, False
+            new, added = entry, False
+        elif x[0]==h:
+            new, added = Collisions(h, (x, entry)), True
+        else:
+            new, added = splitNode(x[0], x, h, entry, shift+BITS), True
+    else:
+        new, added = nodeAssoc(x, entry, shift+BITS)
+        if new is x: return node, False
+    return MapNode(node.bitmap, slots[:ix] + (new,) + slots[ix+1:]), added
+
+def nodeDissoc(node, h, key, shift):
+    """ a trie without the entry for (key)
+    @return the new trie: node itself if (key) isn't in it, None if
+       it's empty, or an entry if that's all it holds
+    """
+    if node.__class__ is Collisions:
+        entries = tuple([e for e in node.entries if not e[1]==key])
+        if len(entries)==len(node.entries): return node
+        if len(entries)==1: return entries[0]
+        return Collisions(node.hash, entries)
+    bit = 1 << ((h >> shift) & MASK)
+    if not node.bitmap & bit: return node
+    ix = bitCount(node.bitmap & (bit-1))
+    slots = node.slots
+    x = slots[ix]
+    if x.__class__ is tuple:
+        if not (x[0]==h and (x[1] is key or x[1]==key)): return node
+        new = None
+    else:
+        new = nodeDissoc(x, h, key, shift+BITS)
+        if new is x: return node
+    if new is not None:
+        return MapNode(node.bitmap, slots[:ix] + (new,) + slots[ix+1:])
+    bitmap = node.bitmap & ~bit
+    if bitmap==0: return None
+    slots = slots[:ix] + slots[ix+1:]
+    if len(slots)==1 and slots[0].__class__ is tuple and shift > 0:
+        # the entry can go in our parent, in our place
+        return slots[0]
+    return MapNode(bitmap, slots)
+
+def nodeEntries(node):
+    """ the entries in a trie
+    @return [iterator] of (hash, key, value)
+    """
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if node.__class__ is Collisions:
+            items = node.entries
+        else:
+            items = node.slots
+        for x in items:
+            if x.__class__ is tuple:
+                yield x
+            else:
+                stack.append(x)
+    #//while
+
+class PMap(SpillType):
+    """ an immutable map, e.g. {a 1 b 2}. assoc() and dissoc()
+    return new maps, sharing structure with this one.
+    """
+    __slots__ = ('root', 'count')
+
+    def __init__(self, root=EMPTY_NODE, count=0):
+        """
+        @param root [MapNode] the trie
+        @param count [int] how many entries it holds
+        """
+        self.root = root
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __nonzero__(self):
+        return True
+
+    def get(self, key, default=None):
+        e = nodeGet(self.root, keyHash(key), key)
+        if e is None: return default
+        return e[2]
+
+    def __contains__(self, key):
+        return nodeGet(self.root, keyHash(key), key) is not None
+
+    def assoc(self, key, value):
+        """ this map with (key) bound to (value)
+        @return [PMap]
+        """
+        root, added = nodeAssoc(self.root, (keyHash(key), key, value), 0)
+        if root is self.root: return self
+        return PMap(root, self.count + added)
+
+    def dissoc(self, key):
+        """ this map without (key)
+        @return [PMap]
+        """
+        root = nodeDissoc(self.root, keyHash(key), key, 0)
+        if root is self.root: return self
+        if root is None: return EMPTY_MAP
+        return PMap(root, self.count - 1)
+
+    def items(self):
+        """ @return [iterator] of (key, value) """
+        for e in nodeEntries(self.root):
+            yield e[1], e[2]
+
+    def keys(self):
+        return [e[1] for e in nodeEntries(self.root)]
+
+    def values(self):
+        return [e[2] for e in nodeEntries(self.root)]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __eq__(self, other):
+        if other.__class__ is not PMap: return False
+        if other is self: return True
+        if self.count!=other.count: return False
+        for h, key, value in nodeEntries(self.root):
+            e = nodeGet(other.root, h, key)
+            if e is None or not (e[2]==value): return False
+        return True
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "<map %s>" % (self.show(),)
+
+    def show(self):
+        return showList(self)
+    showStr = show
+
+EMPTY_MAP = PMap()
+
+def toMap(pairs):
+    """ make a PMap
+    @param pairs [iterable] of (key, value)
+    @return [PMap]
+    """
+    m = EMPTY_MAP
+    for key, value in pairs: m = m.assoc(key, value)
+    return m
+
+def isMap(x):
+    return x.__class__ is PMap
 
 #---------------------------------------------------------------------
 
@@ -60,13 +711,20 @@ def show(ex):
     if possible (similar to python __repr__)
     @return [str]
     """
+    cls = ex.__class__
+    if cls is Pair or cls is Vector or cls is PMap or isinstance(ex, tuple):
+        return showList(ex)
     if isinstance(ex, SpillType):
         return ex.show()
-    if type(ex)==tuple:
-        contents = " ".join([show(item) for item in ex])
-        return "(" + contents + ")"
     return str(ex)
 
+def showList(ex):
+    """ show() for a list, vector or map, which may be nested any
+    depth
+    """
+    pieces = []
+    writeShow(pieces.append, ex)
+    return "".join(pieces)
 
 def showStr(ex):
     """ display an s-expression in a form suitable for printing
@@ -77,6 +735,92 @@ def showStr(ex):
         return ex.showStr()
     return show(ex)
 
+#---------------------------------------------------------------------
+# writing incrementally
+
+# how many elements of a vector to write at a time
+WRITE_CHUNK = 1000
+
+def writeShow(write, ex):
+    """ write what show(ex) returns, a piece at a time, without
+    building the whole of it in memory or recursing
+    @param write [function] called with each piece, a str
+    """
+    # for each list or map being written: [its parts, at start, what
+    # to write at the end]
+    stack = []
+    x = ex
+    while True:
+        if x.__class__ is Pair or isinstance(x, tuple):
+            write("(")
+            stack.append([listParts(x), True, ")"])
+        elif x.__class__ is PMap:
+            write("{")
+            stack.append([mapParts(x), True, "}"])
+        elif x.__class__ is Vector:
+            write("#(")
+            items = x.tolist()
+            for i in xrange(0, len(items), WRITE_CHUNK):
+                if i: write(" ")
+                write(" ".join([str(n) for n in items[i:i+WRITE_CHUNK]]))
+            write(")")
+        elif x is DOT:
+            write(".")
+        elif isinstance(x, SpillType):
+            write(x.show())
+        else:
+            write(str(x))
+        # move on to the next item, closing the lists that are done
+        while stack:
+            top = stack[-1]
+            x = next(top[0], END)
+            if x is not END:
+                if top[1]:
+                    top[1] = False
+                else:
+                    write(" ")
+                break
+            stack.pop()
+            write(top[2])
+        else:
+            return
+
+def writeShowStr(write, ex):
+    """ write what showStr(ex) returns, a piece at a time """
+    cls = ex.__class__
+    if isinstance(ex, SpillType) and cls is not Pair \
+           and cls is not Vector and cls is not PMap:
+        write(ex.showStr())
+    else:
+        writeShow(write, ex)
+
+# markers used by writeShow(): the dot before the tail of an improper
+# list, and the end of a list
+DOT = object()
+END = object()
+
+def listParts(x):
+    """ the items of a list, then if it's an improper list, DOT and
+    its tail
+    @param x [Pair|tuple]
+    @return [iterator]
+    """
+    if x.__class__ is not Pair: return iter(x)
+    return pairParts(x)
+
+def pairParts(x):
+    while x.__class__ is Pair:
+        yield x.car
+        x = x.cdr
+    if not isNull(x):
+        yield DOT
+        yield x
+
+def mapParts(m):
+    """ the keys and values of a map, in turn """
+    for key, value in m.items():
+        yield key
+        yield value
 
 #---------------------------------------------------------------------
 # utility functions
@@ -84,11 +828,7 @@ def showStr(ex):
 def exToList(ex):
     """ convert an s-expression to a Python list
     """
-    if isinstance(ex, tuple):
-        return [exToList(e) for e in ex]
-    else:
-       return ex
-
+    return rebuildLists(ex, list)
 
 #---------------------------------------------------------------------
 
@@ -1,20 +1,46 @@
 # test_spill.py = test the Spill system
 
+import os
+import shutil
+import StringIO
+import tempfile
+import threading
 
 import addpath
 import lintest
 
+import lexer
 import parser
+import reader
 import spilltypes
 import spill
+import spillaot
+import spillcache
+import spillcomp
+import spillopt
+import spillpar
+import spillport
+import spillprof
+import spillserver
+import spilltrace
+from bench import runner, workloads
 
 
 #---------------------------------------------------------------------
 
+# frozen SpillSys instances with libcore loaded, by engine
+bases = {}
+
+def newSpillSys(engine='seval'):
+    """ a fresh SpillSys, spawned from a shared base """
+    if not bases.has_key(engine):
+        bases[engine] = spill.SpillSys(engine=engine).freeze()
+    return bases[engine].spawn()
+
 class SpillTestTools(lintest.TestCase):
 
     def setUp(self):
-        self.si = spill.SpillSys()
+        self.si = newSpillSys()
 
     def assertSameSpill(self, rData, sbData, comment=""):
         self.assertEqual(spilltypes.show(rData),
@@ -80,6 +106,108 @@ class T_parser(lintest.TestCase):
 
 #---------------------------------------------------------------------
 
+class T_lexer(lintest.TestCase):
+
+    SAMPLE = """hello world -9 - -x
+    ; this is a comment
+    ;{{ a multi-line
+    comment ;}}
+    #| another |#
+    ( 1234 `(a ,b c ,@d e) () "a \\"quoted\\" \\x41 string\\n" . ]
+    """
+
+    def typesAndValues(self, tokens):
+        return [(tok.type, tok.attr) for tok in tokens]
+
+    def test_sameAsIstream(self):
+        r = lexer.Lexer().tokenize(self.SAMPLE)
+        sb = lexer.Lexer(mode='istream').tokenize(self.SAMPLE)
+        self.assertSame(self.typesAndValues(r), self.typesAndValues(sb))
+
+    def test_tokenArrays(self):
+        ta = lexer.scan('(foo\n  "x" 12)')
+        self.assertSame(list(ta.types), [lexer.LPAREN, lexer.IDENTIFIER,
+            lexer.STRING, lexer.INTEGER, lexer.RPAREN])
+        self.assertSame(ta.value(1), 'foo')
+        self.assertSame(ta.value(2), 'x')
+        self.assertSame(ta.value(3), 12)
+        self.assertSame(ta.where(2), (2, 3))
+        self.assertSame(len(ta), 5)
+
+    def test_unterminatedString(self):
+        ta = lexer.scan('a "abc')
+        self.assertSame(ta.typeName(1), '"')
+
+    def test_escapes(self):
+        for s in [r"plain", r"a\nb", r"\\", r"\x41\x4", r"\xZZq",
+                  r"\q\"", "end\\", r"\x"]:
+            self.assertSame(lexer.replaceStringEscapes(s),
+                            lexer.replaceStringEscapesSlow(s), repr(s))
+
+#---------------------------------------------------------------------
+
+class T_reader(lintest.TestCase):
+
+    def read(self, s):
+        return list(reader.readForms(lexer.Lexer().tokenize(s)))
+
+    def test_sameAsParser(self):
+        s = """(def foo (fn (x * ys) `(a ,x ,@ys "str\\n" -45)))
+               '(1 (2 (3)) ()) x"""
+        sb = []
+        parser.SpillParser().parse(lexer.Lexer().tokenize(s), sb.append)
+        self.assertSame(self.read(s), sb)
+
+    def test_values(self):
+        self.assertSame(self.read("a (b) '() ,@c"),
+            ['a', ('b',), ('quote', ()), ('unquotesplicing', 'c')])
+        self.assertSame(self.read(" `,x "),
+            [('quasiquote', ('unquote', 'x'))])
+        self.assertSame(self.read(""), [])
+
+    def test_deep(self):
+        n = 20000
+        r = self.read("(" * n + "x" + ")" * n)[0]
+        for i in range(n-1): r = r[0]
+        self.assertSame(r, ('x',))
+        r = self.read("(" + "1 " * n + ")")[0]
+        self.assertSame(len(r), n)
+
+    def test_errors(self):
+        for s in ["(a b", "a)", "'", "(a ')", "(a . b)"]:
+            try:
+                self.read(s)
+                self.failed("no syntax error for {%s}" % (s,))
+            except reader.SpillSyntaxError:
+                self.passedTest("syntax error for {%s}" % (s,))
+
+    def test_streaming(self):
+        forms = reader.readForms(lexer.Lexer().tokenize("(a) (b"))
+        self.assertSame(forms.next(), ('a',), "first form before error")
+
+    def test_iterForms(self):
+        s = """(def a 1) ; comment (not a form)
+        #| block
+        comment (x) |# -123 "str;ing" 'quoted
+        (nested (list (of "things")) ()) symbol"""
+        sb = self.read(s)
+        for chunkSize in (1, 2, 3, 7, 100):
+            r = list(reader.iterForms(StringIO.StringIO(s), chunkSize))
+            self.assertSame(r, sb, "chunkSize=%d" % (chunkSize,))
+
+    def test_iterFormsError(self):
+        f = StringIO.StringIO("(a)\n(b))")
+        forms = reader.iterForms(f, 2)
+        self.assertSame(forms.next(), ('a',))
+        try:
+            forms.next()
+            forms.next()
+            self.failed("no syntax error")
+        except reader.SpillSyntaxError, e:
+            self.assertSame(str(e), "line 2 col 4: unexpected ')'")
+
+#---------------------------------------------------------------------
+
 class T_spilltypes(SpillTestTools):
 
     def test_exToList(self):
@@ -95,6 +223,72 @@ class T_spilltypes(SpillTestTools):
         sb = ['fn', ['a', 'b'], ['*', 'a', 'b']]
         self.assertSame(r, sb, "nested list")
 
+    def test_pair(self):
+        Pair = spilltypes.Pair
+        a = spilltypes.toCons((1, 2, 3))
+        self.assertSame(a.__class__, Pair)
+        self.assertSame(a, (1, 2, 3), "a Pair equals a tuple")
+        self.assertSame((1, 2, 3), a)
+        self.assertSame(hash(a), hash((1, 2, 3)))
+        self.assertSame(list(a), [1, 2, 3])
+        self.assertSame(len(a), 3)
+        self.assertSame(spilltypes.show(Pair(0, a)), "(0 1 2 3)")
+        self.assertSame(spilltypes.show(Pair(1, 2)), "(1 . 2)")
+        self.assertSame(a == (1, 2), False)
+        self.assertSame(a == (1, 2, 3, 4), False)
+
+    def test_toCode(self):
+        data = spilltypes.toConsDeep(('if', ('quote', ('a', 'b')), 'x'))
+        r = spilltypes.toCode(data)
+        self.assertSame(r.__class__, tuple)
+        self.assertSame(r[1][1].__class__, spilltypes.Pair,
+                        "quoted data stays as Pairs")
+        self.assertSameSpill(r, data)
+
+    def test_deep(self):
+        # nested more deeply than Python's recursion limit
+        depth = 20000
+        data = ()
+        code = ()
+        for i in range(depth):
+            data = spilltypes.Pair(data, ())
+            code = (code,)
+        shown = "(" * (depth+1) + ")" * (depth+1)
+        self.assertSame(spilltypes.show(data), shown)
+        self.assertSame(spilltypes.show(code), shown)
+        self.assertSame(spilltypes.show(spilltypes.toConsDeep(code)), shown)
+        self.assertSame(spilltypes.toCode(data).__class__, tuple)
+        self.assertSame(spilltypes.show(spilltypes.toCode(data)), shown)
+        x = spilltypes.exToList(code)
+        for i in range(depth): x = x[0]
+        self.assertSame(x, [])
+        self.assertSame(spilltypes.show(
+            spillcache.decode(spillcache.encode(data))), shown)
+
+    def test_lstr(self):
+        LStr = spilltypes.LStr
+        a = LStr("abc")
+        self.assertSame(a, LStr("abc"))
+        self.assertSame(a == "abc", False, "a string isn't a symbol")
+        self.assertSame("abc" == a, False)
+        self.assertSame(a != "abc", True)
+        self.assertSame(hash(a), hash(LStr("abc")))
+        self.assertSame(len(set([a, LStr("abc"), "abc"])), 2)
+        self.assertSame(a.s.__class__, str)
+        self.assertSame(a.showStr(), "abc")
+        self.assertSame(spilltypes.show(LStr('say "hi"\\n\n')),
+                        r'"say \"hi\"\\n\n"')
+
+    def test_internLStr(self):
+        a = spilltypes.internLStr("interned")
+        self.assertSame(a.__class__, spilltypes.LStr)
+        self.failUnless(spilltypes.internLStr("interned") is a)
+        forms = list(reader.readForms(lexer.scan('"lit" ("lit")')))
+        self.failUnless(forms[0] is forms[1][0])
+        long = "x" * (spilltypes.INTERN_MAX_LENGTH + 1)
+        self.failIf(spilltypes.internLStr(long)
+                    is spilltypes.internLStr(long))
+
 #---------------------------------------------------------------------
 
 class T_basicFunctionality(SpillTestTools):
@@ -104,11 +298,41 @@ class T_basicFunctionality(SpillTestTools):
         self.retr("(+ 4 5)", "9")
         self.retr("'(+ 4 5)", "(+ 4 5)")
 
+    def test_arity(self):
+        """ run by both engines, which must agree """
+        self.retr("((fn (a b) b) 1 2)", "2")
+        self.retr("((fn (a * xs) xs) 1)", "()")
+        self.retr("((fn (a * xs) xs) 1 2 3)", "(2 3)")
+        self.retr("((fn (* xs) xs))", "()")
+        self.retr("((fn () 7))", "7")
+        for s in ["((fn (a b) b) 1)", "((fn (a b) b) 1 2 3)",
+                  "((fn (a * xs) xs))", "((fn () 7) 1)"]:
+            self.assertRaises(TypeError, self.si.readEval, s)
+
+    def test_stringOperations(self):
+        # they'd make symbols, if strings supported them
+        for ex in ['(+ "a" "b")', '(+ \'a "b")', '(* "ab" 3)',
+                   '(* 3 "ab")', '(car "abc")', '(cdr "abc")']:
+            self.assertRaises(TypeError, self.si.readEval, ex)
+        self.retr("(+ 'a 'b)", "ab")
+
     def test_listFunctions(self):
         self.retr("(cons 'a '(b c))", "(a b c)")
         self.retr("(cons 5 '(b c))", "(5 b c)")
         self.retr("(cons 5 '())", "(5)")
         self.retr("(append '(x) '(y) '(3))", "(x y 3)")
+        self.retr("(append)", "()")
+        self.retr("(cdr (cdr '(a b c)))", "(c)")
+        self.retr("(if (null? (cdr '(a))) 'empty 'full)", "empty")
+
+    def test_sharedTails(self):
+        self.si.readEval("(def xs '(b c))")
+        ys = self.si.readEval("(cons 'a xs)")
+        self.assertSame(ys.cdr is self.si.eval('xs'), True,
+                        "cons shares its tail")
+        zs = self.si.readEval("(append '(1 2) xs)")
+        self.assertSame(zs.cdr.cdr is self.si.eval('xs'), True,
+                        "append shares the last list")
 
     def test_square(self):
         self.retr("""
@@ -138,6 +362,21 @@ class T_basicFunctionality(SpillTestTools):
         self.retr("(== '(a b c) '(a b c))", "true")
         self.retr("(== '(a b c) '(a b d))", "false")
 
+    def test_tailCalls(self):
+        self.retr("""
+        (def count (fn (n acc)
+           (if (== n 0) acc
+               (begin
+                  (def next (- n 1))
+                  (count next (+ acc 2))))))
+        (count 10000 0)
+        """, "20000")
+        self.retr("""
+        (def even2? (fn (n) (if (== n 0) 'true (odd2? (- n 1)))))
+        (def odd2? (fn (n) (if (== n 0) 'false (even2? (- n 1)))))
+        (even2? 10001)
+        """, "false")
+
     def test_eval(self):
         self.retr("(eval '(+ 2 5))", "7")
         self.retr("""
@@ -186,12 +425,400 @@ class T_libcore(SpillTestTools):
         self.retr("(fromto -6 -6)", "(-6)")
         self.retr("(fromto 6 5)", "()")
 
+    def test_listLibrary(self):
+        self.retr("(reduce + 0 (fromto 1 100))", "5050")
+        self.retr("(reduce (fn (acc x) (cons x acc)) '() '(1 2 3))",
+                  "(3 2 1)")
+        self.retr("(length '(a b c))", "3")
+        self.retr("(length '())", "0")
+        self.retr("(reverse '(1 2 3))", "(3 2 1)")
+        self.retr("(nth 1 '(a b c))", "b")
+        self.retr("(sort '(3 1 2))", "(1 2 3)")
+        self.retr("(sort '(3 1 2) (fn (a b) (> a b)))", "(3 2 1)")
+        self.retr("(filter (fn (x) (> x 2)) '(1 2 3 4))", "(3 4)")
+        self.retr("(map car '((a 1) (b 2)))", "(a b)")
+
+    def test_longLists(self):
+        self.retr("(length (map (fn (x) (* x x)) (fromto 1 20000)))",
+                  "20000")
+        self.retr("(nth 19999 (filter odd? (fromto 1 40000)))", "39999")
+
     def xtest_miscFunctions(self):
         self.retr("(and 'foo 'bar)", "(if (not foo) 'false bar)")
 
 #---------------------------------------------------------------------
 
 
+class T_vectors(SpillTestTools):
+    """ test numeric vectors """
+
+    def test_literal(self):
+        v = parser.parseExp("#(1 -2 3)")
+        self.assertSame(v.__class__, spilltypes.Vector)
+        self.assertSame(v.tolist(), [1, -2, 3])
+        self.retr("(vsum #(1 2 3))", "6")
+        self.retr("'(#(1) #())", "(#(1) #())")
+        self.assertRaises(reader.SpillSyntaxError, parser.parseExp,
+                          "#(1 a)")
+
+    def test_construct(self):
+        self.retr("(vector 1 2 3)", "#(1 2 3)")
+        self.retr("(list->vector '(4 5))", "#(4 5)")
+        self.retr("(vector->list (vrange 1 4))", "(1 2 3 4)")
+        self.retr("(vector)", "#()")
+        self.retr("(if (vector? (vector 1)) 'yes 'no)", "yes")
+        self.retr("(length (vrange 1 100))", "100")
+        self.retr("(nth 2 (vector 7 8 9))", "9")
+        self.assertRaises(TypeError, self.si.readEval, "(vector 'a)")
+
+    def test_arithmetic(self):
+        self.si.readEval("(def a (vector 1 2 3)) (def b (vector 10 20 30))")
+        self.retr("(+ a b)", "#(11 22 33)")
+        self.retr("(- b a)", "#(9 18 27)")
+        self.retr("(* a 2)", "#(2 4 6)")
+        self.retr("(- 10 a)", "#(9 8 7)")
+        self.retr("(/ b 10)", "#(1 2 3)")
+        self.assertRaises(ValueError, self.si.readEval,
+                          "(+ a (vector 1 2))")
+
+    def test_comparisons(self):
+        self.si.readEval("(def a (vector 1 5 3))")
+        self.retr("(v< a 3)", "#(1 0 0)")
+        self.retr("(v>= a (vector 1 6 2))", "#(1 0 1)")
+        self.retr("(v== a 5)", "#(0 1 0)")
+        self.retr("(eq? a (vector 1 5 3))", "true")
+
+    def test_reductions(self):
+        self.si.readEval("(def a (vector 4 -2 9))")
+        self.retr("(vsum a)", "11")
+        self.retr("(vmin a)", "-2")
+        self.retr("(vmax a)", "9")
+        self.retr("(dot a (vector 1 2 3))", "27")
+        self.retr("(vslice a 1 3)", "#(-2 9)")
+        self.retr("(vsum (vrange 1 100000))", "5000050000")
+
+    def test_listFunctions(self):
+        self.retr("(map (fn (x) (* x x)) (vector 1 2 3))", "#(1 4 9)")
+        self.retr("(filter odd? (vrange 1 6))", "#(1 3 5)")
+        self.retr("(reduce + 0 (vector 1 2 3))", "6")
+        self.si.readEval("(def out (open-output-string))")
+        self.si.readEval("(with-output-to out (fn () (pr (vector 1 2))))")
+        self.retr("(get-output-string out)", '"#(1 2)"')
+
+class CollidingKey(object):
+    """ a key whose hash is the same as many others' """
+    def __init__(self, n): self.n = n
+    def __hash__(self): return self.n % 3
+    def __eq__(self, other):
+        return isinstance(other, CollidingKey) and other.n==self.n
+    def __repr__(self): return "k%d" % (self.n,)
+
+class T_maps(SpillTestTools):
+    """ test persistent hash maps """
+
+    def test_primitives(self):
+        self.si.readEval("""
+        (def m (hash-map 'a 1 "a" 2 '(1 2) 3))
+        (def m2 (assoc m 'b 4 'a 5))
+        """)
+        self.retr("(list (get m 'a) (get m \"a\") (get m (list 1 2)))",
+                  "(1 2 3)")
+        self.retr("(list (get m 'b) (get m 'b 0))", "(() 0)")
+        self.retr("(list (count m) (count m2) (get m 'a) (get m2 'a))",
+                  "(3 4 1 5)")
+        self.retr("(count (dissoc m2 'a 'b \"c\"))", "2")
+        self.retr("(list (has-key? m 'a) (has-key? m 'b))", "(true false)")
+        self.retr("(sort (vals m2))", "(2 3 4 5)")
+        self.retr("(length (keys m))", "3")
+        self.retr("(if (hash-map? m) 'yes 'no)", "yes")
+        self.retr("(count (hash-map))", "0")
+        self.assertRaises(TypeError, self.si.readEval, "(hash-map 'a)")
+        self.assertRaises(TypeError, self.si.readEval, "(get '(a) 'a)")
+
+    def test_show(self):
+        m = self.si.readEval("(hash-map 'a (list 1 \"x\") 'b (hash-map))")
+        self.failUnless(spilltypes.show(m) in ('{a (1 "x") b {}}',
+                                               '{b {} a (1 "x")}'))
+        self.assertSame(spilltypes.show(spilltypes.EMPTY_MAP), "{}")
+
+    def test_updates(self):
+        m = spilltypes.EMPTY_MAP
+        for i in range(1000): m = m.assoc(i, i*i)
+        self.assertSame(len(m), 1000)
+        self.assertSame(m.get(999), 998001)
+        m2 = m.assoc(5, 'five')
+        self.assertSame((m.get(5), m2.get(5)), (25, 'five'))
+        # only the path to 5 is copied
+        shared = [a is b for a, b in zip(m.root.slots, m2.root.slots)]
+        self.assertSame(shared.count(False), 1)
+        self.failUnless(m.assoc(5, 25) is m)
+        self.failUnless(m.dissoc('x') is m)
+        m3 = m
+        for i in range(0, 1000, 2): m3 = m3.dissoc(i)
+        self.assertSame(len(m3), 500)
+        self.assertSame(sorted(m3.keys()), range(1, 1000, 2))
+        self.assertSame(len(m), 1000)
+        self.failUnless(spilltypes.toMap(m3.items()) == m3)
+        self.failIf(m3 == m)
+
+    def test_collisions(self):
+        keys = [CollidingKey(i) for i in range(30)]
+        m = spilltypes.toMap([(k, k.n) for k in keys])
+        self.assertSame(len(m), 30)
+        self.assertSame([m.get(CollidingKey(i)) for i in range(30)],
+                        range(30))
+        for k in keys[::2]: m = m.dissoc(k)
+        self.assertSame(len(m), 15)
+        self.assertSame(sorted(m.values()), range(1, 30, 2))
+        self.assertSame(m.get(CollidingKey(2)), None)
+        m = m.assoc("str", 1).assoc(spilltypes.LStr("str"), 2)
+        self.assertSame((m.get("str"), m.get(spilltypes.LStr("str"))),
+                        (1, 2))
+
+class T_pmap(SpillTestTools):
+    """ test parallel map """
+
+    def setUp(self):
+        SpillTestTools.setUp(self)
+        self.saved = spillpar.MIN_PARALLEL, spillpar.PROCESSES
+        spillpar.MIN_PARALLEL = 0
+        spillpar.PROCESSES = 2
+
+    def tearDown(self):
+        spillpar.closePools()
+        spillpar.MIN_PARALLEL, spillpar.PROCESSES = self.saved
+
+    def test_shipClosure(self):
+        self.si.readEval("""
+        (def fact (fn (n) (if (< n 2) 1 (* n (fact (- n 1))))))
+        (def k 10)
+        (def f (fn (x) (+ k (fact x))))
+        """)
+        table = spillpar.shipClosure(self.si.eval('f'))
+        self.assertSame(len(table), 2, "f and fact")
+        self.assertSame(table[0][2]['k'], ('value', 10))
+        self.assertSame(table[0][2]['+'], ('primitive', '+'))
+        self.assertSame(table[0][2]['fact'], ('closure', 1))
+        self.assertSame(table[1][2]['fact'], ('closure', 1))
+
+    def test_freeSymbols(self):
+        ex = parser.parseExp("""(begin (def y 1)
+            (map (fn (z * more) (begin (def w z) (+ w k more)))
+                 (list x y 'quoted)))""")
+        self.assertSame(sorted(spillpar.freeSymbols(('x',), ex)),
+                        ['+', 'begin', 'def', 'k', 'list', 'map'])
+
+    def test_shipNestedFn(self):
+        self.si.readEval("""
+        (def z (list car))
+        (def f (fn (x) (map (fn (z) (* z x)) '(1 2))))
+        """)
+        table = spillpar.shipClosure(self.si.eval('f'))
+        self.failIf('z' in table[0][2], "z is the inner fn's parameter")
+        self.failIf('x' in table[0][2])
+        self.retr("(pmap f '(1 2))", "((1 2) (2 4))")
+
+    def test_pmap(self):
+        for si in (self.si, newSpillSys('compile')):
+            si.readEval("""
+            (def fact (fn (n) (if (< n 2) 1 (* n (fact (- n 1))))))
+            (def addFact (fn (k) (fn (x) (list x (+ k (fact x))))))
+            """)
+            self.assertSameSpill(
+                si.readEval("(pmap (addFact 3) (fromto 1 50))"),
+                si.readEval("(map (addFact 3) (fromto 1 50))"))
+            self.assertSameSpill(si.readEval(
+                "(pmap (fn (x) (* x x)) (vrange 1 5))"),
+                spilltypes.toVector([1, 4, 9, 16, 25]))
+            self.assertSameSpill(si.readEval("(pmap odd? '())"), ())
+
+    def test_serialFallback(self):
+        self.si.readEval("""
+        (def fs (list car cdr))
+        (def f (fn (x) (list (pr "") ((nth 0 fs) x))))
+        """)
+        self.assertRaises(spillpar.Unshippable, spillpar.shipClosure,
+                          self.si.eval('f'))
+        self.retr("(pmap f '((1 2) (3 4)))", '(("" 1) ("" 3))')
+
+    def test_unshippableFunctions(self):
+        self.si.readEval("""
+        (defmemo sq (x) (* x x))
+        (def f (fn (x) (sq x)))
+        """)
+        self.assertRaises(spillpar.Unshippable, spillpar.shipClosure,
+                          self.si.eval('f'))
+        self.retr("(pmap f '(1 2 3))", "(1 4 9)")
+
+    def test_profiled(self):
+        self.si.readEval("""
+        (def sq (fn (x) (* x x)))
+        (def f (fn (x) (sq x)))
+        """)
+        self.si.startProfiling()
+        try:
+            table = spillpar.shipClosure(self.si.eval('f'))
+            self.assertSame(table[0][2]['sq'], ('closure', 1))
+            self.assertSame(table[1][2]['*'], ('primitive', '*'))
+            self.retr("(pmap f '(1 2 3))", "(1 4 9)")
+        finally:
+            self.si.stopProfiling()
+
+    def test_unshippableResults(self):
+        m = self.si.readEval("(pmap (fn (x) (hash-map 'a x)) '(1 2))")
+        self.assertSame([x.get('a') for x in m], [1, 2])
+
+class T_ports(SpillTestTools):
+    """ test output ports """
+
+    def test_stringPort(self):
+        self.si.readEval("""
+        (def out (open-output-string))
+        (display "say \\"hi\\"" out)
+        (newline out)
+        (write "say \\"hi\\"" out)
+        (write (list 1 "x" (vector 2 3) (cons 4 5)) out)
+        """)
+        self.assertSame(self.si.eval('out').getvalue(),
+                        'say "hi"\n"say \\"hi\\""(1 "x" #(2 3) (4 . 5))')
+        self.retr("(get-output-string out)",
+                  '"say \\"hi\\"\\n\\"say \\\\\\"hi\\\\\\"\\"'
+                  '(1 \\"x\\" #(2 3) (4 . 5))"')
+
+    def test_currentPort(self):
+        self.retr("(pr 1 2)", "2", "pr returns its last argument")
+        self.si.readEval("(def out (open-output-string))")
+        old = self.si.readEval("(set-output-port! out)")
+        try:
+            self.failUnless(old is spillport.stdoutPort)
+            self.si.readEval('(pr "x=" (list 1 2) "\\n")')
+            self.failUnless(self.si.readEval("(current-output-port)")
+                            is self.si.eval('out'))
+        finally:
+            spillport.setPort(old)
+        self.retr("(get-output-string out)", '"x=(1 2)\\n"')
+
+    def test_filePort(self):
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, "out.txt")
+            self.si.readEval("""
+            (def out (open-output-file "%s"))
+            (with-output-to out (fn () (pr "hello\\n")))
+            (close-port out)
+            """ % (path,))
+            self.assertSame(open(path).read(), "hello\n")
+            self.assertRaises(spillport.PortError, self.si.readEval,
+                              '(display "more" out)')
+        finally:
+            shutil.rmtree(d)
+
+    def test_unclosedFilePort(self):
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, "out.txt")
+            port = spillport.openFile(path)
+            port.write("kept")
+            self.assertSame(open(path).read(), "")
+            spillport.flushAll()
+            self.assertSame(open(path).read(), "kept",
+                            "what atexit does")
+            port.write(" too")
+            del port
+            self.assertSame(open(path).read(), "kept too",
+                            "flushed when garbage collected")
+        finally:
+            shutil.rmtree(d)
+
+    def test_buffering(self):
+        f = StringIO.StringIO()
+        port = spillport.Port(f, "test", bufferSize=10)
+        port.write("12345")
+        self.assertSame(f.getvalue(), "", "still in the buffer")
+        port.write("67890")
+        self.assertSame(f.getvalue(), "1234567890")
+        port.write("x")
+        port.flush()
+        self.assertSame(f.getvalue(), "1234567890x")
+
+    def test_writeShow(self):
+        Pair = spilltypes.Pair
+        deep = ()
+        for i in range(5000): deep = Pair(deep, Pair(i, ()))
+        for ex in [1, 'sym', spilltypes.LStr('a "b"'), (), (1, (2, ())),
+                   Pair(1, Pair(2, 3)), spilltypes.toVector(range(2500)),
+                   spilltypes.toCons([spilltypes.LStr("s"), ('q', 1)])]:
+            pieces = []
+            spilltypes.writeShow(pieces.append, ex)
+            self.assertSame("".join(pieces), spilltypes.show(ex))
+            pieces = []
+            spilltypes.writeShowStr(pieces.append, ex)
+            self.assertSame("".join(pieces), spilltypes.showStr(ex))
+        pieces = []
+        spilltypes.writeShow(pieces.append, deep)
+        s = "".join(pieces)
+        self.failUnless(s.startswith("(" * 5001 + ") 0) 1)"))
+
+class T_memo(SpillTestTools):
+    """ test memoised functions """
+
+    def test_defmemo(self):
+        self.si.readEval("""
+        (defmemo fib (n)
+           (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))
+        """)
+        self.retr("(fib 60)", "1548008755920")
+        self.retr("(memo-stats fib)", """((hits 58) (misses 61)
+            (evictions 0) (size 61) (max-size 1000))""")
+        self.retr("(fib 60)", "1548008755920")
+        self.assertSame(self.si.eval('fib').stats()['hits'], 59)
+
+    def test_lru(self):
+        self.si.readEval("""
+        (def calls 0)
+        (def sq (memo (fn (x) (begin (set! calls (+ calls 1)) (* x x))) 2))
+        """)
+        self.retr("(list (sq 1) (sq 2) (sq 1) (sq 3) calls)", "(1 4 1 9 3)")
+        self.retr("(list (sq 1) calls)", "(1 3)", "1 was used recently")
+        self.retr("(list (sq 2) calls)", "(4 4)", "2 was evicted")
+        m = self.si.eval('sq')
+        self.assertSame(m.stats(), {'hits': 2, 'misses': 4,
+            'evictions': 2, 'size': 2, 'max-size': 2})
+        self.si.readEval("(memo-clear! sq)")
+        self.assertSame(m.stats()['size'], 0)
+
+    def test_keys(self):
+        self.si.readEval("""
+        (def calls 0)
+        (def f (memo (fn (* args) (begin (set! calls (+ calls 1)) args))))
+        """)
+        self.retr("(list (f (list 1 2)) (f (list 1 2)) calls)",
+                  "(((1 2)) ((1 2)) 1)", "lists are compared by contents")
+        self.retr('(list (f "a") (f \'a) calls)', '(("a") (a) 3)')
+        self.retr("(list (f 1 2) (f 1 2) (f 2 1) calls)",
+                  "((1 2) (1 2) (2 1) 5)")
+        self.si.readEval("(set! calls 0)")
+        self.si.readEval("(f (null? '())) (f 1)")
+        self.retr("calls", "2", "true and 1 have different keys")
+        self.si.readEval("(def k (fn (n) (list (fn () n))))")
+        self.retr("((car (car (f (k 1)))))", "1")
+        self.retr("((car (car (f (k 2)))))", "2",
+                  "closures with the same source aren't the same")
+        self.retr("calls", "4")
+
+    def test_errors(self):
+        self.si.readEval("(def inv (memo (fn (x) (/ 1 x))))")
+        self.assertRaises(ZeroDivisionError, self.si.readEval, "(inv 0)")
+        self.retr("(memo-stats inv)", """((hits 0) (misses 1)
+            (evictions 0) (size 0) (max-size 1000))""")
+        self.assertRaises(TypeError, self.si.readEval, "(memo 3)")
+        self.assertRaises(ValueError, self.si.readEval, "(memo inv 0)")
+        self.assertRaises(TypeError, self.si.readEval, "(memo-stats car)")
+
+class T_memoCompiled(T_memo):
+    def setUp(self):
+        self.si = newSpillSys('compile')
+
 class T_macros(SpillTestTools):
     """ test macro expansion """
 
@@ -227,6 +854,24 @@ class T_macros(SpillTestTools):
         #   `(a ,@b c) => (cat '(a) b '(c))
         self.macExpand("(quasiquote (a (unquotesplicing b) c))", "(a 33 44 c)")
 
+    def test_longQuasiquote(self):
+        items = " ".join([str(i) for i in range(5000)])
+        self.si.readEval("(def x 'x) (def ys '(1 2))")
+        self.retr("(length `(,x %s ,@ys %s ,x))" % (items, items), "10004")
+
+    def test_deepExpansion(self):
+        depth = 5000
+        code = "(and a b)"
+        for i in range(depth): code = "(list %s)" % (code,)
+        expanded = self.si.macroExpand(parser.parseExp(code))
+        for i in range(depth): expanded = expanded[1]
+        self.assertSameSpill(expanded,
+                             parser.parseExp("(if (not a) 'false b)"))
+        quasi = "(quasiquote %s(unquote x)%s)" % ("(" * depth, ")" * depth)
+        expanded = self.si.macroExpand(parser.parseExp(quasi))
+        for i in range(depth): expanded = expanded[1]
+        self.assertSame(expanded, 'x')
+
     def test_quasiquote2(self):
         # as above, but use appreviations
         self.si.readEval("(def b '(33 44))")
@@ -254,14 +899,791 @@ class T_macros(SpillTestTools):
             `(if ,a 'true ,b)))
         """)
 
+    def test_sharing(self):
+        """ forms without macros aren't copied """
+        ex = parser.parseExp("(def f (fn (x) (if (< x 1) (g x 'y) 0)))")
+        self.failUnless(self.si.macroExpand(ex) is ex)
+        ex = parser.parseExp("(foo (bar 1) (and a b) (baz 2))")
+        r = self.si.macroExpand(ex)
+        self.assertSameSpill(r,
+            parser.parseExp("(foo (bar 1) (if (not a) 'false b) (baz 2))"))
+        self.failUnless(r[1] is ex[1])
+        self.failUnless(r[3] is ex[3])
+
+    def test_expansionCache(self):
+        table = self.si.macroTable
+        self.failUnless(self.si.isMacro('and'))
+        self.failIf(self.si.isMacro('not'))
+        ex = parser.parseExp("(list (and a b) (and a b))")
+        self.si.macroExpand(ex)
+        self.assertSame(table.hits, 1)
+        self.si.readEval("(def macro~and (fn (a b) (list 'if a b 0)))")
+        self.assertSameSpill(self.si.macroExpand(ex),
+            parser.parseExp("(list (if a b 0) (if a b 0))"),
+            "redefining a macro forgets old expansions")
+
+    def test_evalExpands(self):
+        for si in (self.si, newSpillSys('compile')):
+            self.assertSame(si.readEval("(eval '(and 'false 1))"), 'false')
+            si.readEval("(def macro~twice (fn (x) (list '* 2 x)))")
+            self.assertSame(si.readEval("(eval '(twice 21))"), 42)
+            self.assertSame(si.readEval(
+                "((fn (n) (eval (list 'twice n))) 5)"), 10)
+
+#---------------------------------------------------------------------
+# the same tests, run using the closure compiler
+
+class T_basicFunctionalityCompiled(T_basicFunctionality):
+    def setUp(self):
+        self.si = newSpillSys('compile')
+
+class T_libcoreCompiled(T_libcore):
+    def setUp(self):
+        self.si = newSpillSys('compile')
+
+class T_compileEngine(SpillTestTools):
+
+    def setUp(self):
+        self.si = newSpillSys('compile')
+
+    def test_closures(self):
+        self.retr("""
+        (def addn (fn (n)
+           (fn (x) (+ n x))))
+        ((addn 3) 10)
+        """, "13")
+
+    def test_set(self):
+        self.retr("""
+        (def counter 0)
+        (def bump (fn () (set! counter (+ counter 1))))
+        (bump) (bump) counter
+        """, "2")
+
+    def test_lexicalAddressing(self):
+        self.retr("""
+        (def add3 (fn (a)
+           (fn (b)
+              (fn (c) (+ a (+ b c))))))
+        (((add3 1) 20) 300)
+        """, "321")
+        self.retr("""
+        (def account (fn (balance)
+           (fn (amount) (set! balance (+ balance amount)))))
+        (def acc (account 100))
+        (acc 10)
+        (acc 5)
+        """, "115")
+        self.retr("""
+        (def localDef (fn (x)
+           (begin
+              (def y (* x 2))
+              (+ x y))))
+        (localDef 4)
+        """, "12")
+
+    def test_evalDefinesLocal(self):
+        self.retr("""
+        (def foo (fn (a)
+           (begin
+              (eval '(def b 7))
+              (+ a b))))
+        (foo 1)
+        """, "8")
+
+    def test_globalCells(self):
+        self.si.readEval("""
+        (def g 1)
+        (def f (fn (x) (fn () (list g (length x)))))
+        (def h (f '(1 2)))
+        """)
+        self.retr("(h)", "(1 2)")
+        self.si.readEval("(def g 2)")
+        self.retr("(h)", "(2 2)", "redefined")
+        self.si.readEval("(set! g 3)")
+        self.retr("(h)", "(3 2)", "set")
+        # (length) is in the frozen base environment, until we hide it
+        self.si.readEval("(def length (fn (x) 'mine))")
+        self.retr("(h)", "(3 mine)", "hidden")
+        self.si.globalEnv.unbind('length')
+        self.retr("(h)", "(3 2)", "uncovered")
+        prof = self.si.startProfiling()
+        self.retr("(h)", "(3 2)")
+        self.si.stopProfiling()
+        self.assertSame(prof.stats['length'].calls, 1)
+        self.retr("(h)", "(3 2)")
+
+    def test_cell(self):
+        env = self.si.globalEnv
+        cell = env.cell('car')
+        self.failUnless(env.parent.cells['car'] is cell)
+        self.failUnless(env.cell('car') is cell)
+        version = env.stamp.version
+        self.si.readEval("(def car cdr)")
+        self.failIf(env.cell('car') is cell)
+        self.failUnless(env.stamp.version > version)
+        self.failIf(env.parent.stamp is env.stamp)
+        self.failUnless(env.stamp.parent is env.parent.stamp)
+        sibling = bases['compile'].spawn()
+        self.failIf(sibling.globalEnv.stamp is env.stamp)
+        self.failUnless(sibling.globalEnv.stamp.parent is env.stamp.parent)
+        version = env.stamp.version
+        baseVersion = env.parent.stamp.version
+        sibling.readEval("(def zz 1)")
+        self.assertSame(env.stamp.version, version,
+                        "another spawned instance's changes don't affect us")
+        self.assertSame(env.parent.stamp.version, baseVersion)
+        other = spill.SpillSys(engine='compile', cache=False)
+        self.failIf(other.globalEnv.stamp is env.stamp)
+        version = env.stamp.version
+        other.readEval("(def newVariable 1)")
+        self.assertSame(env.stamp.version, version,
+                        "another tree's changes don't affect us")
+        self.assertRaises(spill.VariableNotFound, env.cell, 'nosuchvar')
+
+    def test_scope(self):
+        ex = parser.parseExp("(fn (a * rest) (begin (def c 1) (fn (d) a)))")
+        scope = spillcomp.Scope(ex[1], ex[2], None)
+        self.assertSame(scope.names, ('a', 'rest', 'c'))
+        inner = spillcomp.Scope(('d',), 'a', scope)
+        self.assertSame(inner.resolve('a'), (1, 0))
+        self.assertSame(inner.resolve('d'), (0, 0))
+        self.assertSame(inner.resolve('car'), None)
+
+    def test_if(self):
+        self.retr("(if 'false 1 'false 2 3)", "3")
+        self.retr("(if 'false 1 0 2)", "0")
+        self.retr("(if 'false 1 'true 2)", "2")
+
+#---------------------------------------------------------------------
+
+class T_optimiser(SpillTestTools):
+    """ test the optimiser """
+
+    def opt(self, s):
+        """ the optimised form of the expression in (s) """
+        form = list(reader.readForms(lexer.scan(s)))[0]
+        ex = self.si.optimise(self.si.macroExpand(form))
+        return spilltypes.show(ex)
+
+    def test_fold(self):
+        self.assertSame(self.opt("(+ 1 (* 2 3))"), "7")
+        self.assertSame(self.opt("(list 'a (car '(1 2)) \"s\")"),
+                        '(quote (a 1 "s"))')
+        self.assertSame(self.opt("(list)"), "(quote ())")
+        self.assertSame(self.opt("(f (+ 1 2) x)"), "(f 3 x)")
+        self.assertSame(self.opt("(+ x (+ 1 2))"), "(+ x 3)")
+        self.assertSame(self.opt("(append (list 'a) '() x)"),
+                        "(append (quote (a)) x)")
+        self.assertSame(self.opt("(append x '(1) '())"),
+                        "(append x (quote (1)))")
+        self.assertSame(self.opt("(append (list 'a) x '())"),
+                        "(append (quote (a)) x (quote ()))",
+                        "x needn't be a list")
+        self.assertSame(self.opt("(/ 1 0)"), "(/ 1 0)",
+                        "errors are left to happen at run-time")
+        self.assertSame(self.si.optimiser.stats()['folded'], 11)
+
+    def test_notFolded(self):
+        for s in ["(fn (car) (car (quote (1 2))))",
+                  "(fn (x) (begin (def + -) (+ 1 2)))",
+                  "(begin (set! * +) (* 2 3))",
+                  "(begin (eval (quote x)) (+ 1 2))",
+                  "(pr 1)"]:
+            self.assertSame(self.opt(s), s)
+        self.si.readEval("(def length (fn (x) 99))")
+        self.assertSame(self.opt("(length '(1))"), "(length (quote (1)))")
+        self.retr("(length '(1))", "99")
+
+    def test_if(self):
+        self.assertSame(self.opt("(if (< 1 2) a b)"), "a")
+        self.assertSame(self.opt("(if (< 2 1) a b)"), "b")
+        self.assertSame(self.opt("(if x a (== 1 1) b c)"), "(if x a b)")
+        self.assertSame(self.opt("(if x a (== 1 2) b c)"), "(if x a c)")
+        self.assertSame(self.opt("(if x a (== 1 2) b)"),
+                        "(if x a (quote false))")
+        self.retr("(if (< 2 1) 5)", "false")
+
+    def test_begin(self):
+        self.assertSame(self.opt("(begin 1 (begin (pr 2) (begin 3 x)))"),
+                        "(begin (pr 2) x)")
+        self.assertSame(self.opt("(begin 1 2)"), "2")
+        self.assertSame(self.opt("(fn () (begin (def a 1) (begin a)))"),
+                        "(fn () (begin (def a 1) a))")
+
+    def test_quasiquote(self):
+        self.assertSame(self.opt("`(a ,@x)"),
+                        "(append (quote (a)) x (quote ()))")
+        self.assertSame(self.opt("`(a ,(+ 1 2))"), "(quote (a 3))")
+
+    def test_sameResults(self):
+        prog = """
+        (defn f (n) (if (< n 2) `(,n) (append `(,n) (f (- n (- 3 2))))))
+        (f (+ 2 3))
+        """
+        plain = newSpillSys()
+        plain.optimiser = None
+        self.assertSameSpill(self.si.readEval(prog), plain.readEval(prog))
+        self.retr("(f 3)", "(3 2 1)")
+        for s in ["(append 5 '())", "(append '(1) 5 '())"]:
+            self.assertRaises(TypeError, plain.readEval, s)
+            self.assertRaises(TypeError, self.si.readEval, s)
+        self.assertSameSpill(self.si.readEval("(append '(1) '() 5)"),
+                             plain.readEval("(append '(1) '() 5)"))
+
+    def test_fnBodies(self):
+        self.assertSame(self.opt("(fn () (+ 1 2))"), "(fn () (+ 1 2))")
+        self.assertSame(self.opt("(fn (x) (begin 1 (if 'true x y)))"),
+                        "(fn (x) x)")
+        for engine in spill.ENGINES:
+            si = newSpillSys(engine)
+            si.readEval("(def g (fn () (+ 1 2)))")
+            si.readEval("(def + (fn (* a) 99))")
+            self.assertSame(si.readEval("(g)"), 99, engine)
+
+    def test_defnShrinks(self):
+        form = list(reader.readForms(lexer.scan(
+            "(defn f (x) (if 'true (begin 'unused x) 0))")))[0]
+        ex = self.si.macroExpand(form)
+        result = self.si.optimise(ex)
+        self.assertSame(spilltypes.show(result), "(def f (fn (x) x))")
+        self.failUnless(spillopt.countNodes(result)
+                        < spillopt.countNodes(ex))
+
+    def test_switch(self):
+        si = spill.SpillSys(cache=False, optimise=False)
+        self.failUnless(si.optimiser is None)
+        self.failUnless(si.freeze().spawn().optimiser is None)
+        self.failUnless(self.si.optimiser is not None)
+
+    def test_dump(self):
+        out = StringIO.StringIO()
+        self.si.optimiser.dump = out
+        self.si.readEval("(+ 1 2)")
+        self.si.readEval("(pr)")
+        self.assertSame(out.getvalue(),
+                        "optimised (4 -> 1 nodes):\n  (+ 1 2)\n  3\n")
+
+class T_profiler(SpillTestTools):
+    """ test the profiler """
+
+    PROGRAM = """
+    (def fact (fn (n) (if (< n 2) 1 (* n (fact (- n 1))))))
+    (def sumFacts (fn (n) (reduce + 0 (map fact (fromto 1 n)))))
+    """
+
+    def test_names(self):
+        for si in (self.si, newSpillSys('compile')):
+            si.readEval(self.PROGRAM)
+            self.assertSame(si.eval('fact').name, 'fact')
+            si.readEval("(def f2 fact)")
+            self.assertSame(si.eval('f2').name, 'fact')
+
+    def test_profile(self):
+        for si in (self.si, newSpillSys('compile')):
+            si.readEval(self.PROGRAM)
+            fact = si.eval('fact')
+            prof = si.startProfiling()
+            self.assertSame(si.readEval("(sumFacts 4)"), 33)
+            si.readEval("(def twice (fn (x) (* 2 x)))")
+            si.readEval("(twice 1)")
+            si.stopProfiling()
+            self.failUnless(si.eval('fact') is fact, "fact put back")
+            self.assertSame(si.eval('odd?').__class__,
+                            si.globalEnv.parent.get('odd?').__class__)
+            st = prof.stats
+            self.assertSame(st['sumFacts'].calls, 1)
+            self.assertSame(st['sumFacts'].frames, 11,
+                            "sumFacts, and fact 1+2+3+4 times")
+            self.assertSame(st['fact'].calls, 10)
+            self.assertSame(st['fact'].primitiveCalls, 4)
+            self.assertSame(st['*'].calls, 7, "6 in fact, 1 in twice")
+            self.assertSame(st['twice'].calls, 1)
+            self.failUnless(st['sumFacts'].inclusive
+                            >= st['sumFacts'].exclusive)
+            self.assertSame(sorted(st['fact'].callers.keys()),
+                            ['fact', 'map'])
+            report = prof.report()
+            self.failUnless("sumFacts" in report and
+                            "* (primitive)" in report)
+
+    def test_baseLibrary(self):
+        for engine in spill.ENGINES:
+            base = spill.SpillSys(engine=engine)
+            base.readEval("(def inner (fn (x) x))")
+            base.readEval("(def outer (fn (x) (inner x)))")
+            base.freeze()
+            si = base.spawn()
+            prof = si.startProfiling()
+            self.assertSame(si.readEval("(outer 1)"), 1)
+            si.stopProfiling()
+            self.assertSame(prof.stats['inner'].calls, 1, engine)
+            self.assertSame(prof.stats['outer'].frames, 2, engine)
+            self.failIf(si.globalEnv.copied, engine)
+            self.failIf(si.globalEnv.data.has_key('inner'), engine)
+            self.assertSame(si.readEval("(outer 2)"), 2)
+            self.assertSame(prof.stats['inner'].calls, 1, engine)
+
+    def test_pstats(self):
+        import pstats
+        self.si.readEval(self.PROGRAM)
+        prof = self.si.startProfiling()
+        self.si.readEval("(sumFacts 3)")
+        self.si.stopProfiling()
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, "spill.prof")
+            prof.dumpStats(path)
+            st = pstats.Stats(path, stream=StringIO.StringIO())
+            self.assertSame(st.total_calls, prof.pstatsData()[
+                ("<spill closure>", 0, "fact")][1] + sum(
+                [v[1] for k, v in prof.pstatsData().items()
+                 if k[2]!='fact']))
+            st.sort_stats('time').print_stats()
+        finally:
+            shutil.rmtree(d)
+
+class T_tracer(SpillTestTools):
+    """ test the event tracer """
+
+    def test_events(self):
+        si = self.si
+        si.readEval("(def sq (fn (x) (* x x)))")
+        tracer = si.startTracing()
+        si.readEval("(sq 3)")
+        si.readEval("(and 1 2)")
+        si.stopTracing()
+        si.readEval("(sq 4)")
+        self.assertSame(si.eval('sq').__class__, spill.Closure)
+        events = [(e['ph'], e['cat'], e['name'])
+                  for e in tracer.traceEvents()]
+        self.assertSame(events, [
+            ('B', 'closure', 'sq'),
+            ('B', 'primitive', '*'),
+            ('E', 'primitive', '*'),
+            ('E', 'closure', 'sq'),
+            ('B', 'macro', 'and'),
+            ('E', 'macro', 'and'),
+            ('B', 'closure', 'not'),
+            ('E', 'closure', 'not'),
+        ])
+
+    def test_ringBuffer(self):
+        tracer = self.si.startTracing(size=10)
+        self.si.readEval("(map odd? (fromto 1 5))")
+        self.si.stopTracing()
+        self.failUnless(tracer.count > 10)
+        events = tracer.traceEvents()
+        self.failUnless(0 < len(events) <= 10)
+        self.assertSame(events[0]['ph'], 'B', "unmatched ends dropped")
+        ts = [e['ts'] for e in events]
+        self.assertSame(ts, sorted(ts))
+
+    def test_loadAndExport(self):
+        import json
+        d = tempfile.mkdtemp()
+        try:
+            source = os.path.join(d, "prog.l")
+            f = open(source, "w")
+            f.write("(def x (even? 2))")
+            f.close()
+            prof = self.si.startProfiling()
+            tracer = self.si.startTracing()
+            self.si.loadFile(source)
+            self.si.stopProfiling()
+            self.si.stopTracing()
+            self.assertSame(prof.stats['even?'].calls, 1,
+                            "profiling and tracing at once")
+            path = os.path.join(d, "trace.json")
+            tracer.exportChrome(path)
+            data = json.load(open(path))
+            events = data['traceEvents']
+            self.assertSame(events[0]['cat'], 'load')
+            self.assertSame(events[0]['name'], source)
+            self.assertSame(events[-1]['ph'], 'E')
+            self.assertSame(events[-1]['cat'], 'load')
+        finally:
+            shutil.rmtree(d)
+
+class T_spawn(SpillTestTools):
+    """ test spawning instances from a frozen base """
+
+    def setUp(self):
+        self.base = spill.SpillSys().freeze()
+        self.si = self.base.spawn()
+
+    def test_sharesLibrary(self):
+        self.retr("(even? 4)", "true")
+        self.failIf(self.si.globalEnv.data.has_key('even?'))
+        self.retr("(and 1 2)", "2")
+        self.failUnless('and' in self.si.macroNames())
+
+    def test_noLeaks(self):
+        self.si.readEval("(def x 1)")
+        self.si.readEval("(def not (fn (a) 'mine))")
+        self.si.readEval("(set! mod (fn (a b) 'mine))")
+        self.retr("(mod 7 2)", "mine")
+        si2 = self.base.spawn()
+        self.assertRaises(spill.VariableNotFound, si2.readEval, "x")
+        self.assertSame(si2.readEval("(mod 7 2)"), 1)
+        self.assertSame(si2.readEval("(not 0)"), "true")
+
+    def test_frozen(self):
+        self.assertRaises(spill.EnvironmentFrozen,
+                          self.base.readEval, "(def y 2)")
+        self.assertRaises(spill.EnvironmentFrozen,
+                          spill.SpillSys(library=None).spawn)
+
+    def test_compileEngine(self):
+        base = spill.SpillSys(engine='compile').freeze()
+        si = base.spawn()
+        self.assertSame(si.engine, 'compile')
+        si.readEval("(def f (fn (n) (begin (set! odd? (fn (x) n)) (odd? 1))))")
+        self.assertSame(si.readEval("(f 5)"), 5)
+        self.assertSame(base.spawn().readEval("(odd? 1)"), "true")
+
+    def test_setFromBase(self):
+        for engine in spill.ENGINES:
+            base = spill.SpillSys(engine=engine)
+            base.readEval("(def counter 0)")
+            base.readEval("(def bump (fn () (set! counter (+ counter 1))))")
+            base.freeze()
+            si = base.spawn()
+            si.readEval("(bump)")
+            si.readEval("(bump)")
+            self.assertSame(si.readEval("counter"), 2, engine)
+            self.assertSame(si.readEval("(bump)"), 3, engine)
+            self.assertSame(base.readEval("counter"), 0, engine)
+            si2 = base.spawn()
+            self.assertSame(si2.readEval("counter"), 0, engine)
+            self.assertSame(si2.readEval("(bump)"), 1, engine)
+            self.assertSame(si.readEval("counter"), 3, engine)
+            self.assertRaises(spill.EnvironmentFrozen,
+                              base.readEval, "(bump)")
+
+    def test_setIsPerInstance(self):
+        for engine in spill.ENGINES:
+            base = spill.SpillSys(engine=engine)
+            base.readEval("(def g 1)")
+            base.readEval("(def getg (fn () g))")
+            base.freeze()
+            a = base.spawn()
+            b = base.spawn()
+            a.readEval("(set! g 5)")
+            b.readEval("(def g 100)")
+            self.assertSame(b.readEval("(getg)"), 1, engine)
+            self.assertSame(a.readEval("(getg)"), 5, engine)
+            self.assertSame(b.readEval("(getg)"), 1, engine)
+            self.assertSame(base.spawn().readEval("(getg)"), 1, engine)
+            self.failIf(base.globalEnv.copied, engine)
+            self.failUnless(spill.Environment.copying > 0)
+
+class T_aot(SpillTestTools):
+    """ test ahead-of-time compilation into Python modules """
+
+    def setUp(self):
+        SpillTestTools.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.dir, "sample.l")
+        f = open(self.source, "w")
+        f.write("""
+        (defn twice (x) (* 2 x))
+        (def greeting "hi\\n")
+        (def data '(1 (2 "two") ()))
+        """)
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_compileAndLoad(self):
+        path = self.si.compileFile(self.source)
+        self.assertSame(path, os.path.join(self.dir, "sample_l.pyc"))
+        forms = spillaot.loadCompiled(self.source, self.si.macroState())
+        self.assertSameSpill(forms[0],
+           parser.parseExp("(def twice (fn (x) (* 2 x)))"))
+        si2 = spill.SpillSys()
+        si2.loadFile(self.source)
+        self.retr("(twice 21)", "42")
+        self.assertSame(si2.eval(('twice', 4)), 8)
+        self.assertSame(si2.eval('greeting'), spilltypes.LStr("hi\n"))
+        data = si2.eval('data')
+        self.assertSame(data.__class__, spilltypes.Pair)
+        self.assertSameSpill(data, parser.parseExp('(1 (2 "two") ())'))
+
+    def test_dottedPair(self):
+        f = open(self.source, "a")
+        # there's no syntax for an improper list, but a macro can
+        # put one in code
+        f.write("(def macro~dotted (fn () (list 'quote (cons 'a 'b))))\n"
+                "(def pair (dotted))")
+        f.close()
+        macros = self.si.macroState()
+        self.si.compileFile(self.source)
+        forms = spillaot.loadCompiled(self.source, macros)
+        pair = forms[-1][2][1]
+        self.assertSame(pair.car, 'a')
+        self.assertSame(pair.cdr, 'b')
+        si2 = spill.SpillSys()
+        si2.loadFile(self.source)
+        self.assertSame(si2.eval('pair').cdr, 'b')
+
+    def test_badModule(self):
+        self.si.compileFile(self.source)
+        f = open(spillaot.modulePath(self.source), "wb")
+        f.write("not a module")
+        f.close()
+        self.assertSame(spillaot.loadCompiled(self.source,
+                                              self.si.macroState()), None)
+
+    def test_iterLoadFile(self):
+        results = self.si.iterLoadFile(self.source)
+        self.assertSame(results.next(), self.si.eval('twice'))
+        self.assertSame(results.next(), spilltypes.LStr("hi\n"))
+
+    def test_outOfDate(self):
+        self.si.compileFile(self.source)
+        r = spillaot.loadCompiled(self.source, [])
+        self.assertSame(r, None, "different macros in effect")
+        f = open(self.source, "a")
+        f.write("(def more 1)")
+        f.close()
+        r = spillaot.loadCompiled(self.source, self.si.macroState())
+        self.assertSame(r, None, "source has changed")
+
+    def test_macroRedefined(self):
+        self.si.compileFile(self.source)
+        macros = self.si.macroState()
+        self.failIf(spillaot.loadCompiled(self.source, macros) is None)
+        self.si.readEval("(def macro~defn (fn (name params body) "
+                         "(list 'def name 0)))")
+        r = spillaot.loadCompiled(self.source, self.si.macroState())
+        self.assertSame(r, None, "a macro has a new definition")
+
+    def test_sameNameElsewhere(self):
+        other = os.path.join(self.dir, "other")
+        os.mkdir(other)
+        source2 = os.path.join(other, "sample.l")
+        f = open(source2, "w")
+        f.write("(def elsewhere 1)")
+        f.close()
+        self.si.compileFile(self.source)
+        self.si.compileFile(source2)
+        macros = self.si.macroState()
+        forms = spillaot.loadCompiled(self.source, macros)
+        forms2 = spillaot.loadCompiled(source2, macros)
+        self.assertSame(len(forms), 3)
+        self.assertSame(len(forms2), 1)
+        self.assertSame(spillaot.loadCompiled(self.source, macros), forms)
+
+    def test_optimised(self):
+        f = open(self.source, "a")
+        f.write("(def folded (fn () (if 'true (+ 1 2) 0)))")
+        f.close()
+        self.si.compileFile(self.source)
+        si2 = spill.SpillSys()
+        si2.loadFile(self.source)
+        self.assertSameSpill(si2.eval('folded').body,
+                             parser.parseExp("(+ 1 2)"))
+
+class T_formCache(SpillTestTools):
+    """ test the on-disk cache of expanded forms """
+
+    def setUp(self):
+        SpillTestTools.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        self.cacheDir = os.path.join(self.dir, "cache")
+        self.cache = spillcache.FormCache(self.cacheDir)
+        self.source = os.path.join(self.dir, "sample.l")
+        f = open(self.source, "w")
+        f.write("""
+        (defn twice (x) (* 2 x))
+        (def greeting "hi\\n")
+        (def data '(1 (2 "two") ()))
+        """)
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_encode(self):
+        exs = [parser.parseExp('(def x (quote (1 "a" ())))'),
+               spilltypes.toCons([1, 2], 3),
+               spilltypes.LStr("\xff\n"),
+               parser.parseExp("(def v #(1 2 3))")]
+        for ex in exs:
+            ex = self.si.macroExpand(ex)
+            r = spillcache.decode(spillcache.encode(ex))
+            self.assertSame(spilltypes.show(r), spilltypes.show(ex))
+            self.assertSame(r.__class__, ex.__class__)
+
+    def test_hitAndMiss(self):
+        si = spill.SpillSys(cache=self.cache)
+        self.assertSame(self.cache.stats(),
+                        {'hits': 0, 'misses': 1, 'writes': 1},
+                        "libcore.l was cached")
+        si.loadFile(self.source)
+        self.assertSame(self.cache.misses, 2)
+        si2 = spill.SpillSys(cache=self.cache)
+        si2.loadFile(self.source)
+        self.assertSame(self.cache.stats(),
+                        {'hits': 2, 'misses': 2, 'writes': 2})
+        self.assertSame(si2.eval(('twice', 4)), 8)
+        self.assertSame(si2.eval('greeting'), spilltypes.LStr("hi\n"))
+        data = si2.eval('data')
+        self.assertSame(data.__class__, spilltypes.Pair)
+        self.assertSameSpill(data, parser.parseExp('(1 (2 "two") ())'))
+
+    def test_key(self):
+        state = self.si.macroState()
+        k = self.cache.key(self.source, state)
+        self.assertSame(self.cache.key(self.source, state), k)
+        self.failIf(self.cache.key(self.source, []) == k,
+                    "different macros in effect")
+        self.si.readEval("(def macro~and (fn (a b) (list 'if a b 0)))")
+        self.failIf(self.cache.key(self.source, self.si.macroState())
+                    == k, "a macro has been redefined")
+        f = open(self.source, "a")
+        f.write("(def more 1)")
+        f.close()
+        self.failIf(self.cache.key(self.source, state) == k,
+                    "source has changed")
+
+    def test_failedLoad(self):
+        """ a file that fails to load isn't cached """
+        f = open(self.source, "a")
+        f.write("(undefinedFunction 1)")
+        f.close()
+        si = spill.SpillSys(cache=self.cache)
+        self.assertRaises(Exception, si.loadFile, self.source)
+        self.assertSame(self.cache.writes, 1)
+        self.assertSame(os.listdir(self.cacheDir),
+                        [k for k in os.listdir(self.cacheDir)
+                         if k.endswith(".forms")], "no temporary files left")
+
+class T_server(lintest.TestCase):
+    """ test the evaluation server """
+
+    def startServer(self, address):
+        pool = spillserver.InterpreterPool(size=2)
+        self.server = spillserver.makeServer(address, pool)
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        addr = self.server.server_address
+        if isinstance(addr, tuple): addr = "%s:%d" % addr
+        return addr
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_eval(self):
+        client = spillserver.SpillClient(self.startServer("localhost:0"))
+        self.assertSame(client.eval("(+ 1 2)"), "3")
+        self.assertSame(client.eval("(def x 5) (list x 'a \"b\")"),
+                        '(5 a "b")')
+        self.assertSame(client.eval("(odd? 3)"), "true", "has libcore")
+        self.assertRaises(spillserver.SpillServerError, client.eval,
+                          "x")
+        self.assertRaises(spillserver.SpillServerError, client.eval,
+                          "(+ 1")
+        stats = client.stats()
+        self.assertSame(stats['requests'], 5)
+        self.assertSame(stats['errors'], 2)
+        client.close()
+
+    def test_isolation(self):
+        addr = self.startServer("localhost:0")
+        a = spillserver.SpillClient(addr)
+        b = spillserver.SpillClient(addr)
+        a.eval("(def y 1) (set! odd? 0)")
+        self.assertRaises(spillserver.SpillServerError, a.eval, "y")
+        self.assertSame(b.eval("(odd? 3)"), "true")
+        a.close()
+        b.close()
+
+    def test_output(self):
+        client = spillserver.SpillClient(self.startServer("localhost:0"))
+        for i in range(2):
+            self.assertSame(client.eval('(pr "x")'), '"x"')
+            self.assertSame(client.output, "x")
+        client.eval("(set-output-port! (open-output-string)) (pr 1)")
+        self.assertSame(client.output, "")
+        self.assertSame(client.eval('(pr "y") 2'), "2")
+        self.assertSame(client.output, "y", "the port was put back")
+        self.assertRaises(spillserver.SpillServerError, client.eval,
+                          '(pr "z") nosuchvar')
+        self.assertSame(client.output, "z")
+        self.assertSame(client.eval("3"), "3")
+        self.assertSame(client.output, "")
+        client.close()
+
+    def test_unixSocket(self):
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, "spill.sock")
+            client = spillserver.SpillClient(self.startServer(path))
+            self.assertSame(client.eval("(* 6 7)"), "42")
+            client.close()
+        finally:
+            shutil.rmtree(d)
+
+    def test_loadTest(self):
+        addr = self.startServer("localhost:0")
+        rate = spillserver.loadTest(addr, "(reduce + 0 (fromto 1 10))",
+                                    requests=40, concurrency=4)
+        self.failUnless(rate > 0)
+
+#---------------------------------------------------------------------
+
+class T_bench(lintest.TestCase):
+    """ the benchmarks still run """
+
+    def test_workloads(self):
+        for w in workloads.WORKLOADS:
+            r = runner.runWorkload(w, 10, repeat=1)
+            self.assertSame([name for name, t in r['phases']],
+                            [name for name, f in w.phases])
+
+    def test_exponent(self):
+        self.assertSame(runner.exponent(1.0, 4.0, 100, 200), 2.0)
+        self.assertSame(runner.exponent(0.0, 4.0, 100, 200), None)
+
+    def test_compare(self):
+        old = {'results': [{'workload': "fib", 'size': 12,
+                            'phases': [["seval", 2.0]]}]}
+        new = {'results': [{'workload': "fib", 'size': 12,
+                            'phases': [["seval", 1.0]]}]}
+        self.failUnless("-50.0%" in runner.compare(old, new))
+
 #---------------------------------------------------------------------
 
 group = lintest.TestGroup()
+group.add(T_lexer)
 group.add(T_parser)
+group.add(T_reader)
 group.add(T_spilltypes)
 group.add(T_basicFunctionality)
 group.add(T_libcore)
+group.add(T_vectors)
+group.add(T_maps)
+group.add(T_pmap)
+group.add(T_ports)
+group.add(T_memo)
+group.add(T_memoCompiled)
 group.add(T_macros)
+group.add(T_basicFunctionalityCompiled)
+group.add(T_libcoreCompiled)
+group.add(T_compileEngine)
+group.add(T_optimiser)
+group.add(T_profiler)
+group.add(T_tracer)
+group.add(T_spawn)
+group.add(T_aot)
+group.add(T_formCache)
+group.add(T_server)
+group.add(T_bench)
 
 if __name__=="__main__": group.run()
 